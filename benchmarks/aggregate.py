@@ -0,0 +1,48 @@
+"""
+Measure the aggregate graph of a campaign with many long running instances.
+
+	python -m benchmarks.aggregate [instances] [snapshots per instance] [database uri]
+
+A campaign is filled with snapshots, by default 1,000 instances of 10,000 each, and its aggregate paths_total graph is
+requested (the benchmark config disables the cache). Reports the time of each request and the peak memory allocated by
+Python while serving one.
+"""
+import sys
+import tracemalloc
+from collections import OrderedDict
+
+from benchmarks.common import make_app, timed, report, save_results, compare
+from benchmarks.generate import populate_campaign
+from mothership import models
+
+REQUESTS = 3
+
+
+def main():
+	instances = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+	snapshots = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+	app = make_app(sys.argv[3] if len(sys.argv) > 3 else None)
+	campaign = models.Campaign('aggregate')
+	campaign.put()
+
+	results = OrderedDict()
+	with timed(results, 'populate (s)'):
+		populate_campaign(campaign, instances, snapshots)
+	client = app.test_client()
+	url = '/graphs/campaign/%d/paths_total/aggregate' % campaign.id
+	for n in range(REQUESTS):
+		with timed(results, 'request %d (s)' % (n + 1)):
+			response = client.get(url)
+		assert response.status_code == 200, response.status_code
+	# measured separately as tracing allocations slows the request down several times
+	tracemalloc.start()
+	client.get(url)
+	results['peak memory (MB)'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+	tracemalloc.stop()
+
+	report('aggregate of %d instances x %d snapshots' % (instances, snapshots), results)
+	compare({'aggregate': results}, save_results('aggregate %d instances %d snapshots' % (instances, snapshots), {'aggregate': results}))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,131 @@
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'results')
+
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import event
+
+from mothership import create_app, settings
+from mothership.models import db
+
+
+def make_app(database_uri=None, **config):
+	"""
+	Create an application backed by a fresh database and data directory and push an application context for it
+
+	:param database_uri: the database to benchmark against, defaults to a new sqlite database in a temporary directory
+	:param config: any other config values to override
+	"""
+	directory = tempfile.mkdtemp(prefix='mothership_bench_')
+	overrides = dict(
+		SQLALCHEMY_DATABASE_URI=database_uri or 'sqlite:///' + os.path.join(directory, 'database.db'),
+		SQLALCHEMY_ECHO=False,
+		DATA_DIRECTORY=os.path.join(directory, 'data'),
+	)
+	overrides.update(config)
+	app = create_app(type('BenchConfig', (settings.TestConfig,), overrides))
+	app.app_context().push()
+	db.create_all()
+	return app
+
+
+@contextlib.contextmanager
+def timed(results, name):
+	start = time.perf_counter()
+	yield
+	results[name] = time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def count_queries(results, name):
+	"""
+	Count the SQL statements executed inside the block
+	"""
+	count = [0]
+
+	def before_cursor_execute(*args):
+		count[0] += 1
+	event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+	try:
+		yield
+	finally:
+		event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+		results[name] = count[0]
+
+
+def percentiles(latencies, unit=1000, suffix=' (ms)'):
+	"""
+	Summarise a list of latencies in seconds as p50/p90/p99/max in milliseconds
+	"""
+	latencies = sorted(latencies)
+	r = {}
+	for p in [50, 90, 99]:
+		r['p%d%s' % (p, suffix)] = latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * unit
+	r['max' + suffix] = latencies[-1] * unit
+	return r
+
+
+def report(title, results):
+	print(title)
+	width = max(len(k) for k in results)
+	for k, v in results.items():
+		print('  %s  %s' % (k.ljust(width), '%.3f' % v if isinstance(v, float) else v))
+
+
+def git(*args):
+	return subprocess.check_output(('git',) + args, cwd=ROOT).decode('utf-8').strip()
+
+
+def results_path(commit):
+	return os.path.join(RESULTS_DIRECTORY, '%s.json' % commit)
+
+
+def save_results(benchmark, results):
+	"""
+	Record the results of a benchmark against the current commit in benchmarks/results/<commit>.json
+
+	:return: the results of the same benchmark at the most recent earlier commit that has them, or None
+	"""
+	commit = git('rev-parse', '--short', 'HEAD')
+	path = results_path(commit)
+	saved = {}
+	if os.path.exists(path):
+		with open(path) as f:
+			saved = json.load(f)
+	saved[benchmark] = results
+	os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+	with open(path, 'w') as f:
+		json.dump(saved, f, indent=2, sort_keys=True)
+
+	for previous in git('rev-list', '--abbrev-commit', 'HEAD~1').split():
+		if os.path.exists(results_path(previous)):
+			with open(results_path(previous)) as f:
+				previous_results = json.load(f)
+			if benchmark in previous_results:
+				return dict(previous_results[benchmark], commit=previous)
+	return None
+
+
+def compare(results, previous):
+	"""
+	Print how each result changed since a previous run
+	"""
+	if not previous:
+		print('No results from an earlier commit to compare with')
+		return
+	print('Compared with %s' % previous['commit'])
+	for name, values in results.items():
+		if not isinstance(values, dict) or not isinstance(previous.get(name), dict):
+			continue
+		for k, v in values.items():
+			before = previous[name].get(k)
+			if isinstance(v, (int, float)) and before:
+				print('  %s %s  %+.1f%%' % (name, k, (v - before) / before * 100))
@@ -0,0 +1,148 @@
+"""
+Drive a simulated fleet of slaves through the fuzzer endpoints (and a dashboard polling the campaign endpoints) with
+the Flask test client and report the latency percentiles and throughput of each endpoint.
+
+	python -m benchmarks.fleet [fuzzers] [rounds] [campaigns] [database uri]
+
+Each round every fuzzer submits a snapshot, every fifth round it also submits a crash, uploads its queue and downloads
+the other fuzzers' queues. Results are saved to benchmarks/results/<commit>.json and compared with the most recent
+earlier commit that has results.
+"""
+import io
+import json
+import os
+import random
+import sys
+import time
+from collections import OrderedDict, defaultdict
+from urllib.parse import urlsplit
+
+from benchmarks.common import make_app, report, percentiles, save_results, compare
+from mothership import models, storage
+from mothership.storage import campaign_key
+
+QUEUE_SIZE = 64 * 1024
+
+
+def path(url):
+	url = urlsplit(url)
+	return url.path + ('?' + url.query if url.query else '')
+
+
+class Fleet:
+
+	def __init__(self, app):
+		self.app = app
+		self.client = app.test_client()
+		self.latencies = defaultdict(list)
+		self.errors = defaultdict(int)
+
+	def request(self, endpoint, method, url, **kwargs):
+		start = time.perf_counter()
+		response = getattr(self.client, method)(path(url), **kwargs)
+		self.latencies[endpoint].append(time.perf_counter() - start)
+		if response.status_code >= 400:
+			self.errors[endpoint] += 1
+		return response
+
+	def register(self, master=None):
+		url = '/fuzzers/register?hostname=fleet' + ('&master=%d' % master if master else '')
+		return json.loads(self.request('register', 'get', url).get_data(as_text=True))
+
+	def submit(self, fuzzer, n):
+		now = int(time.time()) + n * 60
+		self.request('submit', 'post', fuzzer['submit'], content_type='application/json', data=json.dumps({
+			'status': {
+				'last_update': now,
+				'execs_done': n * 100000,
+				'execs_per_sec': random.uniform(100, 2000),
+				'paths_total': n,
+				'paths_found': n,
+				'bitmap_cvg': random.uniform(0, 10),
+				'unique_crashes': n // 5,
+			},
+			'snapshots': [{
+				'unix_time': now,
+				'paths_total': n,
+				'map_size': random.uniform(0, 10),
+				'unique_crashes': n // 5,
+				'execs_per_sec': random.uniform(100, 2000),
+			}]
+		}))
+
+	def submit_crash(self, fuzzer, n):
+		self.request('submit_crash', 'post', fuzzer['submit_crash'] + '?time=%d' % (int(time.time()) + n * 60), data={
+			'file': (io.BytesIO(os.urandom(256)), 'id:%06d,sig:11' % n)
+		})
+
+	def upload(self, fuzzer):
+		self.request('upload', 'post', fuzzer['upload'], data={
+			'file': (io.BytesIO(os.urandom(QUEUE_SIZE)), 'queue.tar')
+		})
+
+	def download(self, fuzzer):
+		urls = json.loads(self.request('download', 'get', fuzzer['download']).get_data(as_text=True))
+		for url in urls['sync_dirs'][:3]:
+			self.request('download sync_dir', 'get', url)
+		return urls
+
+	def dashboard(self, campaign_id):
+		self.request('stats', 'get', '/campaigns/stats/%d' % campaign_id)
+		self.request('graph', 'get', '/graphs/campaign/%d/paths_total' % campaign_id)
+
+	def results(self, elapsed):
+		results = OrderedDict()
+		for endpoint, latencies in self.latencies.items():
+			results[endpoint] = OrderedDict(requests=len(latencies), errors=self.errors[endpoint])
+			results[endpoint]['requests/s'] = len(latencies) / sum(latencies)
+			results[endpoint].update(percentiles(latencies))
+		results['total'] = OrderedDict(requests=sum(len(l) for l in self.latencies.values()))
+		results['total']['requests/s'] = results['total']['requests'] / elapsed
+		return results
+
+
+def make_campaigns(app, campaigns, fuzzers):
+	campaign_ids = []
+	for i in range(campaigns):
+		campaign = models.Campaign('fleet %d' % i)
+		campaign.active = True
+		campaign.desired_fuzzers = -(-fuzzers // campaigns)
+		campaign.executable_name = 'executable'
+		campaign.put()
+		storage.get().save(campaign_key(campaign.name, 'executable'), io.BytesIO(os.urandom(1024 * 1024)))
+		campaign_ids.append(campaign.id)
+	return campaign_ids
+
+
+def main():
+	fuzzers = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+	rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+	campaigns = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+	app = make_app(sys.argv[4] if len(sys.argv) > 4 else None)
+	campaign_ids = make_campaigns(app, campaigns, fuzzers)
+
+	fleet = Fleet(app)
+	start = time.perf_counter()
+	slaves = [fleet.register(master=campaign_id) for campaign_id in campaign_ids] + [fleet.register() for _ in range(fuzzers)]
+	for fuzzer in slaves:
+		urls = fleet.download(fuzzer)
+		fleet.request('download executable', 'get', urls['executable'])
+		fleet.request('download testcases', 'get', urls['testcases'])
+	for n in range(1, rounds + 1):
+		for fuzzer in slaves:
+			fleet.submit(fuzzer, n)
+			if n % 5 == 0:
+				fleet.submit_crash(fuzzer, n)
+				fleet.upload(fuzzer)
+				fleet.download(fuzzer)
+		for campaign_id in campaign_ids:
+			fleet.dashboard(campaign_id)
+	results = fleet.results(time.perf_counter() - start)
+
+	for endpoint, endpoint_results in results.items():
+		report(endpoint, endpoint_results)
+	compare(results, save_results('fleet %d fuzzers %d rounds %d campaigns' % (fuzzers, rounds, campaigns), results))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,99 @@
+"""
+Generate a synthetic fleet's worth of campaigns, instances, snapshots and crashes.
+
+	python -m benchmarks.generate [campaigns] [instances] [snapshots] [crashes] [database uri]
+
+The totals are spread evenly across the campaigns. Pass the same database uri to the other benchmarks to run them
+against the generated data.
+"""
+import random
+import sys
+import time
+from collections import OrderedDict
+
+from benchmarks.common import make_app, timed, report
+from mothership import models
+from mothership.models import db
+
+
+def populate_campaign(campaign, instances, snapshots_per_instance, crashes_per_instance=0, chunk_size=10000):
+	"""
+	Fill a campaign with synthetic instances, snapshots and crashes using bulk inserts
+	"""
+	now = int(time.time())
+	start = now - snapshots_per_instance * 60
+	instance_table = models.FuzzerInstance.__table__
+	db.session.execute(instance_table.insert(), [dict(
+		campaign_id=campaign.id,
+		hostname='bench-%d' % i,
+		start_time=start,
+		last_update=now,
+		execs_done=random.randint(10 ** 6, 10 ** 8),
+		paths_found=random.randint(0, 1000),
+		bitmap_cvg=random.uniform(0, 10),
+	) for i in range(instances)])
+	db.session.commit()
+	instance_ids = [i for i, in db.session.query(models.FuzzerInstance.id).filter_by(campaign_id=campaign.id)]
+
+	rows = []
+	crashes = []
+	for instance_id in instance_ids:
+		for n in range(snapshots_per_instance):
+			rows.append(dict(
+				instance_id=instance_id,
+				unix_time=start + n * 60,
+				paths_total=n,
+				map_size=n / snapshots_per_instance,
+				unique_crashes=n // 100,
+				execs_per_sec=random.uniform(100, 2000),
+			))
+			if len(rows) >= chunk_size:
+				db.session.execute(models.FuzzerSnapshot.__table__.insert(), rows)
+				rows = []
+		for n in range(crashes_per_instance):
+			crashes.append(dict(
+				campaign_id=campaign.id,
+				instance_id=instance_id,
+				created=start + random.randint(0, snapshots_per_instance * 60),
+				name='id:%06d' % n,
+				analyzed=True,
+				crash_in_debugger=True,
+				backtrace=str(random.randint(0, 100)),
+			))
+	if rows:
+		db.session.execute(models.FuzzerSnapshot.__table__.insert(), rows)
+	if crashes:
+		db.session.execute(models.Crash.__table__.insert(), crashes)
+	db.session.commit()
+	return instance_ids
+
+
+def populate(campaigns, instances, snapshots, crashes=0):
+	"""
+	Create campaigns and spread the given total numbers of instances, snapshots and crashes across them
+	"""
+	instances_per_campaign = max(instances // campaigns, 1)
+	snapshots_per_instance = max(snapshots // (instances_per_campaign * campaigns), 1)
+	crashes_per_instance = crashes // (instances_per_campaign * campaigns)
+	for i in range(campaigns):
+		campaign = models.Campaign('generated %d' % i)
+		campaign.desired_fuzzers = instances_per_campaign
+		campaign.put()
+		populate_campaign(campaign, instances_per_campaign, snapshots_per_instance, crashes_per_instance)
+
+
+def main():
+	campaigns = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+	instances = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+	snapshots = int(sys.argv[3]) if len(sys.argv) > 3 else 10000000
+	crashes = int(sys.argv[4]) if len(sys.argv) > 4 else 50000
+	app = make_app(sys.argv[5] if len(sys.argv) > 5 else None)
+	results = OrderedDict()
+	with timed(results, 'populate (s)'):
+		populate(campaigns, instances, snapshots, crashes)
+	results['database'] = app.config['SQLALCHEMY_DATABASE_URI']
+	report('%d campaigns, %d instances, %d snapshots, %d crashes' % (campaigns, instances, snapshots, crashes), results)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,88 @@
+"""
+Fire a storm of concurrent registrations at a multi-process server and check that no campaign is given more fuzzers
+than it wants, and that each campaign gets at most one master.
+
+	python -m benchmarks.registration [registrations] [processes] [database uri]
+"""
+import multiprocessing
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from sqlalchemy import func
+from werkzeug.serving import run_simple
+
+from benchmarks.common import make_app, report, percentiles
+from mothership import models
+from mothership.models import db
+
+PORT = 5055
+CAMPAIGNS = 10
+
+
+def serve(database_uri, data_directory, processes):
+	app = make_app(database_uri, DATA_DIRECTORY=data_directory)
+	run_simple('127.0.0.1', PORT, app, processes=processes)
+
+
+def wait_for_server(url):
+	for _ in range(100):
+		try:
+			requests.get(url)
+			return
+		except requests.ConnectionError:
+			time.sleep(0.1)
+	raise Exception('Server did not start')
+
+
+def timed_get(url):
+	start = time.perf_counter()
+	status = requests.get(url).status_code
+	return status, time.perf_counter() - start
+
+
+def main():
+	registrations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+	processes = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+	app = make_app(sys.argv[3] if len(sys.argv) > 3 else None)
+	desired = registrations // CAMPAIGNS // 2
+	for i in range(CAMPAIGNS):
+		campaign = models.Campaign('storm %d' % i)
+		campaign.active = True
+		campaign.desired_fuzzers = desired
+		campaign.put()
+
+	server = multiprocessing.Process(target=serve, args=(app.config['SQLALCHEMY_DATABASE_URI'], app.config['DATA_DIRECTORY'], processes))
+	server.daemon = True
+	server.start()
+	url = 'http://127.0.0.1:%d/fuzzers/register?hostname=storm' % PORT
+	wait_for_server(url.replace('register', 'is_active/0'))
+
+	campaign_ids = [c.id for c in models.Campaign.query]
+	urls = [url] * registrations + [url + '&master=%d' % campaign_ids[i % CAMPAIGNS] for i in range(CAMPAIGNS * 10)]
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=200) as executor:
+		responses = list(executor.map(timed_get, urls))
+	elapsed = time.perf_counter() - start
+	server.terminate()
+
+	results = OrderedDict()
+	results['registered'] = sum(1 for status, _ in responses if status == 200)
+	results['rejected'] = sum(1 for status, _ in responses if status != 200)
+	results['registrations/s'] = len(responses) / elapsed
+	results.update(percentiles([latency for _, latency in responses]))
+	report('%d registrations against %d processes' % (len(urls), processes), results)
+
+	db.session.remove()
+	instance = models.FuzzerInstance
+	for campaign_id, count in db.session.query(instance.campaign_id, func.count(instance.id)).filter_by(master=False).group_by(instance.campaign_id):
+		assert count <= desired, 'campaign %d has %d fuzzers but only wants %d' % (campaign_id, count, desired)
+	for campaign_id, count in db.session.query(instance.campaign_id, func.count(instance.id)).filter_by(master=True).group_by(instance.campaign_id):
+		assert count == 1, 'campaign %d has %d masters' % (campaign_id, count)
+	print('OK - no campaign exceeded its desired fuzzers or had more than one master')
+
+
+if __name__ == '__main__':
+	main()
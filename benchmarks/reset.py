@@ -0,0 +1,40 @@
+"""
+Benchmark resetting a campaign with a large number of snapshots.
+
+	python -m benchmarks.reset [snapshots] [instances]
+"""
+import sys
+from collections import OrderedDict
+
+from benchmarks.common import make_app, timed, count_queries, report
+from benchmarks.generate import populate_campaign
+from mothership import models
+from mothership.controllers.campaigns import reset_campaign
+
+
+def legacy_reset(campaign):
+	for fuzzer in campaign.fuzzers:
+		fuzzer.snapshots.delete()
+		fuzzer.crashes.delete()
+	campaign.fuzzers.delete()
+	campaign.put()
+
+
+def main():
+	snapshots = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+	instances = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+	make_app()
+
+	for name, reset in [('chunked', reset_campaign), ('legacy', legacy_reset)]:
+		results = OrderedDict()
+		campaign = models.Campaign.create(name='reset %s' % name)
+		with timed(results, 'populate (s)'):
+			populate_campaign(campaign, instances, snapshots // instances, crashes_per_instance=2)
+		with timed(results, 'reset (s)'), count_queries(results, 'statements'):
+			reset(campaign)
+		assert not models.FuzzerSnapshot.query.count()
+		report('%s reset of %d snapshots across %d instances' % (name, snapshots, instances), results)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,132 @@
+"""
+Measure how snapshot ingest scales with the number of gunicorn worker processes (see gunicorn.conf.py).
+
+	python -m benchmarks.scaling [fuzzers] [seconds] [database uri]
+
+For 1, 2, 4 and 8 workers a server is started and client processes submit snapshots for the fuzzers as fast as the
+server accepts them. Scaling is the throughput relative to perfectly linear scaling from one worker. Ingest can only
+scale with a database that handles concurrent writers, so give a MySQL uri for meaningful results - sqlite serialises
+every write. Requires gunicorn.
+"""
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+import requests
+
+from benchmarks.common import ROOT, make_app, report, percentiles, save_results, compare
+from benchmarks.fleet import Fleet, make_campaigns
+from benchmarks.registration import wait_for_server
+
+PORT = 5056
+WORKERS = [1, 2, 4, 8]
+CLIENTS = 32
+CAMPAIGNS = 10
+
+
+def server_app(database_uri, data_directory, **config):
+	"""
+	The app served by each worker, which gunicorn creates with benchmarks.scaling:server_app('<uri>', '<directory>')
+	"""
+	from mothership import create_app, settings
+	overrides = dict(
+		DEBUG=False,
+		SQLALCHEMY_DATABASE_URI=database_uri,
+		SQLALCHEMY_ECHO=False,
+		DATA_DIRECTORY=data_directory,
+		INGEST_DIRECTORY=os.path.join(data_directory, 'ingest'),
+		JOB_WORKERS=1
+	)
+	overrides.update(config)
+	return create_app(type('ScalingConfig', (settings.TestConfig,), overrides))
+
+
+def serve(workers, database_uri, data_directory, **config):
+	return subprocess.Popen([
+		sys.executable, '-m', 'gunicorn',
+		'-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+		'-w', str(workers),
+		'-b', '127.0.0.1:%d' % PORT,
+		'benchmarks.scaling:server_app(%r, %r%s)' % (
+			database_uri, data_directory, ''.join(', %s=%r' % item for item in sorted(config.items()))
+		)
+	], cwd=ROOT)
+
+
+def submit_snapshots(args):
+	"""
+	Submit snapshots for instance_ids in turn until the deadline
+
+	:return: the latency of each submission and the number that failed
+	"""
+	instance_ids, deadline = args
+	session = requests.Session()
+	latencies, errors, n = [], 0, 0
+	while time.time() < deadline:
+		for instance_id in instance_ids:
+			n += 1
+			now = int(time.time()) + n
+			start = time.perf_counter()
+			response = session.post('http://127.0.0.1:%d/fuzzers/submit/%d' % (PORT, instance_id), json={
+				'status': {
+					'last_update': now,
+					'execs_done': n * 100000,
+					'execs_per_sec': random.uniform(100, 2000),
+					'paths_total': n,
+					'bitmap_cvg': random.uniform(0, 10),
+				},
+				'snapshots': [{
+					'unix_time': now,
+					'paths_total': n,
+					'map_size': random.uniform(0, 10),
+					'unique_crashes': 0,
+					'execs_per_sec': random.uniform(100, 2000),
+				}]
+			})
+			latencies.append(time.perf_counter() - start)
+			# 202 when accepted for the ingest writer
+			if response.status_code not in (200, 202):
+				errors += 1
+	return latencies, errors
+
+
+def main():
+	fuzzers = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+	app = make_app(sys.argv[3] if len(sys.argv) > 3 else None)
+	make_campaigns(app, CAMPAIGNS, fuzzers)
+	fleet = Fleet(app)
+	instance_ids = [fleet.register()['id'] for _ in range(fuzzers)]
+	clients = [instance_ids[i::CLIENTS] for i in range(min(CLIENTS, fuzzers))]
+
+	results = OrderedDict()
+	for workers in WORKERS:
+		server = serve(workers, app.config['SQLALCHEMY_DATABASE_URI'], app.config['DATA_DIRECTORY'])
+		try:
+			wait_for_server('http://127.0.0.1:%d/fuzzers/is_active/0' % PORT)
+			deadline = time.time() + seconds
+			with multiprocessing.Pool(len(clients)) as pool:
+				submitted = pool.map(submit_snapshots, [(ids, deadline) for ids in clients])
+		finally:
+			server.terminate()
+			server.wait()
+		latencies = [latency for client_latencies, _ in submitted for latency in client_latencies]
+		run = OrderedDict()
+		run['snapshots'] = len(latencies)
+		run['errors'] = sum(errors for _, errors in submitted)
+		run['snapshots/s'] = len(latencies) / seconds
+		run['scaling'] = run['snapshots/s'] / (results['1 worker']['snapshots/s'] * workers) if results else 1.
+		run.update(percentiles(latencies))
+		name = '%d worker%s' % (workers, 's' if workers > 1 else '')
+		results[name] = run
+		report(name, run)
+
+	compare(results, save_results('scaling %d fuzzers %d seconds' % (fuzzers, seconds), results))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,107 @@
+"""
+Compare snapshot ingest into an sqlite database with sqlite's defaults and with the settings from sqlite.py (WAL and
+its pragmas, and the single ingest writer), and check that the latter meets its throughput targets.
+
+	python -m benchmarks.sqlite [fuzzers] [seconds] [workers]
+
+For each mode a fresh database is served by gunicorn and client processes submit snapshots as fast as the server
+accepts them. Throughput counts the snapshots that reached the database, including those still being written by the
+ingest writer after the clients stopped. Requires gunicorn.
+"""
+import multiprocessing
+import sys
+import time
+from collections import OrderedDict
+
+from benchmarks.common import make_app, report, percentiles, save_results, compare
+from benchmarks.fleet import Fleet, make_campaigns
+from benchmarks.registration import wait_for_server
+from benchmarks.scaling import PORT, CLIENTS, CAMPAIGNS, serve, submit_snapshots
+from mothership import models
+from mothership.models import db
+
+MODES = OrderedDict([
+	('default', dict(SQLITE_PRAGMAS={}, SQLITE_SINGLE_WRITER=False)),
+	('performance', dict(SQLITE_SINGLE_WRITER=True)),
+])
+# performance mode must write this many times as many snapshots per second as sqlite's defaults...
+MIN_SPEEDUP = 2.
+# ...without failing any submissions, and written within this many seconds of the last being accepted
+MAX_DRAIN_SECONDS = 30
+
+
+def wait_for_writes(expected, timeout):
+	"""
+	Wait until expected snapshots are in the database, or no more have been written for timeout seconds
+
+	:return: the number of snapshots written
+	"""
+	written, last_change = 0, time.time()
+	while time.time() - last_change < timeout:
+		db.session.remove()
+		count = models.FuzzerSnapshot.query.count()
+		if count != written:
+			written, last_change = count, time.time()
+		if written >= expected:
+			break
+		time.sleep(0.1)
+	return written
+
+
+def run(mode, fuzzers, seconds, workers):
+	app = make_app()
+	make_campaigns(app, CAMPAIGNS, fuzzers)
+	fleet = Fleet(app)
+	instance_ids = [fleet.register()['id'] for _ in range(fuzzers)]
+	clients = [instance_ids[i::CLIENTS] for i in range(min(CLIENTS, fuzzers))]
+
+	server = serve(workers, app.config['SQLALCHEMY_DATABASE_URI'], app.config['DATA_DIRECTORY'], **MODES[mode])
+	try:
+		wait_for_server('http://127.0.0.1:%d/fuzzers/is_active/0' % PORT)
+		start = time.time()
+		deadline = start + seconds
+		with multiprocessing.Pool(len(clients)) as pool:
+			submitted = pool.map(submit_snapshots, [(ids, deadline) for ids in clients])
+		latencies = [latency for client_latencies, _ in submitted for latency in client_latencies]
+		errors = sum(errors for _, errors in submitted)
+		accepted = time.time()
+		written = wait_for_writes(len(latencies) - errors, MAX_DRAIN_SECONDS)
+		finished = time.time()
+	finally:
+		server.terminate()
+		server.wait()
+
+	results = OrderedDict()
+	results['snapshots'] = len(latencies)
+	results['errors'] = errors
+	results['written'] = written
+	results['drain (s)'] = finished - accepted
+	results['snapshots/s'] = written / (finished - start)
+	results.update(percentiles(latencies))
+	return results
+
+
+def main():
+	fuzzers = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+	workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+	results = OrderedDict()
+	for mode in MODES:
+		results[mode] = run(mode, fuzzers, seconds, workers)
+		report(mode, results[mode])
+	speedup = results['performance']['snapshots/s'] / results['default']['snapshots/s']
+	print('speedup  %.2fx' % speedup)
+
+	compare(results, save_results('sqlite %d fuzzers %d seconds %d workers' % (fuzzers, seconds, workers), results))
+
+	performance = results['performance']
+	assert not performance['errors'], '%d submissions failed in performance mode' % performance['errors']
+	assert performance['written'] == performance['snapshots'], 'only %d of %d snapshots were written within %ds' % (
+		performance['written'], performance['snapshots'], MAX_DRAIN_SECONDS
+	)
+	assert speedup >= MIN_SPEEDUP, 'performance mode is only %.2fx faster than the defaults, wanted %.1fx' % (speedup, MIN_SPEEDUP)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,67 @@
+"""
+Compare the execs/sec of afl-fuzz with its output directory on disk and on a tmpfs, as used by slave.py --tmpfs.
+
+	python -m benchmarks.tmpfs <afl-fuzz> <testcases> <seconds> <disk directory> [tmpfs directory] -- <target> [args]
+
+The tmpfs directory defaults to /dev/shm.
+"""
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from benchmarks.common import report, save_results, compare
+
+
+def read_stats(output):
+	stats = {}
+	with open(os.path.join(output, 'fuzzer_stats')) as f:
+		for line in f:
+			key, _, value = line.partition(':')
+			stats[key.strip()] = value.strip()
+	return stats
+
+
+def fuzz(afl, testcases, seconds, directory, target):
+	"""
+	Run afl-fuzz with its output in directory for a number of seconds
+
+	:return: afl's average execs/sec
+	"""
+	output = tempfile.mkdtemp(prefix='mothership_bench_', dir=directory)
+	env = dict(os.environ, AFL_NO_UI='1', AFL_SKIP_CPUFREQ='1', AFL_I_DONT_CARE_ABOUT_MISSING_CRASHES='1')
+	try:
+		with open(os.devnull, 'wb') as devnull:
+			process = subprocess.Popen([afl, '-i', testcases, '-o', output, '--'] + target, env=env, stdout=devnull, stderr=devnull)
+			time.sleep(seconds)
+			# afl-fuzz writes its final stats when interrupted
+			process.send_signal(signal.SIGINT)
+			process.wait()
+		return float(read_stats(output)['execs_per_sec'])
+	finally:
+		shutil.rmtree(output, ignore_errors=True)
+
+
+def main():
+	if '--' not in sys.argv:
+		print(__doc__)
+		sys.exit(1)
+	args = sys.argv[1:sys.argv.index('--')]
+	target = sys.argv[sys.argv.index('--') + 1:]
+	afl, testcases, seconds, disk = args[:4]
+	tmpfs = args[4] if len(args) > 4 else '/dev/shm'
+
+	results = OrderedDict()
+	results['disk execs/s'] = fuzz(afl, testcases, int(seconds), disk, target)
+	results['tmpfs execs/s'] = fuzz(afl, testcases, int(seconds), tmpfs, target)
+	results['speedup'] = results['tmpfs execs/s'] / results['disk execs/s']
+	report('afl-fuzz output on %s and on %s for %s seconds' % (disk, tmpfs, seconds), results)
+	compare({'tmpfs': results}, save_results('tmpfs', {'tmpfs': results}))
+
+
+if __name__ == '__main__':
+	main()
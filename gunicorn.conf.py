@@ -0,0 +1,37 @@
+"""
+gunicorn settings for the mothership, see wsgi.py. Any of them can be overridden on the command line, e.g. -w 8
+
+Every worker process serves requests and runs background jobs against the shared database (see coordination.py). Use
+a database that handles concurrent writers, such as MySQL, a cache shared between workers (ProdConfig's filesystem
+cache, or redis across hosts) and, across hosts, STORAGE_BACKEND = 's3'.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('MOTHERSHIP_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('MOTHERSHIP_WORKERS', multiprocessing.cpu_count()))
+# threaded workers so that dashboards' long lived event streams don't each tie up a process. Each open dashboard still
+# holds one of a worker's threads (for up to STREAM_MAX_AGE at a time), so raise MOTHERSHIP_THREADS for many viewers.
+# Snapshots are only pushed live to dashboards on the worker that received them (see events.py), the rest pick up new
+# stats every STREAM_KEEPALIVE and graphs on their next poll - run a single worker if every dashboard must update live
+worker_class = 'gthread'
+threads = int(os.environ.get('MOTHERSHIP_THREADS', 8))
+timeout = 120
+graceful_timeout = 30
+# recycle workers now and then to bound any memory growth
+max_requests = 10000
+max_requests_jitter = 1000
+
+
+def on_starting(server):
+	"""
+	Bring the database up to date once, before any workers start, rather than in every worker at once. The workers are
+	forked with the app loaded here, so they skip doing it again on their first request
+	"""
+	from mothership.models import db, init_db
+	app = server.app.wsgi()
+	with app.app_context():
+		init_db()
+		# don't hand the master's connections down to the workers
+		db.engine.dispose()
+	app.config['INIT_DB_ON_START'] = False
@@ -4,8 +4,9 @@ import os
 
 from flask_script import Manager, Server
 from flask_script.commands import ShowUrls, Clean
-from mothership import create_app
+from mothership import create_app, jobs, models
 from mothership.models import db
+from mothership.retention import archive_campaign, import_archive
 
 # default to dev config because no one should use this in
 # production anyway
@@ -13,7 +14,7 @@ env = os.environ.get('MOTHERSHIP_ENV', 'dev')
 app = create_app('mothership.settings.%sConfig' % env.capitalize())
 
 manager = Manager(app)
-manager.add_command("server", Server())
+manager.add_command("server", Server(threaded=True))  # threaded so dashboard event streams don't block requests
 manager.add_command("show-urls", ShowUrls())
 manager.add_command("clean", Clean())
 
@@ -36,5 +37,37 @@ def createdb():
 
 	db.create_all()
 
+
+@manager.command
+def retention():
+	""" Apply snapshot retention and archive old campaigns now
+	"""
+
+	job = jobs.enqueue('apply_retention')
+	# there is no job runner in this process, so run it here unless enqueue already has (JOB_WORKERS = 0)
+	if jobs.claim(job.id):
+		jobs.run(job)
+	job = models.Job.get(id=job.id)
+	print(job.result if job.status == models.Job.DONE else '%s %s' % (job.status, job.message or ''))
+
+
+@manager.command
+def archive(campaign_id):
+	""" Archive a campaign's instances, snapshots and crashes
+	"""
+
+	campaign = models.Campaign.get(id=int(campaign_id))
+	path, freed = archive_campaign(campaign)
+	print('Archived to %s, freeing %d bytes' % (path, freed))
+
+
+@manager.command
+def restore(path):
+	""" Restore a campaign from an archive file
+	"""
+
+	campaign = import_archive(path)
+	print('Restored %s (id=%d)' % (campaign.name, campaign.id))
+
 if __name__ == "__main__":
 	manager.run()
@@ -5,7 +5,6 @@ __author__ = 'Simon Pinfold'
 __email__ = 'simon@uint8.me'
 __version__ = '1.0'
 
-import os
 import datetime
 from flask import Flask
 from webassets.loaders import PythonLoader as PythonAssetsLoader
@@ -15,7 +14,7 @@ from mothership.controllers.main import main
 from mothership.controllers.campaigns import campaigns
 from mothership.controllers.graphs import graphs
 from mothership.controllers.fuzzers import fuzzers
-from mothership import assets
+from mothership import assets, jobs, retention, scheduler, reaper, metrics, storage, ingest, sqlite
 from mothership.models import db, init_db
 
 from mothership.extensions import (
@@ -42,7 +41,10 @@ def create_app(object_name):
 
 	@app.before_first_request
 	def _run_on_start():
-		init_db()
+		if app.config['INIT_DB_ON_START']:
+			init_db()
+		jobs.start_runner(app)
+		ingest.start_writer(app)
 
 	csrf = CsrfProtect(app)
 
@@ -60,6 +62,9 @@ def create_app(object_name):
 
 	# initialize SQLAlchemy
 	db.init_app(app)
+	sqlite.init_app(app)
+
+	metrics.init_app(app)
 
 	login_manager.init_app(app)
 
@@ -76,9 +81,6 @@ def create_app(object_name):
 	app.register_blueprint(fuzzers)
 	csrf.exempt(fuzzers)
 
-	try:
-		os.mkdir(app.config['DATA_DIRECTORY'])
-	except FileExistsError:
-		pass
+	storage.init_app(app)
 
 	return app
@@ -0,0 +1,51 @@
+"""
+Cache the responses of the campaign endpoints that dashboards poll.
+
+Cached responses are keyed by a per-campaign version which the ingest endpoints bump whenever a campaign gets new
+data, so a response is reused until either the campaign changes or CACHE_VIEW_TIMEOUT expires. With a shared cache
+backend (CACHE_TYPE = 'filesystem' or 'redis') every dashboard and server process shares one computation.
+"""
+from functools import wraps
+
+from flask import current_app, request, make_response
+
+from mothership.extensions import cache
+
+
+def version_key(campaign_id):
+	return 'campaign-version:%d' % campaign_id
+
+
+def campaign_version(campaign_id):
+	return cache.get(version_key(campaign_id)) or 0
+
+
+def invalidate(campaign_id):
+	"""
+	Mark every cached response for a campaign as stale
+	"""
+	cache.cache.inc(version_key(campaign_id))
+
+
+def campaign_cached(f):
+	"""
+	Cache the response of a view taking a campaign_id for the current version of that campaign
+	"""
+	@wraps(f)
+	def decorated(campaign_id, **kwargs):
+		key = 'view:%s:%d:%d:%s:%s' % (
+			f.__name__,
+			campaign_id,
+			campaign_version(campaign_id),
+			','.join('%s=%s' % kv for kv in sorted(kwargs.items())),
+			request.query_string.decode('utf-8')
+		)
+		cached = cache.get(key)
+		if cached is None:
+			response = make_response(f(campaign_id, **kwargs))
+			cached = (response.get_data(), response.status_code, response.mimetype)
+			if response.status_code == 200:
+				cache.set(key, cached, timeout=current_app.config['CACHE_VIEW_TIMEOUT'])
+		data, status, mimetype = cached
+		return current_app.response_class(data, status=status, mimetype=mimetype)
+	return decorated
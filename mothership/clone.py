@@ -0,0 +1,81 @@
+import os
+import shutil
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+	"""
+	Create dst as a copy-on-write clone of src. Raises OSError if the filesystem (or platform) does not support it
+	"""
+	if not fcntl:
+		raise OSError('reflinks are not supported on this platform')
+	with open(src, 'rb') as s, open(dst, 'xb') as d:
+		try:
+			fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+		except OSError:
+			d.close()
+			os.unlink(dst)
+			raise
+	shutil.copystat(src, dst)
+
+
+def clone_file(src, dst, hardlinks=True):
+	"""
+	Clone a single file as cheaply as the filesystem allows: a reflink if supported, otherwise a hardlink, otherwise a
+	full copy.
+
+	Hardlinked files share their contents, so anything that later writes to a cloned file must call unshare first.
+
+	:return: the method that was used - 'reflink', 'hardlink' or 'copy'
+	"""
+	# left by an earlier attempt (e.g. a requeued copy job), and possibly a hardlink to src that writing would empty
+	try:
+		os.unlink(dst)
+	except FileNotFoundError:
+		pass
+	try:
+		reflink(src, dst)
+		return 'reflink'
+	except OSError:
+		pass
+	if hardlinks:
+		try:
+			os.link(src, dst)
+			return 'hardlink'
+		except OSError:
+			pass
+	shutil.copy2(src, dst)
+	return 'copy'
+
+
+def clone(src, dst, hardlinks=True):
+	"""
+	Clone a file or directory tree from src to dst using clone_file for every file
+	"""
+	if not os.path.isdir(src):
+		clone_file(src, dst, hardlinks)
+		return
+	for root, dirs, files in os.walk(src):
+		dest_root = os.path.join(dst, os.path.relpath(root, src))
+		os.makedirs(dest_root, exist_ok=True)
+		for name in files:
+			clone_file(os.path.join(root, name), os.path.join(dest_root, name), hardlinks)
+
+
+def unshare(path):
+	"""
+	Break the link between a (possibly) hardlinked file and its clones so that it can be written to without modifying
+	the other campaigns sharing it. Once our link is removed, writing to path creates a new file.
+	"""
+	try:
+		if os.stat(path).st_nlink > 1:
+			os.unlink(path)
+	except FileNotFoundError:
+		pass
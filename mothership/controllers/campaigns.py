@@ -1,26 +1,30 @@
-import shutil
+import json
 import subprocess
 import time
 import os
+from queue import Empty
 
 import sqlalchemy
-from flask import Blueprint, render_template, render_template_string, flash, redirect, request, url_for, jsonify, current_app
+from flask import Blueprint, render_template, render_template_string, flash, redirect, request, url_for, jsonify, current_app, Response, stream_with_context
 from datetime import datetime
-from sqlalchemy import case
-from werkzeug.utils import secure_filename
+from sqlalchemy import case, desc
 
-from mothership import forms, models
+from mothership import forms, models, jobs, events, storage
+from mothership.caching import campaign_cached, invalidate
+from mothership.storage import campaign_key
 from mothership.utils import format_timedelta_secs, pretty_size_dec, format_ago
 
 
 campaigns = Blueprint('campaigns', __name__)
 
+CAMPAIGN_FILES = ['executable', 'libraries', 'testcases', 'ld_preload', 'dictionary']
+
 
 @campaigns.route('/')
 def list_campaigns():
-	if not os.path.exists(os.path.join(current_app.config['DATA_DIRECTORY'], 'libdislocator.so')):
+	if not storage.get().exists('libdislocator.so'):
 		flash('Missing libdislocator.so', 'danger')
-	if not os.path.exists(os.path.join(current_app.config['DATA_DIRECTORY'], 'afl-fuzz')):
+	if not storage.get().exists('afl-fuzz'):
 		flash('Missing afl-fuzz', 'danger')
 	return render_template('campaigns.html', campaigns=models.Campaign.all(parent_id=None))
 
@@ -31,45 +35,48 @@ def new_campaign():
 	if form.validate_on_submit():
 		model = models.Campaign(form.name)
 		form.populate_obj(model)
-		model.active = True
+		copyof = models.Campaign.get(id=form.copy_of.data)
+		# campaigns copied from another stay inactive until the copy job has finished
+		model.active = not copyof
 		model.put()
 
-		copyof = models.Campaign.get(id=form.copy_of.data)
-		other = None
-		if copyof:
-			other = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(copyof.name))
-		dir = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(model.name))
-		os.makedirs(dir)
+		store = storage.get()
+		to_copy = []
 		if form.executable.has_file():
-			form.executable.data.save(os.path.join(dir, 'executable'))
-		elif other:
-			shutil.copy(os.path.join(other, 'executable'), os.path.join(dir, 'executable'))
+			store.save(campaign_key(model.name, 'executable'), form.executable.data)
+		else:
+			to_copy.append('executable')
 
 		for config_files in ['libraries', 'testcases', 'ld_preload']:
-			dest = os.path.join(dir, config_files)
 			if getattr(form, config_files).has_file():
-				os.makedirs(dest)
 				for lib in request.files.getlist(config_files):
-					lib.save(os.path.join(dest, os.path.basename(lib.filename)))
-			elif other:
-				shutil.copytree(os.path.join(other, config_files), dest)
-			else:
-				os.makedirs(dest)
+					store.save(campaign_key(model.name, config_files, os.path.basename(lib.filename)), lib)
+			elif copyof:
+				to_copy.append(config_files)
 
-		if form.use_libdislocator.data:
-			shutil.copy(os.path.join(current_app.config['DATA_DIRECTORY'], 'libdislocator.so'), os.path.join(dir, 'ld_preload'))
-
-		dictionary = os.path.join(dir, 'dictionary')
 		if form.dictionary.has_file():
-			form.dictionary.data.save(dictionary)
-			model.has_dictionary = True
-			model.commit()
-		elif other and os.path.exists(os.path.join(other, 'dictionary')):
-			shutil.copy(os.path.join(other, 'dictionary'), os.path.join(dir, 'dictionary'))
+			store.save(campaign_key(model.name, 'dictionary'), form.dictionary.data)
 			model.has_dictionary = True
 			model.commit()
+		else:
+			to_copy.append('dictionary')
 
-		flash('Campaign created', 'success')
+		if copyof:
+			jobs.enqueue(
+				'copy_campaign_files',
+				campaign_id=model.id,
+				description='Copy files from %s' % copyof.name,
+				source_id=copyof.id,
+				dest_id=model.id,
+				files=to_copy,
+				use_libdislocator=form.use_libdislocator.data,
+				activate=True
+			)
+			flash('Campaign created - copying files from %s' % copyof.name, 'success')
+		else:
+			if form.use_libdislocator.data:
+				store.copy('libdislocator.so', campaign_key(model.name, 'ld_preload', 'libdislocator.so'))
+			flash('Campaign created', 'success')
 		return redirect(request.args.get('next') or url_for('campaigns.campaign', campaign_id=model.id))
 	return render_template('new-campaign.html', form=form)
 
@@ -84,32 +91,32 @@ def make_tests(campaign_id):
 		for test_size in [int(e) for e in form.sizes.data.replace(',', ' ').split()]:
 			for repeat in range(form.repeats.data):
 				name = '%s | %d fuzzer%s | test %d' % (original.name, test_size, 's' if test_size > 1 else '', repeat+1)
-				if os.path.exists(os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(name))):
+				# not the campaign's files, as they are only copied once the job runs
+				if models.Campaign.get(name=name):
 					flash('Failed to create tests - campaign "%s" already exists' % name, 'error')
 					return redirect(url_for('campaigns.campaign', campaign_id=original.id))
 				to_create.append((name, test_size))
-		original_dir = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(original.name))
 		for name, size in to_create:
 			copy = models.Campaign(name)
-			copy.active = original.active
+			copy.active = False
 			copy.desired_fuzzers = size
+			copy.priority = original.priority
 			copy.has_dictionary = original.has_dictionary
 			copy.executable_name = original.executable_name
 			copy.executable_args = original.executable_args
 			copy.afl_args = original.afl_args
 			copy.parent_id = original.id
 			copy.put()
-			dir = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(copy.name))
-			os.mkdir(dir)
-			for tocopy in ['executable', 'libraries', 'testcases', 'ld_preload', 'dictionary']:
-				original_path = os.path.join(original_dir, tocopy)
-				new_path = os.path.join(dir, tocopy)
-				if os.path.exists(original_path):
-					if os.path.isdir(original_path):
-						shutil.copytree(original_path, new_path)
-					else:
-						shutil.copy(original_path, new_path)
-		flash('Tests created', 'info')
+			jobs.enqueue(
+				'copy_campaign_files',
+				campaign_id=original.id,
+				description='Create %s' % copy.name,
+				source_id=original.id,
+				dest_id=copy.id,
+				files=CAMPAIGN_FILES,
+				activate=original.active
+			)
+		flash('Creating %d tests' % len(to_create), 'info')
 		return redirect(url_for('campaigns.campaign', campaign_id=original.id))
 	else:
 		return render_template('make-tests.html', campaign=original, form=form)
@@ -120,7 +127,6 @@ def campaign(campaign_id):
 	if not campaign_model:
 		return 'Campaign not found', 404
 	if request.method == 'POST':
-		dir = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign_model.name))
 		if 'delete' in request.form:
 			return redirect(url_for('campaigns.delete', campaign_id=campaign_id))
 		if 'enable' in request.form:
@@ -131,8 +137,8 @@ def campaign(campaign_id):
 			else:
 				flash('Campaign disabled', 'success')
 		if 'reset' in request.form:
-			reset_campaign(campaign_model)
-			flash('Campaign reset', 'success')
+			enqueue_reset(campaign_model)
+			flash('Campaign reset queued', 'success')
 		if 'activate_children' in request.form:
 			for child in campaign_model.children:
 				child.active = True
@@ -143,21 +149,22 @@ def campaign(campaign_id):
 				child.put()
 		if 'delete_children' in request.form:
 			for child in campaign_model.children:
-				delete_campaign(child)
+				enqueue_delete(child)
 		if 'reset_children' in request.form:
 			for child in campaign_model.children:
-				reset_campaign(child)
+				enqueue_reset(child)
 		uploaded = 0
 		for lib in request.files.getlist('libraries'):
 			if lib.filename:
-				lib.save(os.path.join(dir, 'libraries', os.path.basename(lib.filename)))
+				storage.get().save(campaign_key(campaign_model.name, 'libraries', os.path.basename(lib.filename)), lib)
 				uploaded += 1
 		for test in request.files.getlist('testcases'):
 			if test.filename:
-				test.save(os.path.join(dir, 'testcases', os.path.basename(test.filename)))
+				storage.get().save(campaign_key(campaign_model.name, 'testcases', os.path.basename(test.filename)), test)
 				uploaded += 1
 		if uploaded:
 			flash('Uploaded %d files' % uploaded, 'success')
+		invalidate(campaign_id)
 		return redirect(url_for('campaigns.campaign', campaign_id=campaign_id))
 
 	# TODO show campaign options, allow editing and show ldd output
@@ -172,13 +179,10 @@ def campaign(campaign_id):
 	))
 	heisenbugs = campaign_model.crashes.filter_by(analyzed=True, crash_in_debugger=False)
 	ldd = get_ldd(campaign_model)
-	try:
-		testcases = os.listdir(os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign_model.name), 'testcases'))
-		ld_preload = os.listdir(os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign_model.name), 'ld_preload'))
-	except FileNotFoundError:
-		testcases = []
-		ld_preload = []
-	return render_template('campaign.html', campaign=campaign_model, crashes=crashes, heisenbugs=heisenbugs, testcases=testcases, ldd=ldd, ld_preload=ld_preload, children=list(campaign_model.children))
+	testcases = storage.get().list(campaign_key(campaign_model.name, 'testcases'))
+	ld_preload = storage.get().list(campaign_key(campaign_model.name, 'ld_preload'))
+	campaign_jobs = models.Job.all(campaign_id=campaign_id).order_by(desc(models.Job.id)).limit(10)
+	return render_template('campaign.html', campaign=campaign_model, crashes=crashes, heisenbugs=heisenbugs, testcases=testcases, ldd=ldd, ld_preload=ld_preload, children=list(campaign_model.children), jobs=list(campaign_jobs))
 
 
 def get_ldd(campaign_model):
@@ -187,10 +191,12 @@ def get_ldd(campaign_model):
 		env['LD_LIBRARY_PATH'] = ':' + env['LD_LIBRARY_PATH']
 	else:
 		env['LD_LIBRARY_PATH'] = ''
-	env['LD_LIBRARY_PATH'] = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign_model.name), 'libraries') + env['LD_LIBRARY_PATH']
+	store = storage.get()
 	try:
-		p = subprocess.Popen(['ldd', os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign_model.name), 'executable')], env=env, stdout=subprocess.PIPE)
-		process_output = p.communicate()
+		with store.local(campaign_key(campaign_model.name, 'libraries')) as libraries, store.local(campaign_key(campaign_model.name, 'executable')) as executable:
+			env['LD_LIBRARY_PATH'] = libraries + env['LD_LIBRARY_PATH']
+			p = subprocess.Popen(['ldd', executable], env=env, stdout=subprocess.PIPE)
+			process_output = p.communicate()
 	except FileNotFoundError:
 		ldd = None
 	else:
@@ -204,7 +210,7 @@ def get_ldd(campaign_model):
 			found = 'not found' not in line
 			if found:
 				path = parts[2]
-				if path.startswith(current_app.config['DATA_DIRECTORY']):
+				if path.startswith(libraries):
 					ldd_row = (parts[0], 'info', path.rsplit(os.path.sep, 1)[-1])
 				else:
 					ldd_row = (parts[0], '', path)
@@ -222,8 +228,8 @@ def delete(campaign_id):
 		campaign_model = models.Campaign.get(id=campaign_id)
 		if not campaign_model:
 			return 'Campaign not found', 404
-		delete_campaign(campaign_model)
-		flash('Campaign deleted', 'success')
+		enqueue_delete(campaign_model)
+		flash('Campaign deletion queued', 'success')
 		return redirect(url_for('campaigns.list_campaigns'))
 	else:
 		html = '<form method="post">' \
@@ -233,33 +239,85 @@ def delete(campaign_id):
 		return render_template_string(html)
 
 
+def enqueue_delete(campaign_model):
+	# stop handing out fuzzers straight away, the job removes the campaign once its data is gone
+	campaign_model.active = False
+	campaign_model.put()
+	return jobs.enqueue('delete_campaign', campaign_id=campaign_model.id, description='Delete %s' % campaign_model.name, campaign_id_to_delete=campaign_model.id)
+
+
+def enqueue_reset(campaign_model):
+	return jobs.enqueue('reset_campaign', campaign_id=campaign_model.id, description='Reset %s' % campaign_model.name, campaign_id_to_reset=campaign_model.id)
+
+
+@jobs.task('delete_campaign')
+def delete_campaign_job(job, campaign_id_to_delete):
+	campaign_model = models.Campaign.get(id=campaign_id_to_delete)
+	if campaign_model:
+		delete_campaign(campaign_model)
+
+
+@jobs.task('reset_campaign')
+def reset_campaign_job(job, campaign_id_to_reset):
+	campaign_model = models.Campaign.get(id=campaign_id_to_reset)
+	if campaign_model:
+		reset_campaign(campaign_model)
+
+
+@jobs.task('copy_campaign_files')
+def copy_campaign_files(job, source_id, dest_id, files, use_libdislocator=False, activate=False):
+	source = models.Campaign.get(id=source_id)
+	dest = models.Campaign.get(id=dest_id)
+	if not source or not dest:
+		raise ValueError('Campaign to copy from or to no longer exists')
+	store = storage.get()
+	for i, tocopy in enumerate(files):
+		job.set_progress(i / len(files), 'Copying %s' % tocopy)
+		source_key = campaign_key(source.name, tocopy)
+		dest_key = campaign_key(dest.name, tocopy)
+		if store.exists(source_key):
+			store.copy(source_key, dest_key)
+		if tocopy == 'dictionary' and store.exists(dest_key):
+			dest.has_dictionary = True
+	if use_libdislocator:
+		libdislocator = campaign_key(dest.name, 'ld_preload', 'libdislocator.so')
+		if not store.exists(libdislocator):
+			store.copy('libdislocator.so', libdislocator)
+	if activate:
+		dest.active = True
+	dest.commit()
+
+
 def delete_campaign(campaign_model):
-	for child in campaign_model.children:
-		delete_campaign(child)
-	for fuzzer in campaign_model.fuzzers:
-		fuzzer.snapshots.delete()
-		fuzzer.crashes.delete()
-	campaign_model.fuzzers.delete()
-	campaign_model.delete()
-	try:
-		shutil.rmtree(os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign_model.name)))
-	except FileNotFoundError:
-		pass
+	campaign_ids = campaign_model.tree_ids()
+	names = [name for name, in models.Campaign.query.filter(models.Campaign.id.in_(campaign_ids)).with_entities(models.Campaign.name)]
+	models.delete_campaign_data(campaign_ids, chunk_size=current_app.config['DELETE_CHUNK_SIZE'])
+	# children first so that no campaign is left referencing a deleted parent
+	for campaign_id in reversed(campaign_ids):
+		models.Campaign.query.filter_by(id=campaign_id).delete(synchronize_session=False)
+	models.Campaign.commit()
+	for name in names:
+		storage.get().delete(campaign_key(name))
 
 def reset_campaign(campaign_model):
-	for fuzzer in campaign_model.fuzzers:
-		fuzzer.snapshots.delete()
-		fuzzer.crashes.delete()
-	campaign_model.fuzzers.delete()
-	campaign_model.put()
-	try:
-		shutil.rmtree(os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign_model.name), 'sync_dir'))
-	except FileNotFoundError:
-		pass
-	try:
-		shutil.rmtree(os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign_model.name), 'crashes'))
-	except FileNotFoundError:
-		pass
+	models.delete_campaign_data([campaign_model.id], chunk_size=current_app.config['DELETE_CHUNK_SIZE'])
+	campaign_model.running_fuzzers = 0
+	campaign_model.has_master = False
+	campaign_model.commit()
+	invalidate(campaign_model.id)
+	storage.get().delete(campaign_key(campaign_model.name, 'sync_dir'))
+	storage.get().delete(campaign_key(campaign_model.name, 'crashes'))
+
+
+@campaigns.route('/campaigns/jobs/<int:job_id>')
+def job_status(job_id):
+	job = models.Job.get(id=job_id)
+	if not job:
+		return 'Job not found', 404
+	r = job.to_dict()
+	r['progress_str'] = '%d%%' % (100 * (job.progress or 0))
+	r['finished'] = job.done
+	return jsonify(**r)
 
 
 @campaigns.route('/campaigns/<int:campaign_id>/crashes')
@@ -272,7 +330,7 @@ def analysis_queue_campaign(campaign_id):
 			'name': os.path.split(crash.path)[1],
 			'href': url_for('fuzzers.download_crash', crash_id=crash.id),
 			'date': ' ' * (70 - len(os.path.split(crash.path)[1])) + datetime.fromtimestamp(crash.created).strftime('%x %X'),
-			'size': str(os.stat(crash.path).st_size).rjust(20)
+			'size': str(storage.get().size(crash.path)).rjust(20)
 		} for crash in models.Crash.all(campaign_id=campaign_id)
 	])
 
@@ -280,6 +338,7 @@ def count_crashes(crashes, **kwargs):
 	return sum(1 if all(hasattr(crash, k) and getattr(crash, k) == v for k, v in kwargs.items()) else 0 for crash in crashes)
 
 @campaigns.route('/campaigns/stats/<int:campaign_id>')
+@campaign_cached
 def stats(campaign_id):
 	campaign_model = models.Campaign.get(id=campaign_id)
 	current_time = int(time.time())
@@ -329,7 +388,47 @@ def stats(campaign_id):
 	)
 
 
+@campaigns.route('/campaigns/stream/<int:campaign_id>')
+def stream(campaign_id):
+	"""
+	Server-Sent Events stream for a campaign's dashboard: 'stats' events carry the stats that changed since the last
+	event and 'snapshots' events carry the snapshots submitted by a fuzzer as they arrive.
+
+	A stream occupies a server thread for as long as it is open, so allow a thread for each open dashboard on top of
+	those serving fuzzers (see gunicorn.conf.py). Streams end after STREAM_MAX_AGE and the browser reconnects, which
+	spreads dashboards over the worker processes again and frees the threads of clients that went away silently
+	"""
+	if not models.Campaign.get(id=campaign_id):
+		return 'Campaign not found', 404
+	keepalive = current_app.config['STREAM_KEEPALIVE']
+	closes = time.time() + current_app.config['STREAM_MAX_AGE']
+
+	def generate():
+		sent = {}
+		yield 'retry: %d\n\n' % (current_app.config['STREAM_RETRY'] * 1000)
+		with events.subscribe(campaign_id) as queue:
+			while True:
+				current = json.loads(stats(campaign_id).get_data().decode('utf-8'))
+				changed = {k: v for k, v in current.items() if sent.get(k) != v}
+				if changed:
+					yield events.format_event('stats', changed)
+					sent = current
+				# don't hold a database connection while waiting
+				models.db.session.remove()
+				if time.time() >= closes:
+					return
+				try:
+					event, data = queue.get(timeout=min(keepalive, closes - time.time()))
+				except Empty:
+					yield ': keepalive\n\n'
+					continue
+				yield events.format_event(event, data)
+
+	return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
 @campaigns.route('/campaigns/data/<int:campaign_id>')
+@campaign_cached
 def data(campaign_id):
 	campaign_data = models.Campaign.get(id=campaign_id).to_dict()
 	instances = []
@@ -1,25 +1,17 @@
-import glob
-import io
-import os
-import tarfile
+import json
 import random
 
-import time
 from flask import Blueprint, jsonify, request, current_app, send_file, url_for
 from werkzeug.utils import secure_filename
 #from itsdangerous import Signer, BadSignature
 
-from mothership import models
+from mothership import models, scheduler, reaper, events, timeline, metrics, storage, ingest
+from mothership.models import db
+from mothership.caching import invalidate
+from mothership.storage import campaign_key
 
 fuzzers = Blueprint('fuzzers', __name__)
 
-def get_best_campaign():
-	for campaign in models.Campaign.all(active=True).order_by(models.Campaign.id):
-		if campaign.active_fuzzers < campaign.desired_fuzzers:
-			return campaign
-	return None
-
-
 # TODO: make instances each own a secret key used to sign submitted data
 # use a wrapper on the endpoints we want the data verified for
 # def get_signature(value):
@@ -35,23 +27,38 @@ def register():
 	master = request.args.get('master')
 
 	if not master:
-		campaign = get_best_campaign()
-		if not campaign:
+		instance = scheduler.reserve(hostname)
+		if not instance:
 			return 'No active campaigns', 404
-		instance = models.FuzzerInstance.create(hostname=hostname)
-		instance.start_time = time.time()
-		campaign.fuzzers.append(instance)
-		campaign.commit()
 	else:
 		campaign = models.Campaign.get(id=master)
 		if not campaign:
 			return 'Could not find specified campaign', 404
-		if campaign.fuzzers.filter_by(master=True).first():
+		instance = scheduler.reserve_master(campaign, hostname)
+		if not instance:
 			return 'Campaign already has a master', 400
-		instance = models.FuzzerInstance.create(hostname=hostname, master=True)
-		instance.start_time = time.time()
-		campaign.fuzzers.append(instance)
-		campaign.commit()
+	return registration(instance)
+
+
+@fuzzers.route('/fuzzers/reattach/<int:instance_id>')
+def reattach(instance_id):
+	"""
+	Resume an existing (non master) instance after its slave restarts, so it keeps its queue and history
+	"""
+	instance = models.FuzzerInstance.get(id=instance_id)
+	if not instance or instance.master:
+		return 'Could not find specified instance', 404
+	if not instance.campaign.active or not reaper.beat(instance):
+		return 'Instance can not be resumed', 410
+	return registration(instance)
+
+
+def registration(instance):
+	campaign = instance.campaign
+	cpu = request.args.get('cpu', type=int)
+	if cpu is not None:
+		instance.cpu = cpu
+		instance.commit()
 
 	# avoid all hosts uploading at the same time from reporting at the same time
 	deviation = random.randint(15, 30)
@@ -69,18 +76,64 @@ def register():
 		submit=request.host_url[:-1] + url_for('fuzzers.submit', instance_id=instance.id),
 		submit_crash=request.host_url[:-1] + url_for('fuzzers.submit_crash', instance_id=instance.id),
 		upload=request.host_url[:-1] + url_for('fuzzers.upload', instance_id=instance.id),
-		upload_in=current_app.config['UPLOAD_FREQUENCY'] + deviation
+		upload_in=current_app.config['UPLOAD_FREQUENCY'] + deviation,
+		heartbeat=request.host_url[:-1] + url_for('fuzzers.heartbeat', instance_id=instance.id),
+		heartbeat_in=current_app.config['HEARTBEAT_FREQUENCY'],
 	)
 
 
 @fuzzers.route('/fuzzers/terminate/<int:instance_id>', methods=['POST'])
 def terminate(instance_id):
 	instance = models.FuzzerInstance.get(id=instance_id)
-	instance.update(terminated=True)
+	was_running = instance.running
+	instance.update(terminated=True, state=models.FuzzerInstance.TERMINATED)
+	reason = (request.get_json(silent=True) or {}).get('reason')
+	if reason:
+		instance.exit_reason = reason[:256]
 	instance.commit()
+	if was_running:
+		scheduler.release(instance)
 	return jsonify()
 
 
+def should_terminate(instance, alive):
+	# masters are paused rather than terminated while their campaign is inactive, see slave/master.py
+	return not alive or (not instance.master and not instance.campaign.active)
+
+
+def logged_terminate(instance_id):
+	"""
+	Whether a fuzzer should terminate, for answering a submission that was logged rather than written. Read from the
+	database rather than kept by the process that wrote the fuzzer's last submission, as that may be another worker
+	"""
+	instance, campaign = models.FuzzerInstance, models.Campaign
+	row = db.session.query(
+		instance.state, instance.master, campaign.active, campaign.running_fuzzers, campaign.desired_fuzzers
+	).join(campaign, campaign.id == instance.campaign_id).filter(instance.id == instance_id).first()
+	if not row:
+		return False
+	state, master, active, running_fuzzers, desired_fuzzers = row
+	if state == instance.TERMINATED:
+		return True
+	if master:
+		return False
+	if state == instance.DEAD:
+		# revived by the writer only if the campaign has a free slot, as in reaper.beat
+		return not active or (running_fuzzers or 0) >= desired_fuzzers
+	return not active
+
+
+@fuzzers.route('/fuzzers/heartbeat/<int:instance_id>', methods=['POST'])
+def heartbeat(instance_id):
+	instance = models.FuzzerInstance.get(id=instance_id)
+	if not instance:
+		return 'Instance not found', 404
+	alive = reaper.beat(instance)
+	return jsonify(
+		terminate=should_terminate(instance, alive)
+	)
+
+
 @fuzzers.route('/fuzzers/is_active/<int:campaign_id>', methods=['GET'])
 def is_active(campaign_id):
 	campaign = models.Campaign.get(id=campaign_id)
@@ -91,37 +144,89 @@ def is_active(campaign_id):
 
 @fuzzers.route('/fuzzers/submit/<int:instance_id>', methods=['POST'])
 def submit(instance_id):
+	data = request.get_json(silent=True)
+	if not isinstance(data, dict) or not isinstance(data.get('status'), dict) or not isinstance(data.get('snapshots'), list):
+		return 'Expected status and snapshots', 400
+	if ingest.enabled() and ingest.backlogged():
+		return ingest.retry_later()
+	terminate, status = ingest.accept(
+		'submit',
+		instance_id=instance_id,
+		status=data['status'],
+		snapshots=data['snapshots'],
+		supervisor=data.get('supervisor') or {},
+		telemetry=data.get('telemetry') or {}
+	)
+	if status == 202:
+		terminate = logged_terminate(instance_id)
+	return jsonify(
+		terminate=terminate
+	), status
+
+
+@ingest.handler('submit')
+def apply_submit(instance_id, status, snapshots, supervisor, telemetry):
 	instance = models.FuzzerInstance.get(id=instance_id)
-	instance.update(**request.json['status'])
-	for snapshot_data in request.json['snapshots']:
+	instance.update(**status)
+	if supervisor:
+		instance.restarts = supervisor.get('restarts') or 0
+		instance.exit_reason = (supervisor.get('exit_reason') or '')[:256] or None
+	if snapshots and telemetry:
+		snapshots[-1] = dict(snapshots[-1], **{k: v for k, v in telemetry.items() if k in models.FuzzerSnapshot.TELEMETRY})
+	times = []
+	for snapshot_data in snapshots:
 		snapshot = models.FuzzerSnapshot()
 		snapshot.update(**snapshot_data)
 		instance.snapshots.append(snapshot)
-	instance.commit()
-	return jsonify(
-		terminate=not instance.campaign.active
-	)
+		times.append(int(snapshot.unix_time))
+	timeline.record(instance, times, commit=False)
+	alive = reaper.beat(instance, commit=False)
+	terminate = should_terminate(instance, alive)
+	ingest.after_commit(metrics.count, metrics.snapshots_ingested, len(snapshots))
+	ingest.after_commit(invalidate, instance.campaign_id)
+	if snapshots:
+		ingest.after_commit(events.publish, instance.campaign_id, 'snapshots', {
+			'name': 'Master Instance' if instance.master else instance.name,
+			'snapshots': snapshots
+		})
+	return terminate
 
 
 @fuzzers.route('/fuzzers/submit_crash/<int:instance_id>', methods=['POST'])
 def submit_crash(instance_id):
+	if ingest.enabled() and ingest.backlogged():
+		return ingest.retry_later()
+	# slaves batch their crashes into one request, with each file's time in the times field keyed by its field name
+	times = json.loads(request.form.get('times') or '{}')
+	crashes = [{
+		'name': file.filename,
+		'created': times.get(field, request.args.get('time')),
+		'file': ingest.spool(file)
+	} for field, file in request.files.items(multi=True)]
+	_, status = ingest.accept('crash', instance_id=instance_id, crashes=crashes)
+	return '', status
+
+
+@ingest.handler('crash')
+def apply_crash(instance_id, crashes):
 	instance = models.FuzzerInstance.get(id=instance_id)
 	campaign = instance.campaign
-	for filename, file in request.files.items():
-		crash = models.Crash.create(
+	for crash_data in crashes:
+		crash = models.Crash(
 			instance_id=instance.id,
 			campaign_id=instance.campaign_id,
-			created=request.args.get('time'),
-			name=file.filename,
+			created=crash_data['created'],
+			name=crash_data['name'],
 			analyzed=False
 		)
-		crash_dir = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign.name), 'crashes')
-		os.makedirs(crash_dir, exist_ok=True)
-		upload_path = os.path.join(crash_dir, '%d_%s' % (crash.id, secure_filename(file.filename.replace(',', '_'))))
-		file.save(upload_path)
-		crash.path = os.path.abspath(upload_path)
-		crash.commit()
-	return ''
+		db.session.add(crash)
+		db.session.flush()
+		crash.path = campaign_key(campaign.name, 'crashes', '%d_%s' % (crash.id, secure_filename(crash_data['name'].replace(',', '_'))))
+		storage.get().save(crash.path, ingest.read(crash_data['file']))
+		# otherwise left behind without a crash, and saved again under another id when the submission is retried
+		ingest.after_rollback(storage.get().delete, crash.path)
+	ingest.after_commit(metrics.count, metrics.crashes_ingested, len(crashes))
+	ingest.after_commit(invalidate, instance.campaign_id)
 
 
 @fuzzers.route('/fuzzers/submit_analysis/<int:crash_id>', methods=['POST'])
@@ -141,26 +246,36 @@ def submit_analysis(crash_id):
 		crash.frames = request.json['frames']
 
 	crash.commit()
+	invalidate(crash.campaign_id)
 	return ''
 
 
 @fuzzers.route('/fuzzers/upload/<int:instance_id>', methods=['POST'])
 def upload(instance_id):
+	# upload less often while submissions are waiting to be written
+	upload_in = int(current_app.config['UPLOAD_FREQUENCY'] * (1 + ingest.load()))
+	if ingest.enabled() and ingest.backlogged():
+		return ingest.retry_later(upload_in=upload_in)
+	if 'file' not in request.files:
+		return 'Expected file', 400
+	_, status = ingest.accept('upload', instance_id=instance_id, file=ingest.spool(request.files['file']))
+	metrics.count(metrics.upload_bytes, request.content_length or 0)
+	return jsonify(
+		upload_in=upload_in,
+	), status
+
+
+@ingest.handler('upload')
+def apply_upload(instance_id, file):
 	instance = models.FuzzerInstance.get(id=instance_id)
 	campaign = instance.campaign
-	data_dir = current_app.config['DATA_DIRECTORY']
-	sync_dir = os.path.join(data_dir, secure_filename(campaign.name), 'sync_dir')
-	os.makedirs(sync_dir, exist_ok=True)
-	request.files['file'].save(os.path.join(sync_dir, secure_filename(instance.name) + '.tar'))
-	return jsonify(
-		upload_in=current_app.config['UPLOAD_FREQUENCY'],
-	)
+	storage.get().save(campaign_key(campaign.name, 'sync_dir', secure_filename(instance.name) + '.tar'), ingest.read(file))
 
 
 @fuzzers.route('/fuzzers/download/<int:campaign_id>', methods=['GET'])
 def download(campaign_id):
 	campaign = models.Campaign.get(id=campaign_id)
-	sync_dir = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign.name), 'sync_dir', '*.tar')
+	sync_tars = [name for name in storage.get().list(campaign_key(campaign.name, 'sync_dir')) if name.endswith('.tar')]
 	return jsonify(
 		executable=request.host_url[:-1] + url_for('fuzzers.download_executable', campaign_id=campaign.id),
 		libraries=request.host_url[:-1] + url_for('fuzzers.download_libraries', campaign_id=campaign.id),
@@ -168,7 +283,7 @@ def download(campaign_id):
 		ld_preload=request.host_url[:-1] + url_for('fuzzers.download_ld_preload', campaign_id=campaign.id),
 		dictionary=request.host_url[:-1] + url_for('fuzzers.download_dictionary', campaign_id=campaign.id) if campaign.has_dictionary else None,
 		sync_dirs=[
-			request.host_url[:-1] + url_for('fuzzers.download_syncdir', campaign_id=campaign.id, filename=os.path.basename(filename)) for filename in glob.glob(sync_dir)
+			request.host_url[:-1] + url_for('fuzzers.download_syncdir', campaign_id=campaign.id, filename=filename) for filename in sync_tars
 		],
 		sync_in=current_app.config['DOWNLOAD_FREQUENCY'],
 	)
@@ -176,54 +291,41 @@ def download(campaign_id):
 @fuzzers.route('/fuzzers/download/<int:campaign_id>/testcases.tar', methods=['GET'])
 def download_testcases(campaign_id):
 	campaign = models.Campaign.get(id=campaign_id)
-	testcases_local_dir = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign.name), 'testcases')
-	return serve_directory_tar(testcases_local_dir, 'testcases')
+	return serve_directory_tar(campaign_key(campaign.name, 'testcases'), 'testcases')
 
 
 @fuzzers.route('/fuzzers/download/<int:campaign_id>/ld_preload.tar', methods=['GET'])
 def download_ld_preload(campaign_id):
 	campaign = models.Campaign.get(id=campaign_id)
-	testcases_local_dir = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign.name), 'ld_preload')
-	return serve_directory_tar(testcases_local_dir, 'ld_preload')
+	return serve_directory_tar(campaign_key(campaign.name, 'ld_preload'), 'ld_preload')
 
 @fuzzers.route('/fuzzers/download/<int:campaign_id>/<filename>', methods=['GET'])
 def download_syncdir(campaign_id, filename):
 	campaign = models.Campaign.get(id=campaign_id)
-	syncdir = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign.name), 'sync_dir')
-	tar = os.path.join(syncdir, secure_filename(filename.rsplit('.', 1)[0]) + '.tar')
-	return send_file(os.path.abspath(tar))
+	return storage.get().serve(campaign_key(campaign.name, 'sync_dir', secure_filename(filename.rsplit('.', 1)[0]) + '.tar'))
 
 @fuzzers.route('/fuzzers/download/<int:campaign_id>/libraries.tar', methods=['GET'])
 def download_libraries(campaign_id):
 	campaign = models.Campaign.get(id=campaign_id)
-	libraries_local_dir = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign.name), 'libraries')
-	return serve_directory_tar(libraries_local_dir, 'libraries')
+	return serve_directory_tar(campaign_key(campaign.name, 'libraries'), 'libraries')
 
 @fuzzers.route('/fuzzers/download/<int:campaign_id>/executable', methods=['GET'])
 def download_executable(campaign_id):
 	campaign = models.Campaign.get(id=campaign_id)
-	executable = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign.name), 'executable')
-	return send_file(os.path.abspath(executable))
+	return storage.get().serve(campaign_key(campaign.name, 'executable'))
 
 @fuzzers.route('/fuzzers/download/<int:campaign_id>/dictionary.txt', methods=['GET'])
 def download_dictionary(campaign_id):
 	campaign = models.Campaign.get(id=campaign_id)
-	executable = os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(campaign.name), 'dictionary')
-	return send_file(os.path.abspath(executable))
+	return storage.get().serve(campaign_key(campaign.name, 'dictionary'))
 
 @fuzzers.route('/fuzzers/download/afl-fuzz', methods=['GET'])
 def download_afl():
-	afl = os.path.join(current_app.config['DATA_DIRECTORY'], 'afl-fuzz')
-	return send_file(os.path.abspath(afl))
+	return storage.get().serve('afl-fuzz')
 
 
-def serve_directory_tar(local_dir, arcname):
-	tardata = io.BytesIO()
-	os.makedirs(local_dir, exist_ok=True)
-	with tarfile.open(fileobj=tardata, mode='w:') as tar:
-		tar.add(local_dir, arcname=arcname)
-	tardata.seek(0)
-	return send_file(tardata)
+def serve_directory_tar(key, arcname):
+	return send_file(storage.get().tar(key, arcname))
 
 
 @fuzzers.route('/fuzzers/analysis_queue/<int:campaign_id>')
@@ -243,6 +345,6 @@ def download_crash(crash_id):
 	crash = models.Crash.get(id=crash_id)
 	if not crash:
 		return 'Crash not found', 404
-	return send_file(crash.path)
+	return storage.get().serve(crash.path)
 
 
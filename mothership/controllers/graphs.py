@@ -1,94 +1,52 @@
 import datetime
 from collections import defaultdict
-from itertools import tee
+from itertools import chain, tee
 from math import ceil
-from operator import itemgetter
 from statistics import mean
 
+import numpy as np
+
 from flask import Blueprint, jsonify, request, render_template
-from sqlalchemy import desc
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 
-from mothership import models
-from sqlalchemy import func
+from mothership import models, timeline
+from mothership.models import db
+from mothership.caching import campaign_cached
+from sqlalchemy import func, select
 
 
 
 graphs = Blueprint('graphs', __name__)
 
-def get_starts(fuzzers):
+def first_seen(campaign_id, consider_unique, **crash_filter):
 	"""
-	Compute the list of start times for a list of fuzzers so that the series of
-
-	fuzzers[n].snapshots[0...m].unix_time - get_starts(fuzzers)[n]
-
-	does not include gaps when no fuzzers where running
-
-	:param fuzzers: the list of fuzzers to compute the start times for
-	:return: the list of start values
+	:return: the time each distinct value of consider_unique was first seen amongst a campaign's crashes, in order
 	"""
-	run_times = [(f.start_time, f.last_update) for f in fuzzers]
-	start, stop = run_times[0]
-	starts = []
-	for run_time, fuzzer in zip(run_times, fuzzers):
-		n_start, n_stop = run_time
-		if n_start > stop:
-			start += n_start - stop
-		stop = n_stop
-		starts.append(start)
-	return starts
-
-def get_activity_periods(instances):
-	r = []
-	start = 0
-	running = 0
-	duration = 0
-	startstop_events = sorted(
-		[(i, i.snapshots.order_by(models.FuzzerSnapshot.unix_time).first().unix_time, True) for i in instances] +
-		[(i, i.snapshots.order_by(desc(models.FuzzerSnapshot.unix_time)).first().unix_time, False) for i in instances],
-		key=itemgetter(1))
-	for instance, t, event in startstop_events:
-		if event:
-			if not running:
-				instances = []
-				start = t
-			instances.append(instance)
-			running += 1
-		else:
-			running -= 1
-			if not running:
-				r.append((start, t, instances))
-				duration += t - start
-	return r, duration
-
-def unique_crashes(campaign_id, consider_unique, **crash_filter):
-	r = []
-	s = set()
-	for crash in models.Crash.all(campaign_id=campaign_id, crash_in_debugger=True, **crash_filter).order_by(models.Crash.created):
-		if getattr(crash, consider_unique) in s:
-			continue
-		s.add(getattr(crash, consider_unique))
-		r.append(crash)
-	return r
+	first = func.min(models.Crash.created)
+	return [created for created, in db.session.query(first).filter(
+		models.Crash.campaign_id == campaign_id,
+		models.Crash.crash_in_debugger == True,
+		models.Crash.created.isnot(None)
+	).filter_by(**crash_filter).group_by(getattr(models.Crash, consider_unique)).order_by(first)]
 
 def get_distinct(campaign, consider_unique, **crash_filter):
 	r = []
-	fuzzers = [f for f in campaign.fuzzers.order_by(models.FuzzerInstance.start_time) if f.started]
-	starts = dict(zip((f.id for f in fuzzers), get_starts(fuzzers)))
+	periods = timeline.activity_periods(campaign)
+	if not periods:
+		return r
 	last_created, last_crashes, this_crashes = 0, 0, 0
-	for crash in unique_crashes(campaign.id, consider_unique, **crash_filter):
-		created = (crash.created - starts[crash.instance_id]) * 1000
+	for created in timeline.place(periods, first_seen(campaign.id, consider_unique, **crash_filter)):
+		created *= 1000
 		if last_created == created:
 			this_crashes += 1
 		else:
 			r.append([last_created, last_crashes])
 			r.append([last_created + 1, this_crashes])
 			last_created, last_crashes, this_crashes = created, this_crashes, this_crashes + 1
-	r.append([(fuzzers[-1].last_update - starts[fuzzers[-1].id]) * 1000, last_crashes])
+	r.append([(periods[-1].stop - periods[-1].offset) * 1000, last_crashes])
 	return r
 
-
-def graph(title, series, chart_type='line', legend=True):
+def graph(title, series, chart_type='line', legend=True, **extra):
 	return jsonify(
 		chart={
 			'type': chart_type
@@ -96,11 +54,11 @@ def graph(title, series, chart_type='line', legend=True):
 		title={
 			'text': title
 		},
-		series=[{
+		series=[dict({
 			'name': data[0],
 			'data': data[1],
 			'type': data[2] if data[2:] else chart_type,
-		} for data in series],
+		}, **(data[3] if data[3:] else {})) for data in series],
 		xAxis={
 			'type': 'datetime',
 			'title': {
@@ -114,7 +72,8 @@ def graph(title, series, chart_type='line', legend=True):
 		},
 		legend={
 			'enabled': legend
-		}
+		},
+		**extra
 	)
 
 
@@ -189,6 +148,7 @@ def graph(title, series, chart_type='line', legend=True):
 
 
 @graphs.route('/graphs/campaign/<int:campaign_id>/aggregated')
+@campaign_cached
 def aggregated(campaign_id):
 	campaign = models.Campaign.get(id=campaign_id)
 	if not campaign.started or not models.Crash.get(campaign_id=campaign_id, analyzed=True):
@@ -200,6 +160,7 @@ def aggregated(campaign_id):
 
 
 @graphs.route('/graphs/campaign/<int:campaign_id>/<property_name>')
+@campaign_cached
 def snapshot_property(campaign_id, property_name):
 	if not hasattr(models.FuzzerSnapshot, property_name) or not type(getattr(models.FuzzerSnapshot, property_name)) is InstrumentedAttribute:
 		return 'Snapshot does not have property "%s"' % property_name, 400
@@ -208,32 +169,125 @@ def snapshot_property(campaign_id, property_name):
 	if not campaign.started or not campaign.fuzzers or not any(fuzzer.snapshots.first() for fuzzer in campaign.fuzzers):
 		return jsonify()
 
-	fuzzers = campaign.fuzzers.filter(models.FuzzerInstance.execs_done > 0)
 	master = campaign.master_fuzzer
 
+	# with since=<cursor> only the points stored after the cursor are returned, in the same series and with the same x
+	# offsets as the full history, along with the cursor to use for the next request. The cursor is a snapshot id
+	# rather than a time, as slaves submit snapshots stamped by their own clocks and a batch of them can arrive after
+	# newer snapshots from other fuzzers
+	since = request.args.get('since', type=int)
+	columns = (models.FuzzerSnapshot.id, models.FuzzerSnapshot.unix_time, getattr(models.FuzzerSnapshot, property_name))
+	cursor = since or 0
+
+	def snapshots(query):
+		nonlocal cursor
+		# telemetry is only recorded on some snapshots
+		query = query.filter(columns[2].isnot(None))
+		if since is not None:
+			query = query.filter(models.FuzzerSnapshot.id > since)
+		for snapshot in query.with_entities(*columns):
+			cursor = max(cursor, snapshot.id)
+			yield snapshot
+
+	# each series reports the offset such that x = (unix_time - offset) * 1000, so the dashboard can place points pushed
+	# to it by the campaign's event stream
 	data = []
 	master_data = []
-	activity_periods, _ = get_activity_periods(fuzzers.filter_by(master=False))
-	running_time = 0
-	for start, stop, instances in activity_periods:
+	offset = 0
+	for period, instances in timeline.periods(campaign):
+		offset = period.offset
 		for fuzzer in instances:
+			if not fuzzer.execs_done:
+				continue
 			data.append((
 				fuzzer.name, [(
-					((snapshot.unix_time - start) + running_time) * 1000,
+					(snapshot.unix_time - offset) * 1000,
 					getattr(snapshot, property_name)
-				) for snapshot in fuzzer.snapshots.with_entities(models.FuzzerSnapshot.unix_time, getattr(models.FuzzerSnapshot, property_name))]
+				) for snapshot in snapshots(fuzzer.snapshots)],
+				'line',
+				{'offset': offset}
 			))
 		if master:
-			master_snapshots = master.snapshots.filter(start < models.FuzzerSnapshot.unix_time, models.FuzzerSnapshot.unix_time < stop)
-			for snapshot in master_snapshots.with_entities(models.FuzzerSnapshot.unix_time, getattr(models.FuzzerSnapshot, property_name)):
-				master_data.append((((snapshot.unix_time - start) + running_time) * 1000, getattr(snapshot, property_name)))
-		running_time += stop - start
+			master_snapshots = master.snapshots.filter(period.start < models.FuzzerSnapshot.unix_time, models.FuzzerSnapshot.unix_time < period.stop)
+			for snapshot in snapshots(master_snapshots):
+				master_data.append(((snapshot.unix_time - offset) * 1000, getattr(snapshot, property_name)))
 	if master:
 		data.append((
 			'Master Instance',
-			master_data
+			master_data,
+			'line',
+			{'offset': offset}
 		))
-	return graph(property_name.replace('_', ' ').title(), data, legend=False)
+	return graph(property_name.replace('_', ' ').title(), data, legend=False, cursor=cursor)
+
+
+def resample(instance_ids, xs, values, points):
+	"""
+	Resample the snapshots of many instances onto a common grid of x values. Each instance contributes its latest
+	value at every grid point between its first and last snapshot, and nothing outside of that
+
+	:param instance_ids, xs, values: arrays of snapshots sorted by instance and then x
+	:return: the grid and a (instances, points) array of values, NaN where an instance wasn't running
+	"""
+	grid = np.linspace(xs.min(), xs.max(), points)
+	boundaries = np.flatnonzero(np.diff(instance_ids)) + 1
+	starts = np.concatenate(([0], boundaries))
+	stops = np.concatenate((boundaries, [len(xs)]))
+	resampled = np.full((len(starts), points), np.nan)
+	for row, (start, stop) in enumerate(zip(starts, stops)):
+		instance_xs = xs[start:stop]
+		alive = (grid >= instance_xs[0]) & (grid <= instance_xs[-1])
+		latest = np.searchsorted(instance_xs, grid[alive], side='right') - 1
+		resampled[row, alive] = values[start:stop][latest]
+	return grid, resampled
+
+
+@graphs.route('/graphs/campaign/<int:campaign_id>/<property_name>/aggregate')
+@campaign_cached
+def aggregate_property(campaign_id, property_name):
+	"""
+	The total, mean and 10th/90th percentiles of a snapshot property across all of a campaign's fuzzers
+	"""
+	if not hasattr(models.FuzzerSnapshot, property_name) or not type(getattr(models.FuzzerSnapshot, property_name)) is InstrumentedAttribute:
+		return 'Snapshot does not have property "%s"' % property_name, 400
+	points = min(max(request.args.get('points', 500, type=int), 2), 5000)
+
+	campaign = models.Campaign.get(id=campaign_id)
+	periods = timeline.activity_periods(campaign)
+	if not periods:
+		return jsonify()
+
+	snapshot = models.FuzzerSnapshot
+	instance_ids = db.session.query(models.FuzzerInstance.id).filter_by(campaign_id=campaign_id)
+	rows = db.session.execute(
+		select([snapshot.instance_id, snapshot.unix_time, getattr(snapshot, property_name)])
+		.where(snapshot.instance_id.in_(instance_ids))
+		.where(getattr(snapshot, property_name).isnot(None))
+		.order_by(snapshot.instance_id, snapshot.unix_time)
+		.execution_options(stream_results=True)
+	)
+	# read the rows straight into an array rather than holding every row as a tuple first
+	snapshots = np.fromiter(chain.from_iterable(rows), dtype=float).reshape(-1, 3)
+	if not len(snapshots):
+		return jsonify()
+
+	# place every snapshot on the timeline by the activity period it falls in
+	period_starts = np.array([period.start for period in periods])
+	period_offsets = np.array([period.offset for period in periods])
+	offsets = period_offsets[np.maximum(np.searchsorted(period_starts, snapshots[:, 1], side='right') - 1, 0)]
+	grid, resampled = resample(snapshots[:, 0], snapshots[:, 1] - offsets, snapshots[:, 2], points)
+
+	running = ~np.isnan(resampled).all(axis=0)
+	grid, resampled = grid[running] * 1000, resampled[:, running]
+	series = [
+		('Total', np.nansum(resampled, axis=0)),
+		('Mean', np.nanmean(resampled, axis=0)),
+		('10th Percentile', np.nanpercentile(resampled, 10, axis=0)),
+		('90th Percentile', np.nanpercentile(resampled, 90, axis=0)),
+	]
+	return graph(property_name.replace('_', ' ').title(), [
+		(name, np.column_stack((grid, values)).tolist()) for name, values in series
+	])
 
 
 @graphs.route('/graph')
@@ -1,9 +1,17 @@
-from flask import Blueprint, render_template
+from flask import Blueprint, render_template, current_app
 
+from mothership import metrics
 from mothership.extensions import cache
 
 main = Blueprint('main', __name__)
 
+
+@main.route('/metrics')
+def prometheus_metrics():
+	if not current_app.config['METRICS_ENABLED']:
+		return 'Metrics are disabled', 404
+	return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
 # @main.route('/')
 # @cache.cached(timeout=1000)
 # def home():
@@ -0,0 +1,101 @@
+"""
+Coordinate the mothership processes (gunicorn workers, possibly on several hosts) that share a database.
+
+Most work that needs a single writer - claiming fuzzer slots, claiming jobs and reaping dead fuzzers - is already done
+with conditional updates that only one process can win. Work that is not, such as deciding when periodic jobs are
+due, is only done by the process holding a lease on it: a row in the lease table naming its holder and when it
+expires. The holder renews the lease well before then, and any other process may take it over once it has expired.
+
+Every process also holds a lease on its own identity while it is alive, so that the jobs claimed by a process that
+has since died can be found and run again.
+"""
+import os
+import socket
+import time
+import uuid
+
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+
+from mothership import models
+from mothership.models import db
+
+PROCESS_PREFIX = 'process:'
+
+_identity = None
+
+
+def identity():
+	"""
+	:return: a name for this process that is unique across hosts and restarts
+	"""
+	global _identity
+	# recomputed in processes forked after it was first asked for
+	if not _identity or _identity[0] != os.getpid():
+		_identity = (os.getpid(), '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]))
+	return _identity[1]
+
+
+def acquire(name, ttl, now=None):
+	"""
+	Take or renew the lease called name for ttl seconds
+
+	:return: whether this process now holds the lease
+	"""
+	now = now or int(time.time())
+	lease = models.Lease.__table__
+	renewed = db.session.execute(
+		update(lease)
+		.where(lease.c.name == name)
+		.where(or_(lease.c.holder == identity(), lease.c.expires < now))
+		.values(holder=identity(), expires=now + ttl)
+	).rowcount
+	if renewed:
+		db.session.commit()
+		return True
+	if db.session.query(lease.c.id).filter(lease.c.name == name).first():
+		db.session.commit()
+		return False
+	try:
+		db.session.execute(lease.insert().values(name=name, holder=identity(), expires=now + ttl))
+		db.session.commit()
+		return True
+	except IntegrityError:
+		# another process created it first
+		db.session.rollback()
+		return False
+
+
+def release(name):
+	models.Lease.query.filter_by(name=name, holder=identity()).delete(synchronize_session=False)
+	db.session.commit()
+
+
+def heartbeat(ttl, now=None):
+	"""
+	Renew the lease that shows this process is alive
+	"""
+	return acquire(PROCESS_PREFIX + identity(), ttl, now)
+
+
+def alive(now=None):
+	"""
+	:return: a query for the identities of the processes that are alive
+	"""
+	now = now or int(time.time())
+	return db.session.query(models.Lease.holder).filter(
+		models.Lease.name.like(PROCESS_PREFIX + '%'),
+		models.Lease.expires >= now
+	)
+
+
+def forget_dead(now=None):
+	"""
+	Delete the leases of processes that have stopped renewing them
+	"""
+	now = now or int(time.time())
+	models.Lease.query.filter(
+		models.Lease.name.like(PROCESS_PREFIX + '%'),
+		models.Lease.expires < now
+	).delete(synchronize_session=False)
+	db.session.commit()
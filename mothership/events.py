@@ -0,0 +1,43 @@
+"""
+In-process publish/subscribe of campaign events for the dashboard's Server-Sent Events stream.
+
+Events only reach dashboards connected to the same server process as the request that published them. Streams also
+re-check the campaign's stats whenever they are idle, so dashboards connected to other processes still see changes.
+"""
+import json
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from queue import Queue, Full
+
+_subscribers = defaultdict(set)
+_lock = threading.Lock()
+
+
+def publish(campaign_id, event, data):
+	with _lock:
+		subscribers = list(_subscribers.get(campaign_id, ()))
+	for queue in subscribers:
+		try:
+			queue.put_nowait((event, data))
+		except Full:
+			# a slow client misses events rather than holding up ingest
+			pass
+
+
+@contextmanager
+def subscribe(campaign_id, maxsize=1000):
+	queue = Queue(maxsize)
+	with _lock:
+		_subscribers[campaign_id].add(queue)
+	try:
+		yield queue
+	finally:
+		with _lock:
+			_subscribers[campaign_id].discard(queue)
+			if not _subscribers[campaign_id]:
+				del _subscribers[campaign_id]
+
+
+def format_event(event, data):
+	return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
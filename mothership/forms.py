@@ -1,13 +1,11 @@
-import os
-
-from flask import current_app
 from flask_wtf import Form
-from werkzeug.utils import secure_filename
 from wtforms import StringField, SelectField, IntegerField, BooleanField
 from flask_wtf.file import FileField
 from wtforms import validators
 
+from mothership import storage
 from mothership.models import Campaign
+from mothership.storage import campaign_key
 
 class CampaignForm(Form):
 	name = StringField('Name', validators=[validators.required()])
@@ -16,6 +14,7 @@ class CampaignForm(Form):
 	afl_args = StringField('AFL Args', default='-m 100 -t 50+')
 	copy_of = SelectField('Copy of', coerce=int, choices=[(-1, 'None')])
 	desired_fuzzers = IntegerField('Desired Fuzzers')
+	priority = IntegerField('Priority', default=1)
 	executable = FileField()
 	libraries = FileField(
 		render_kw={'multiple': True},
@@ -36,7 +35,7 @@ class CampaignForm(Form):
 			return False
 
 		campaign = Campaign.get(name=self.name.data)
-		if campaign or os.path.exists(os.path.join(current_app.config['DATA_DIRECTORY'], secure_filename(self.name.data))):
+		if campaign or storage.get().exists(campaign_key(self.name.data)):
 			self.name.errors.append('Campaign with that name already exists')
 			return False
 
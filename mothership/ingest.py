@@ -0,0 +1,396 @@
+"""
+Accept what fuzzers submit without waiting for the database.
+
+With INGEST_ASYNC, the submit, submit_crash and upload endpoints only check a submission and append it to this
+process's log before answering 202. The log is an append-only file of JSON records in INGEST_DIRECTORY, split into
+numbered segments; files are spooled next to it. A writer thread applies the records to the database in batches of up
+to INGEST_BATCH_SIZE per transaction, and records how far it has got in the same transaction, so every record is
+applied exactly once even if the process dies part way through a batch. The logs of processes that stopped are found
+by their lock files and replayed by another process on the same host.
+
+Once more than INGEST_MAX_BACKLOG records are waiting to be written (e.g. while the database is unavailable),
+submissions are refused with a 503 and a Retry-After of INGEST_RETRY_AFTER seconds.
+
+Without INGEST_ASYNC (the default) submissions are applied before responding, as in the tests, unless the database is
+sqlite and SQLITE_SINGLE_WRITER is set - then this writer is the only thread writing submissions (see sqlite.py).
+"""
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+import uuid
+
+from flask import current_app, jsonify
+from sqlalchemy.exc import OperationalError
+from werkzeug.utils import secure_filename
+
+from mothership import models, coordination, sqlite
+from mothership.models import db
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+_callbacks = threading.local()
+_log = None
+
+
+def handler(kind):
+	"""
+	Register a function to apply submissions of a kind, called as ``f(**data)``. It must leave committing to its
+	caller, and do anything that should only happen once its changes are committed with after_commit
+	"""
+	def decorator(f):
+		_handlers[kind] = f
+		return f
+	return decorator
+
+
+def after_commit(f, *args):
+	_callbacks.pending.append((f, args))
+
+
+def after_rollback(f, *args):
+	"""
+	Undo something a handler did outside of the database, such as saving a file, if its transaction is rolled back
+	"""
+	_callbacks.undo.append((f, args))
+
+
+def begin():
+	_callbacks.pending, _callbacks.undo = [], []
+
+
+def call(callbacks):
+	for f, args in callbacks:
+		try:
+			f(*args)
+		except Exception:
+			traceback.print_exc()
+
+
+def run_callbacks():
+	callbacks = _callbacks.pending
+	begin()
+	call(callbacks)
+
+
+def rolled_back():
+	callbacks = getattr(_callbacks, 'undo', [])
+	begin()
+	call(callbacks)
+
+
+def configured(config):
+	return config['INGEST_ASYNC'] or (config['SQLITE_SINGLE_WRITER'] and sqlite.is_sqlite(config['SQLALCHEMY_DATABASE_URI']))
+
+
+def enabled():
+	return configured(current_app.config)
+
+
+def apply(kind, data):
+	"""
+	Apply a submission to the database now
+
+	:return: the handler's result
+	"""
+	begin()
+	try:
+		result = _handlers[kind](**data)
+		db.session.commit()
+	except Exception:
+		db.session.rollback()
+		rolled_back()
+		raise
+	run_callbacks()
+	return result
+
+
+def accept(kind, **data):
+	"""
+	Apply a submission, or with INGEST_ASYNC log it for the writer
+
+	:return: the handler's result (None if it was logged) and the status code to answer with
+	"""
+	if not enabled():
+		return apply(kind, data), 200
+	_log.append(kind, data)
+	return None, 202
+
+
+def spool(file):
+	"""
+	Keep an uploaded file until its submission is applied
+
+	:return: a reference to the file to include in the submission, to be opened by the handler with read
+	"""
+	if not enabled():
+		return {'file': file}
+	path = os.path.join(_log.directory, 'spool', uuid.uuid4().hex)
+	file.save(path)
+	return {'spool': path}
+
+
+def read(spooled):
+	"""
+	Open a file from spool. A spooled copy is deleted once the submission it belongs to has been committed
+	"""
+	if 'file' in spooled:
+		return spooled['file']
+	f = open(spooled['spool'], 'rb')
+	after_commit(f.close)
+	after_rollback(f.close)
+	after_commit(os.remove, spooled['spool'])
+	return f
+
+
+def load():
+	"""
+	:return: the fraction of INGEST_MAX_BACKLOG records that are waiting to be written, 0 without INGEST_ASYNC
+	"""
+	if not enabled():
+		return 0
+	return _log.pending / current_app.config['INGEST_MAX_BACKLOG']
+
+
+def backlogged():
+	return load() >= 1
+
+
+def retry_later(**extra):
+	"""
+	:return: the response asking a fuzzer to submit again later
+	"""
+	retry_in = current_app.config['INGEST_RETRY_AFTER']
+	response = jsonify(retry_in=retry_in, **extra)
+	response.status_code = 503
+	response.headers['Retry-After'] = str(retry_in)
+	return response
+
+
+def segment_path(directory, name, segment):
+	return os.path.join(directory, '%s.%d.log' % (name, segment))
+
+
+def segments(directory, name):
+	return sorted(int(path.rsplit('.', 2)[1]) for path in glob.glob(os.path.join(directory, glob.escape(name) + '.*.log')))
+
+
+def read_records(path, offset, limit):
+	"""
+	:return: up to limit (record, offset after it) pairs from a log segment, stopping at a partly written record
+	"""
+	records = []
+	try:
+		f = open(path, 'rb')
+	except FileNotFoundError:
+		return records
+	with f:
+		f.seek(offset)
+		while len(records) < limit:
+			line = f.readline()
+			if not line.endswith(b'\n'):
+				break
+			records.append((json.loads(line.decode('utf-8')), f.tell()))
+	return records
+
+
+class Log:
+	"""
+	The log of submissions accepted by this process
+	"""
+
+	def __init__(self, directory, segment_size, fsync):
+		self.directory = directory
+		self.name = secure_filename(coordination.identity())
+		self.segment_size = segment_size
+		self.fsync = fsync
+		self.segment = -1
+		self.file = None
+		self.pending = 0
+		self.synced = (-1, 0)
+		self.lock = threading.Lock()
+		self.sync_lock = threading.Lock()
+		os.makedirs(os.path.join(directory, 'spool'), exist_ok=True)
+		# held until the process exits, so other processes can tell that the log is still in use
+		self.lock_file = open(os.path.join(directory, self.name + '.lock'), 'w')
+		fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+	def append(self, kind, data):
+		line = (json.dumps({'kind': kind, 'data': data}) + '\n').encode('utf-8')
+		with self.lock:
+			if not self.file or self.file.tell() + len(line) > self.segment_size:
+				self.rotate()
+			self.file.write(line)
+			self.file.flush()
+			self.pending += 1
+			position = (self.segment, self.file.tell())
+		if self.fsync:
+			self.sync(position)
+
+	def sync(self, position):
+		"""
+		Wait until the log has been fsynced up to position. Threads appending at the same time share one fsync rather
+		than each waiting for their own
+		"""
+		with self.sync_lock:
+			if self.synced >= position:
+				return
+			with self.lock:
+				synced = (self.segment, self.file.tell())
+				fd = os.dup(self.file.fileno())
+			try:
+				os.fsync(fd)
+			finally:
+				os.close(fd)
+			self.synced = synced
+
+	def rotate(self):
+		if self.file:
+			if self.fsync:
+				os.fsync(self.file.fileno())
+			self.file.close()
+		self.segment += 1
+		self.file = open(segment_path(self.directory, self.name, self.segment), 'ab')
+
+	def written(self, count):
+		with self.lock:
+			self.pending -= count
+
+
+class Writer(threading.Thread):
+	"""
+	Applies the records of this process's log, and of the logs of stopped processes, to the database
+	"""
+
+	def __init__(self, app, log):
+		super().__init__(name='ingest-writer')
+		self.daemon = True
+		self.app = app
+		self.log = log
+		self.batch_size = app.config['INGEST_BATCH_SIZE']
+		self.batch_interval = app.config['INGEST_BATCH_INTERVAL']
+
+	def run(self):
+		while True:
+			progress = False
+			with self.app.app_context():
+				try:
+					progress = self.drain(self.log.name, self.log)
+					if not progress:
+						self.adopt_orphans()
+				except OperationalError:
+					logger.warning('Database unavailable, %d submissions waiting', self.log.pending)
+					db.session.rollback()
+					rolled_back()
+				except Exception:
+					traceback.print_exc()
+					db.session.rollback()
+					rolled_back()
+				finally:
+					db.session.remove()
+			if not progress:
+				time.sleep(self.batch_interval)
+
+	def checkpoint(self, name):
+		checkpoint = models.IngestCheckpoint.get(log=name)
+		if not checkpoint:
+			existing = segments(self.log.directory, name)
+			checkpoint = models.IngestCheckpoint.create(log=name, segment=existing[0] if existing else 0, offset=0)
+		return checkpoint
+
+	def drain(self, name, log=None):
+		"""
+		Apply the next batch of records from a log
+
+		:return: whether any progress was made
+		"""
+		directory = self.log.directory
+		checkpoint = self.checkpoint(name)
+		path = segment_path(directory, name, checkpoint.segment)
+		records = read_records(path, checkpoint.offset, self.batch_size)
+		if not records:
+			later = [segment for segment in segments(directory, name) if segment > checkpoint.segment]
+			if not later:
+				return False
+			# records can be appended to the segment after reading it and before the log rotates, but none once the
+			# next segment exists, so it's only finished if it's still empty when read again
+			records = read_records(path, checkpoint.offset, self.batch_size)
+		if not records:
+			checkpoint.segment, checkpoint.offset = later[0], 0
+			db.session.commit()
+			os.remove(path)
+			return True
+
+		begin()
+		try:
+			for record, offset in records:
+				_handlers[record['kind']](**record['data'])
+			checkpoint.offset = records[-1][1]
+			db.session.commit()
+		except OperationalError:
+			raise
+		except Exception:
+			db.session.rollback()
+			rolled_back()
+			self.isolate(checkpoint, records)
+		else:
+			run_callbacks()
+		if log:
+			log.written(len(records))
+		return True
+
+	def isolate(self, checkpoint, records):
+		"""
+		Apply a batch that failed one record at a time, skipping the records that can't be applied
+		"""
+		for record, offset in records:
+			begin()
+			try:
+				_handlers[record['kind']](**record['data'])
+			except OperationalError:
+				raise
+			except Exception:
+				db.session.rollback()
+				rolled_back()
+				logger.exception('Skipping %s submission that could not be applied: %r', record['kind'], record['data'])
+			checkpoint.offset = offset
+			db.session.commit()
+			run_callbacks()
+
+	def adopt_orphans(self):
+		"""
+		Replay the logs of processes on this host that stopped before writing them
+		"""
+		for lock_path in glob.glob(os.path.join(self.log.directory, '*.lock')):
+			name = os.path.basename(lock_path)[:-len('.lock')]
+			if name == self.log.name:
+				continue
+			lock_file = open(lock_path, 'a')
+			try:
+				fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except OSError:
+				# still in use
+				lock_file.close()
+				continue
+			with lock_file:
+				logger.info('Replaying the ingest log of %s', name)
+				while self.drain(name):
+					pass
+				for segment in segments(self.log.directory, name):
+					os.remove(segment_path(self.log.directory, name, segment))
+				models.IngestCheckpoint.query.filter_by(log=name).delete(synchronize_session=False)
+				db.session.commit()
+				os.remove(lock_path)
+
+
+def start_writer(app):
+	global _log
+	if _log or not configured(app.config):
+		return
+	_log = Log(app.config['INGEST_DIRECTORY'], app.config['INGEST_SEGMENT_SIZE'], app.config['INGEST_FSYNC'])
+	Writer(app, _log).start()
@@ -0,0 +1,209 @@
+import logging
+import threading
+import time
+import traceback
+
+from flask import current_app
+from sqlalchemy import desc, or_, update
+
+from mothership import models, coordination
+from mothership.models import db
+
+logger = logging.getLogger(__name__)
+
+_tasks = {}
+_periodic = {}
+_runner = None
+
+
+def task(name, every=None):
+	"""
+	Register a function as a job that can be enqueued by name.
+
+	The function is called as ``f(job, **args)`` inside an application context and can report its progress with
+	``job.set_progress``. Any value it returns is stored as the job result.
+
+	:param every: the name of a config value holding an interval in seconds. If given (and the config value is set) the
+		job is also enqueued automatically at that interval
+	"""
+	def decorator(f):
+		_tasks[name] = f
+		if every:
+			_periodic[name] = every
+		return f
+	return decorator
+
+
+def enqueue(kind, campaign_id=None, description=None, **args):
+	"""
+	Persist a new job and wake a worker to run it.
+
+	If the application is configured with ``JOB_WORKERS = 0`` the job is run immediately in the calling thread
+	"""
+	if kind not in _tasks:
+		raise KeyError('No job registered with name %r' % kind)
+	job = models.Job.create(
+		kind=kind,
+		campaign_id=campaign_id,
+		description=description or kind.replace('_', ' '),
+		args=args,
+		status=models.Job.PENDING,
+		created=int(time.time())
+	)
+	if not current_app.config.get('JOB_WORKERS'):
+		if claim(job.id):
+			run(job)
+	elif _runner:
+		_runner.wake()
+	return job
+
+
+def claim(job_id):
+	"""
+	Atomically move a job from pending to running. Returns False if another worker got there first
+	"""
+	result = db.session.execute(
+		update(models.Job.__table__)
+		.where(models.Job.id == job_id)
+		.where(models.Job.status == models.Job.PENDING)
+		.values(status=models.Job.RUNNING, started=int(time.time()), runner=coordination.identity())
+	)
+	db.session.commit()
+	return result.rowcount == 1
+
+
+def requeue_orphans(now=None):
+	"""
+	Return the jobs that were running in processes that have since stopped to the queue, as they will never finish
+
+	:return: the number of jobs requeued
+	"""
+	job = models.Job.__table__
+	result = db.session.execute(
+		update(job)
+		.where(job.c.status == models.Job.RUNNING)
+		.where(or_(job.c.runner.is_(None), ~job.c.runner.in_(coordination.alive(now))))
+		.values(status=models.Job.PENDING, runner=None)
+	)
+	db.session.commit()
+	coordination.forget_dead(now)
+	if result.rowcount:
+		logger.info('Requeued %d jobs of stopped processes', result.rowcount)
+	return result.rowcount
+
+
+def run(job):
+	db.session.refresh(job)
+	logger.info('Running job %d (%s)', job.id, job.kind)
+	try:
+		result = _tasks[job.kind](job, **job.args)
+	except Exception as e:
+		db.session.rollback()
+		traceback.print_exc()
+		job.status = models.Job.FAILED
+		job.message = ('%s: %s' % (type(e).__name__, e))[:1024]
+	else:
+		job.status = models.Job.DONE
+		job.progress = 1
+		job.result = result
+	job.finished = int(time.time())
+	job.commit()
+	logger.info('Job %d (%s) %s', job.id, job.kind, job.status)
+
+
+class JobRunner:
+	"""
+	Runs jobs in worker threads. Every server process has a runner, and they all take jobs from the same table.
+	Periodic jobs are scheduled, and the jobs of stopped processes requeued, only by the process holding the
+	'job-scheduler' lease
+	"""
+
+	def __init__(self, app, workers, poll_interval, lease_ttl):
+		self.app = app
+		self.poll_interval = poll_interval
+		self.lease_ttl = lease_ttl
+		self.event = threading.Event()
+		self.threads = [threading.Thread(target=self.work, name='job-worker-%d' % i) for i in range(workers)]
+		self.threads.append(threading.Thread(target=self.coordinate, name='job-coordinator'))
+		for thread in self.threads:
+			thread.daemon = True
+
+	def start(self):
+		# show this process is alive before any of its workers claim a job, or another process could requeue the job
+		# as orphaned before the coordinator's first heartbeat
+		with self.app.app_context():
+			try:
+				coordination.heartbeat(self.lease_ttl)
+			finally:
+				db.session.remove()
+		for thread in self.threads:
+			thread.start()
+
+	def wake(self):
+		self.event.set()
+
+	def schedule(self):
+		"""
+		Enqueue any periodic jobs that are due. The last job of each kind is read from the job table so the schedule
+		survives restarts
+		"""
+		now = int(time.time())
+		for kind, config_key in _periodic.items():
+			interval = self.app.config.get(config_key)
+			if not interval:
+				continue
+			last = models.Job.all(kind=kind).order_by(desc(models.Job.id)).first()
+			if not last or (last.done and last.created + interval <= now):
+				enqueue(kind, description='Scheduled %s' % kind.replace('_', ' '))
+				if last:
+					# only keep the most recent run of each periodic job
+					models.Job.query.filter(
+						models.Job.kind == kind,
+						models.Job.status.in_([models.Job.DONE, models.Job.FAILED]),
+						models.Job.id < last.id
+					).delete(synchronize_session=False)
+					db.session.commit()
+
+	def next_job(self):
+		for job in models.Job.all(status=models.Job.PENDING).order_by(models.Job.id).limit(16):
+			if claim(job.id):
+				return job
+		return None
+
+	def coordinate(self):
+		while True:
+			with self.app.app_context():
+				try:
+					coordination.heartbeat(self.lease_ttl)
+					if coordination.acquire('job-scheduler', self.lease_ttl):
+						requeue_orphans()
+						self.schedule()
+				except Exception:
+					traceback.print_exc()
+				finally:
+					db.session.remove()
+			time.sleep(self.poll_interval)
+
+	def work(self):
+		while True:
+			with self.app.app_context():
+				try:
+					job = self.next_job()
+					if job:
+						run(job)
+				except Exception:
+					traceback.print_exc()
+					job = None
+				finally:
+					db.session.remove()
+			if not job:
+				self.event.wait(self.poll_interval)
+				self.event.clear()
+
+
+def start_runner(app):
+	global _runner
+	if _runner or not app.config.get('JOB_WORKERS'):
+		return
+	_runner = JobRunner(app, app.config['JOB_WORKERS'], app.config['JOB_POLL_INTERVAL'], app.config['LEASE_TTL'])
+	_runner.start()
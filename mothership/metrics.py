@@ -0,0 +1,164 @@
+"""
+Request, SQL and ingest metrics, exposed at /metrics in the Prometheus text format.
+
+Every request records its latency and the number and total time of the SQL statements it ran. A request that runs the
+same statement more than METRICS_N_PLUS_ONE_THRESHOLD times is logged and counted as a likely N+1 query. Metrics are
+kept per server process, so with several processes each one should be scraped. Set METRICS_ENABLED = False to turn
+all of this off.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+registry = []
+
+
+def format_labels(labels, **extra):
+	labels = labels + tuple(extra.items())
+	if not labels:
+		return ''
+	return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+
+class Counter:
+
+	def __init__(self, name, documentation):
+		self.name = name
+		self.documentation = documentation
+		self.values = defaultdict(float)
+		self.lock = threading.Lock()
+		registry.append(self)
+
+	def inc(self, amount=1, **labels):
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			self.values[key] += amount
+
+	def render(self):
+		yield '# HELP %s %s' % (self.name, self.documentation)
+		yield '# TYPE %s counter' % self.name
+		with self.lock:
+			values = list(self.values.items())
+		for labels, value in values:
+			yield '%s%s %s' % (self.name, format_labels(labels), repr(value))
+
+
+class Histogram:
+
+	def __init__(self, name, documentation, buckets):
+		self.name = name
+		self.documentation = documentation
+		self.buckets = buckets
+		self.values = {}
+		self.lock = threading.Lock()
+		registry.append(self)
+
+	def observe(self, value, **labels):
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			if key not in self.values:
+				self.values[key] = [[0] * len(self.buckets), 0, 0]
+			counts = self.values[key]
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					counts[0][i] += 1
+			counts[1] += value
+			counts[2] += 1
+
+	def render(self):
+		yield '# HELP %s %s' % (self.name, self.documentation)
+		yield '# TYPE %s histogram' % self.name
+		with self.lock:
+			values = [(labels, list(buckets), total, count) for labels, (buckets, total, count) in self.values.items()]
+		for labels, buckets, total, count in values:
+			for bound, bucket_count in zip(self.buckets, buckets):
+				yield '%s_bucket%s %d' % (self.name, format_labels(labels, le=bound), bucket_count)
+			yield '%s_bucket%s %d' % (self.name, format_labels(labels, le='+Inf'), count)
+			yield '%s_sum%s %s' % (self.name, format_labels(labels), repr(total))
+			yield '%s_count%s %d' % (self.name, format_labels(labels), count)
+
+
+requests_total = Counter('mothership_requests_total', 'Requests handled')
+request_latency = Histogram('mothership_request_latency_seconds', 'Request latency', LATENCY_BUCKETS)
+request_queries = Histogram('mothership_request_queries', 'SQL statements executed per request', QUERY_BUCKETS)
+request_query_time = Histogram('mothership_request_query_seconds', 'Time spent executing SQL per request', LATENCY_BUCKETS)
+n_plus_one = Counter('mothership_n_plus_one_total', 'Requests that repeated a statement more than METRICS_N_PLUS_ONE_THRESHOLD times')
+snapshots_ingested = Counter('mothership_snapshots_ingested_total', 'Snapshots submitted by fuzzers')
+crashes_ingested = Counter('mothership_crashes_ingested_total', 'Crashes submitted by fuzzers')
+upload_bytes = Counter('mothership_upload_bytes_total', 'Bytes of queues uploaded by fuzzers')
+
+_listening = False
+
+
+def enabled():
+	return current_app.config['METRICS_ENABLED']
+
+
+def count(counter, amount=1, **labels):
+	"""
+	Increment a counter if metrics are enabled
+	"""
+	if enabled():
+		counter.inc(amount, **labels)
+
+
+def render():
+	return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	# a single value, as statements on a connection don't overlap and one that fails never reaches after_cursor_execute
+	conn.info['metrics_query_start'] = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	elapsed = time.perf_counter() - conn.info.pop('metrics_query_start')
+	if has_request_context() and hasattr(g, 'metrics_statements'):
+		g.metrics_statements[statement] += 1
+		g.metrics_query_time += elapsed
+
+
+def before_request():
+	if not enabled():
+		return
+	g.metrics_start = time.perf_counter()
+	g.metrics_statements = defaultdict(int)
+	g.metrics_query_time = 0
+
+
+def after_request(response):
+	if not hasattr(g, 'metrics_start'):
+		return response
+	endpoint = request.endpoint or 'unknown'
+	requests_total.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+	request_latency.observe(time.perf_counter() - g.metrics_start, endpoint=endpoint)
+	request_queries.observe(sum(g.metrics_statements.values()), endpoint=endpoint)
+	request_query_time.observe(g.metrics_query_time, endpoint=endpoint)
+	if g.metrics_statements:
+		statement, repeats = max(g.metrics_statements.items(), key=lambda s: s[1])
+		if repeats > current_app.config['METRICS_N_PLUS_ONE_THRESHOLD']:
+			n_plus_one.inc(endpoint=endpoint)
+			logger.warning('%s ran the same statement %d times: %s', endpoint, repeats, statement)
+	return response
+
+
+def init_app(app):
+	global _listening
+	if not app.config['METRICS_ENABLED']:
+		return
+	if not _listening:
+		event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+		event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+		_listening = True
+	app.before_request(before_request)
+	app.after_request(after_request)
@@ -1,52 +1,81 @@
 import json
 import statistics
 
-import time
-
 import sqlalchemy.types as types
 from flask.ext.sqlalchemy import SQLAlchemy
-from sqlalchemy import DDL, desc
-from sqlalchemy.exc import OperationalError
+from sqlalchemy import case, desc, func, inspect
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 
 db = SQLAlchemy()
 db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=db))
 
+# bound parameters per statement, under the 999 allowed by sqlite before 3.32
+MAX_PARAMETERS = 900
 
-# from sqlalchemy import event
-# from sqlalchemy.engine import Engine
-# import logging
-#
-# logging.basicConfig()
-# logger = logging.getLogger("mothership.sqltime")
-# logger.setLevel(logging.DEBUG)
-#
-#
-# @event.listens_for(Engine, "before_cursor_execute")
-# def before_cursor_execute(conn, cursor, statement,
-#                           parameters, context, executemany):
-# 	conn.info.setdefault('query_start_time', []).append(time.time())
-# 	logger.debug("Start Query: %s", statement)
-#
-#
-# @event.listens_for(Engine, "after_cursor_execute")
-# def after_cursor_execute(conn, cursor, statement,
-#                          parameters, context, executemany):
-# 	total = time.time() - conn.info['query_start_time'].pop(-1)
-# 	logger.debug("Query Complete!")
-# 	logger.debug("Total Time: %f", total)
 
 def init_db():
-	return
+	"""
+	Bring an existing database up to date with the models: create missing tables, then add any columns and indexes
+	that have been added to existing tables since they were created, and fill in the columns that are maintained
+	incrementally
+	"""
+	# imported here as the scheduler's own imports need these models
+	from mothership import scheduler
+	db.create_all()
+	inspector = inspect(db.engine)
+	added = set()
+	for table in db.metadata.sorted_tables:
+		columns = {c['name'] for c in inspector.get_columns(table.name)}
+		for column in table.columns:
+			if column.name not in columns:
+				db.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, column.type.compile(db.engine.dialect)))
+				added.add((table.name, column.name))
+		indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+		for index in table.indexes:
+			if index.name not in indexes:
+				index.create(db.engine)
+	if ('instance', 'state') in added:
+		# instances from before heartbeats, taking their last submission as their last heartbeat so the reaper only
+		# marks them dead if they have actually stopped
+		FuzzerInstance.query.filter(FuzzerInstance.state.is_(None)).update({
+			FuzzerInstance.state: case([(FuzzerInstance.terminated == True, FuzzerInstance.TERMINATED)], else_=FuzzerInstance.RUNNING),
+			FuzzerInstance.last_heartbeat: func.coalesce(FuzzerInstance.last_heartbeat, FuzzerInstance.last_update)
+		}, synchronize_session=False)
+		db.session.commit()
+	if added & {('campaign', 'running_fuzzers'), ('campaign', 'has_master'), ('instance', 'state')}:
+		# registration relies on these counts, so don't wait for the next refresh_scheduler job to compute them
+		scheduler.recount()
+
+
+def delete_in_chunks(model, *criterion, chunk_size=10000):
+	"""
+	Delete the rows of a model matching criterion using set based deletes of at most chunk_size rows, committing
+	after each chunk to bound lock time and transaction size
+
+	:return: the number of rows deleted
+	"""
+	deleted = 0
+	while True:
+		ids = [row_id for row_id, in db.session.query(model.id).filter(*criterion).limit(chunk_size)]
+		if not ids:
+			return deleted
+		for i in range(0, len(ids), MAX_PARAMETERS):
+			model.query.filter(model.id.in_(ids[i:i + MAX_PARAMETERS])).delete(synchronize_session=False)
+		db.session.commit()
+		deleted += len(ids)
 
 
-# try:
-# 	Campaign.get().executable_name
-# except OperationalError:
-# 	db.engine.execute(DDL('alter table campaign add column executable_name VARCHAR;'))
-# 	db.engine.execute(DDL('alter table campaign add column executable_args VARCHAR;'))
-# 	db.engine.execute(DDL('alter table campaign add column afl_args VARCHAR;'))
+def delete_campaign_data(campaign_ids, chunk_size=10000):
+	"""
+	Delete the snapshots, crashes, instances and timelines of every campaign in campaign_ids
+	"""
+	instance_ids = db.session.query(FuzzerInstance.id).filter(FuzzerInstance.campaign_id.in_(campaign_ids))
+	delete_in_chunks(FuzzerSnapshot, FuzzerSnapshot.instance_id.in_(instance_ids), chunk_size=chunk_size)
+	delete_in_chunks(Crash, Crash.campaign_id.in_(campaign_ids), chunk_size=chunk_size)
+	delete_in_chunks(FuzzerInstance, FuzzerInstance.campaign_id.in_(campaign_ids), chunk_size=chunk_size)
+	ActivityPeriod.query.filter(ActivityPeriod.campaign_id.in_(campaign_ids)).delete(synchronize_session=False)
+	db.session.commit()
 
 
 class JsonType(types.TypeDecorator):
@@ -126,17 +155,43 @@ class Campaign(Model, db.Model):
 
 	active = db.Column(db.Boolean(), default=False)
 	desired_fuzzers = db.Column(db.Integer())
+	priority = db.Column(db.Integer(), default=1)
+
+	# maintained by mothership.scheduler
+	running_fuzzers = db.Column(db.Integer(), default=0)
+	has_master = db.Column(db.Boolean(), default=False)
+	paths_rate = db.Column(db.Float(), default=0)
+	paths_found_total = db.Column(db.Integer(), default=0)
+	paths_rate_updated = db.Column(db.Integer())
 
 	has_dictionary = db.Column(db.Boolean(), default=False)
 	executable_name = db.Column(db.String(512))
 	executable_args = db.Column(db.String(1024))
 	afl_args = db.Column(db.String(1024))
 
-	parent_id = db.Column(db.Integer, db.ForeignKey('campaign.id'))
+	# days to keep every snapshot for before rolling them up, None uses SNAPSHOT_RETENTION_DAYS
+	snapshot_retention_days = db.Column(db.Integer())
+	snapshots_rolled_up_to = db.Column(db.Integer(), default=0)
+	archived = db.Column(db.Boolean(), default=False)
+	# whether activity periods have been built from this campaign's snapshots, see mothership.timeline
+	timeline_built = db.Column(db.Boolean(), default=False)
+
+	parent_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), index=True)
 	@property
 	def children(self):
 		return Campaign.all(parent_id=self.id)
 
+	def tree_ids(self):
+		"""
+		:return: the ids of this campaign and all of its descendants
+		"""
+		ids = [self.id]
+		parents = [self.id]
+		while parents:
+			parents = [campaign_id for campaign_id, in db.session.query(Campaign.id).filter(Campaign.parent_id.in_(parents))]
+			ids += parents
+		return ids
+
 	def __init__(self, name):
 		self.name = name
 
@@ -146,7 +201,7 @@ class Campaign(Model, db.Model):
 
 	@property
 	def active_fuzzers(self):
-		return sum(i.running for i in self.fuzzers if not i.master)
+		return self.fuzzers.filter_by(state=FuzzerInstance.RUNNING, master=False).count()
 
 	@property
 	def master_fuzzer(self):
@@ -174,13 +229,28 @@ class Campaign(Model, db.Model):
 
 class FuzzerInstance(Model, db.Model):
 	__tablename__ = 'instance'
+	__table_args__ = (
+		db.Index('ix_instance_campaign_state', 'campaign_id', 'state'),
+	)
+
+	RUNNING = 'running'
+	DEAD = 'dead'
+	TERMINATED = 'terminated'
 
-	campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'))
+	campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), index=True)
 	snapshots = db.relationship('FuzzerSnapshot', backref='fuzzer', lazy='dynamic')
 	crashes = db.relationship('Crash', backref='fuzzer', lazy='dynamic')
 	hostname = db.Column(db.String(128))
 	terminated = db.Column(db.Boolean(), default=False)
 	master = db.Column(db.Boolean(), default=False)
+	state = db.Column(db.String(16), index=True)
+	last_heartbeat = db.Column(db.Integer())
+	cpu = db.Column(db.Integer())  # the cpu the slave pinned this fuzzer to, if any
+	restarts = db.Column(db.Integer(), default=0)  # times the slave restarted afl-fuzz after it exited
+	exit_reason = db.Column(db.String(256))
+	first_snapshot = db.Column(db.Integer())
+	last_snapshot = db.Column(db.Integer())
+	period_id = db.Column(db.Integer(), index=True)
 
 	start_time = db.Column(db.Integer())
 	last_update = db.Column(db.Integer())
@@ -226,13 +296,26 @@ class FuzzerInstance(Model, db.Model):
 
 	@property
 	def running(self):
-		return not self.terminated and time.time() - max(self.last_update or 0, self.start_time or 0) < 60 * 10
+		return self.state == FuzzerInstance.RUNNING
+
+
+class ActivityPeriod(Model, db.Model):
+	__tablename__ = 'activity_period'
+
+	campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), index=True)
+	start = db.Column(db.Integer())
+	stop = db.Column(db.Integer())
+	# subtracted from a time in this period to place it on the campaign's timeline
+	offset = db.Column(db.Integer())
 
 
 class FuzzerSnapshot(Model, db.Model):
 	__tablename__ = 'snapshot'
 
-	instance_id = db.Column(db.Integer, db.ForeignKey('instance.id'))
+	# resource usage sampled by the slave, only recorded on the newest snapshot of each submission
+	TELEMETRY = ['cpu_percent', 'rss_kb', 'read_bytes_per_sec', 'write_bytes_per_sec', 'ctx_switches_per_sec', 'sync_dir_bytes']
+
+	instance_id = db.Column(db.Integer, db.ForeignKey('instance.id'), index=True)
 	unix_time = db.Column(db.Integer())
 	cycles_done = db.Column(db.Integer())
 	cur_path = db.Column(db.Integer())
@@ -246,12 +329,19 @@ class FuzzerSnapshot(Model, db.Model):
 	execs_per_sec = db.Column(db.Float())
 	stability = db.Column(db.Float())
 
+	cpu_percent = db.Column(db.Float())
+	rss_kb = db.Column(db.Integer())
+	read_bytes_per_sec = db.Column(db.Float())
+	write_bytes_per_sec = db.Column(db.Float())
+	ctx_switches_per_sec = db.Column(db.Float())
+	sync_dir_bytes = db.Column(db.BigInteger())
+
 
 class Crash(Model, db.Model):
 	__tablename__ = 'crash'
 
-	campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'))
-	instance_id = db.Column(db.Integer, db.ForeignKey('instance.id'))
+	campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), index=True)
+	instance_id = db.Column(db.Integer, db.ForeignKey('instance.id'), index=True)
 
 	created = db.Column(db.Integer)
 	name = db.Column(db.String(1024))
@@ -266,3 +356,56 @@ class Crash(Model, db.Model):
 	exploitable_hash = db.Column(db.String(64))
 	exploitable_data = db.Column(JsonType)
 	frames = db.Column(JsonType)
+
+
+class Job(Model, db.Model):
+	__tablename__ = 'job'
+
+	PENDING = 'pending'
+	RUNNING = 'running'
+	DONE = 'done'
+	FAILED = 'failed'
+
+	kind = db.Column(db.String(64))
+	# not a foreign key - jobs such as deleting a campaign outlive the campaign
+	campaign_id = db.Column(db.Integer(), index=True)
+	description = db.Column(db.String(256))
+	status = db.Column(db.String(16), default=PENDING, index=True)
+	args = db.Column(JsonType)
+	result = db.Column(JsonType)
+	progress = db.Column(db.Float(), default=0)
+	message = db.Column(db.String(1024))
+
+	created = db.Column(db.Integer())
+	started = db.Column(db.Integer())
+	finished = db.Column(db.Integer())
+	# the coordination.identity() of the process running the job
+	runner = db.Column(db.String(128))
+
+	@property
+	def done(self):
+		return self.status in (Job.DONE, Job.FAILED)
+
+	def set_progress(self, progress, message=None):
+		self.progress = progress
+		if message is not None:
+			self.message = message
+		self.commit()
+
+
+class Lease(Model, db.Model):
+	""" Held by one mothership process at a time until it expires, see coordination.py """
+	__tablename__ = 'lease'
+
+	name = db.Column(db.String(128), unique=True)
+	holder = db.Column(db.String(128))
+	expires = db.Column(db.Integer())
+
+
+class IngestCheckpoint(Model, db.Model):
+	""" How far the records of a process's ingest log have been written to the database, see ingest.py """
+	__tablename__ = 'ingest_checkpoint'
+
+	log = db.Column(db.String(128), unique=True)
+	segment = db.Column(db.Integer(), default=0)
+	offset = db.Column(db.BigInteger(), default=0)
@@ -0,0 +1,69 @@
+"""
+Track which fuzzers are alive.
+
+Fuzzers send a heartbeat every HEARTBEAT_FREQUENCY seconds (submitting stats counts as one). A periodic job marks
+every running instance that has not been heard from for HEARTBEAT_TIMEOUT seconds as dead in a single statement and
+returns its slot to the scheduler.
+"""
+import logging
+import time
+
+from flask import current_app
+from sqlalchemy import func, update
+
+from mothership import models, jobs, scheduler
+from mothership.models import db
+
+logger = logging.getLogger(__name__)
+
+
+def beat(instance, now=None, commit=True):
+	"""
+	Record that a fuzzer is alive. A fuzzer that was reaped (or predates heartbeats) is revived if its campaign still
+	has a free slot for it
+
+	:param commit: False to leave committing to the caller
+	:return: False if the fuzzer should stop because its campaign no longer has room for it
+	"""
+	now = now or int(time.time())
+	instance.last_heartbeat = now
+	if instance.state == models.FuzzerInstance.RUNNING:
+		alive = True
+	elif instance.state == models.FuzzerInstance.TERMINATED:
+		alive = False
+	elif instance.master or scheduler.claim_slot(instance.campaign_id):
+		instance.state = models.FuzzerInstance.RUNNING
+		logger.info('Revived %s', instance.name)
+		alive = True
+	else:
+		alive = False
+	if commit:
+		instance.commit()
+	return alive
+
+
+def reap(now=None):
+	"""
+	Mark running instances that have missed their heartbeats as dead and recount the campaigns they belonged to
+
+	:return: the number of instances reaped
+	"""
+	now = now or int(time.time())
+	instance = models.FuzzerInstance
+	stale = [
+		instance.state == instance.RUNNING,
+		func.coalesce(instance.last_heartbeat, 0) < now - current_app.config['HEARTBEAT_TIMEOUT']
+	]
+	campaign_ids = [campaign_id for campaign_id, in db.session.query(instance.campaign_id).filter(*stale).distinct()]
+	if not campaign_ids:
+		return 0
+	reaped = db.session.execute(update(instance.__table__).where(stale[0]).where(stale[1]).values(state=instance.DEAD)).rowcount
+	scheduler.recount_running(campaign_ids)
+	db.session.commit()
+	logger.info('Reaped %d instances', reaped)
+	return reaped
+
+
+@jobs.task('reap_instances', every='REAPER_FREQUENCY')
+def reap_instances(job):
+	return dict(reaped=reap())
@@ -0,0 +1,205 @@
+import contextlib
+import json
+import logging
+import os
+import tarfile
+import tempfile
+import time
+
+from flask import current_app
+from sqlalchemy import func
+from werkzeug.utils import secure_filename
+
+from mothership import models, jobs, storage
+from mothership.models import db
+from mothership.storage import campaign_key, add_to_tar
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_COLUMNS = [c.name for c in models.FuzzerSnapshot.__table__.columns if c.name not in ('id', 'instance_id')]
+INSTANCE_COLUMNS = [c.name for c in models.FuzzerInstance.__table__.columns if c.name not in ('id', 'campaign_id')]
+CRASH_COLUMNS = [c.name for c in models.Crash.__table__.columns if c.name not in ('id', 'campaign_id', 'instance_id', 'path')]
+
+
+def rollup_snapshots(campaign, now=None):
+	"""
+	Thin out the snapshots of a campaign that are older than its retention period, keeping the last snapshot of each
+	instance in every SNAPSHOT_ROLLUP_INTERVAL
+
+	:return: the number of snapshots deleted
+	"""
+	retention_days = campaign.snapshot_retention_days or current_app.config['SNAPSHOT_RETENTION_DAYS']
+	interval = current_app.config['SNAPSHOT_ROLLUP_INTERVAL']
+	if not retention_days or not interval:
+		return 0
+	cutoff = (now or int(time.time())) - retention_days * 24 * 60 * 60
+	# only roll up whole buckets, and only the ones not rolled up by a previous run
+	cutoff -= cutoff % interval
+	rolled_up_to = campaign.snapshots_rolled_up_to or 0
+	if cutoff <= rolled_up_to:
+		return 0
+
+	snapshot = models.FuzzerSnapshot
+	instance_ids = db.session.query(models.FuzzerInstance.id).filter_by(campaign_id=campaign.id)
+	window = [
+		snapshot.instance_id.in_(instance_ids),
+		snapshot.unix_time >= rolled_up_to,
+		snapshot.unix_time < cutoff
+	]
+	keep = db.session.query(func.max(snapshot.id)).filter(*window).group_by(
+		snapshot.instance_id,
+		snapshot.unix_time - snapshot.unix_time % interval
+	)
+	deleted = models.delete_in_chunks(snapshot, ~snapshot.id.in_(keep), *window, chunk_size=current_app.config['DELETE_CHUNK_SIZE'])
+	campaign.snapshots_rolled_up_to = cutoff
+	campaign.commit()
+	return deleted
+
+
+def campaign_last_update(campaign):
+	return db.session.query(func.max(models.FuzzerInstance.last_update)).filter_by(campaign_id=campaign.id).scalar()
+
+
+def should_archive(campaign, now=None):
+	archive_after = current_app.config['ARCHIVE_AFTER_DAYS']
+	if not archive_after or campaign.active or campaign.archived:
+		return False
+	last_update = campaign_last_update(campaign)
+	return bool(last_update) and (now or time.time()) - last_update > archive_after * 24 * 60 * 60
+
+
+def write_jsonl(path, rows):
+	with open(path, 'w') as f:
+		for row in rows:
+			f.write(json.dumps(row))
+			f.write('\n')
+
+
+def read_jsonl(f):
+	for line in f:
+		yield json.loads(line.decode('utf-8'))
+
+
+def archive_path(campaign):
+	return os.path.join(current_app.config['ARCHIVE_DIRECTORY'], '%s_%d.tar.gz' % (secure_filename(campaign.name), campaign.id))
+
+
+def archive_campaign(campaign):
+	"""
+	Move the instances, snapshots and crashes of a campaign into a compressed archive file that can later be restored
+	with import_archive. The campaign itself is kept and marked as archived
+
+	:return: the path of the archive and the number of bytes of crash and sync_dir files freed
+	"""
+	store = storage.get()
+	crash_dir = campaign_key(campaign.name, 'crashes')
+	sync_dir = campaign_key(campaign.name, 'sync_dir')
+	os.makedirs(current_app.config['ARCHIVE_DIRECTORY'], exist_ok=True)
+	path = archive_path(campaign)
+
+	instances = campaign.fuzzers.order_by(models.FuzzerInstance.id)
+	instance_ids = db.session.query(models.FuzzerInstance.id).filter_by(campaign_id=campaign.id)
+	snapshots = models.FuzzerSnapshot.query.filter(models.FuzzerSnapshot.instance_id.in_(instance_ids)).order_by(models.FuzzerSnapshot.id)
+	crashes = campaign.crashes.order_by(models.Crash.id)
+
+	with tempfile.TemporaryDirectory() as temp, tarfile.open(path + '.partial', 'w:gz') as tar:
+		write_jsonl(os.path.join(temp, 'campaign.jsonl'), [campaign.to_dict()])
+		write_jsonl(os.path.join(temp, 'instances.jsonl'), (
+			dict(id=i.id, **{k: getattr(i, k) for k in INSTANCE_COLUMNS}) for i in instances
+		))
+		write_jsonl(os.path.join(temp, 'snapshots.jsonl'), (
+			dict(instance_id=s.instance_id, **{k: getattr(s, k) for k in SNAPSHOT_COLUMNS}) for s in snapshots.yield_per(10000)
+		))
+		crash_rows = []
+		for crash in crashes.yield_per(1000):
+			row = dict(instance_id=crash.instance_id, **{k: getattr(crash, k) for k in CRASH_COLUMNS})
+			if crash.path and store.exists(crash.path):
+				row['file'] = 'crashes/' + os.path.basename(crash.path)
+				with contextlib.closing(store.open(crash.path)) as f:
+					add_to_tar(tar, row['file'], f, store.size(crash.path))
+			crash_rows.append(row)
+		write_jsonl(os.path.join(temp, 'crashes.jsonl'), crash_rows)
+		for name in ['campaign.jsonl', 'instances.jsonl', 'snapshots.jsonl', 'crashes.jsonl']:
+			tar.add(os.path.join(temp, name), arcname=name)
+	os.rename(path + '.partial', path)
+
+	freed = store.size(crash_dir) + store.size(sync_dir) - os.path.getsize(path)
+	models.delete_campaign_data([campaign.id], chunk_size=current_app.config['DELETE_CHUNK_SIZE'])
+	store.delete(crash_dir)
+	store.delete(sync_dir)
+	campaign.archived = True
+	campaign.active = False
+	campaign.commit()
+	logger.info('Archived %s to %s, freeing %d bytes', campaign.name, path, freed)
+	return path, freed
+
+
+def import_archive(path):
+	"""
+	Restore a campaign archived by archive_campaign. The data is restored into the campaign of the same name if it
+	still exists, otherwise a new (inactive) campaign is created
+
+	:return: the restored campaign
+	"""
+	with tarfile.open(path, 'r:gz') as tar:
+		campaign_data = next(read_jsonl(tar.extractfile('campaign.jsonl')))
+		campaign = models.Campaign.get(name=campaign_data['name'])
+		if not campaign:
+			campaign = models.Campaign(campaign_data['name'])
+			campaign.update(**{k: v for k, v in campaign_data.items() if k != 'id'})
+			campaign.active = False
+			campaign.put()
+
+		instance_ids = {}
+		for row in read_jsonl(tar.extractfile('instances.jsonl')):
+			old_id = row.pop('id')
+			instance = models.FuzzerInstance(campaign_id=campaign.id, **row)
+			db.session.add(instance)
+			db.session.flush()
+			instance_ids[old_id] = instance.id
+		db.session.commit()
+
+		snapshots = []
+		for row in read_jsonl(tar.extractfile('snapshots.jsonl')):
+			row['instance_id'] = instance_ids.get(row['instance_id'])
+			snapshots.append(row)
+			if len(snapshots) >= 10000:
+				db.session.execute(models.FuzzerSnapshot.__table__.insert(), snapshots)
+				snapshots = []
+		if snapshots:
+			db.session.execute(models.FuzzerSnapshot.__table__.insert(), snapshots)
+		db.session.commit()
+
+		for row in read_jsonl(tar.extractfile('crashes.jsonl')):
+			archived_file = row.pop('file', None)
+			row['instance_id'] = instance_ids.get(row['instance_id'])
+			crash = models.Crash(campaign_id=campaign.id, **row)
+			db.session.add(crash)
+			if archived_file:
+				db.session.flush()
+				crash.path = campaign_key(campaign.name, 'crashes', os.path.basename(archived_file))
+				storage.get().save(crash.path, tar.extractfile(archived_file))
+		campaign.archived = False
+		campaign.timeline_built = False
+		db.session.commit()
+	return campaign
+
+
+@jobs.task('apply_retention', every='RETENTION_FREQUENCY')
+def apply_retention(job):
+	snapshots_deleted, campaigns_archived, bytes_reclaimed = 0, 0, 0
+	campaigns = models.Campaign.query.filter(models.Campaign.archived.isnot(True)).all()
+	for i, campaign in enumerate(campaigns):
+		job.set_progress(i / len(campaigns), 'Processing %s' % campaign.name)
+		if should_archive(campaign):
+			_, freed = archive_campaign(campaign)
+			campaigns_archived += 1
+			bytes_reclaimed += freed
+		else:
+			snapshots_deleted += rollup_snapshots(campaign)
+	logger.info('Retention deleted %d snapshots, archived %d campaigns and reclaimed %d bytes', snapshots_deleted, campaigns_archived, bytes_reclaimed)
+	return dict(
+		snapshots_deleted=snapshots_deleted,
+		campaigns_archived=campaigns_archived,
+		bytes_reclaimed=bytes_reclaimed
+	)
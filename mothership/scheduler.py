@@ -0,0 +1,189 @@
+"""
+Decide which campaign a newly registered fuzzer should work on.
+
+Each campaign keeps a running_fuzzers counter that is incremented atomically when a fuzzer registers, decremented when
+it terminates or is reaped and periodically recounted from the instances, so choosing a campaign only reads the
+campaign table.
+Which campaign with spare capacity wins is decided by the policy named by SCHEDULER_POLICY.
+"""
+import logging
+import time
+
+from flask import current_app
+from sqlalchemy import func, update
+
+from mothership import models, jobs
+from mothership.models import db
+
+logger = logging.getLogger(__name__)
+
+policies = {}
+
+
+def policy(name):
+	def decorator(f):
+		policies[name] = f
+		return f
+	return decorator
+
+
+@policy('first')
+def first_policy(campaign):
+	""" The lowest id campaign that still wants fuzzers """
+	return campaign.id
+
+
+@policy('priority')
+def priority_policy(campaign):
+	""" The highest priority campaign, breaking ties by how full each campaign is """
+	return -(campaign.priority or 1), (campaign.running_fuzzers or 0) / campaign.desired_fuzzers
+
+
+@policy('fair_share')
+def fair_share_policy(campaign):
+	""" Spread fuzzers evenly across campaigns, weighted by priority """
+	return (campaign.running_fuzzers or 0) / (campaign.priority or 1)
+
+
+@policy('productivity')
+def productivity_policy(campaign):
+	""" Give fuzzers to campaigns in proportion to their recent rate of finding new paths, weighted by priority """
+	weight = (campaign.priority or 1) * ((campaign.paths_rate or 0) + current_app.config['SCHEDULER_MIN_PATHS_RATE'])
+	return (campaign.running_fuzzers or 0) / weight
+
+
+def candidates():
+	return models.Campaign.query.filter(
+		models.Campaign.active == True,
+		func.coalesce(models.Campaign.running_fuzzers, 0) < models.Campaign.desired_fuzzers
+	)
+
+
+def claim_slot(campaign_id):
+	result = db.session.execute(
+		update(models.Campaign.__table__)
+		.where(models.Campaign.id == campaign_id)
+		.where(models.Campaign.active == True)
+		.where(func.coalesce(models.Campaign.running_fuzzers, 0) < models.Campaign.desired_fuzzers)
+		.values(running_fuzzers=func.coalesce(models.Campaign.running_fuzzers, 0) + 1)
+	)
+	return result.rowcount == 1
+
+
+def claim_master(campaign_id):
+	result = db.session.execute(
+		update(models.Campaign.__table__)
+		.where(models.Campaign.id == campaign_id)
+		.where(models.Campaign.has_master.isnot(True))
+		.values(has_master=True)
+	)
+	return result.rowcount == 1
+
+
+def add_instance(campaign_id, hostname, master=False):
+	now = int(time.time())
+	instance = models.FuzzerInstance(
+		campaign_id=campaign_id,
+		hostname=hostname,
+		master=master,
+		start_time=now,
+		last_heartbeat=now,
+		state=models.FuzzerInstance.RUNNING
+	)
+	db.session.add(instance)
+	db.session.commit()
+	return instance
+
+
+def reserve(hostname):
+	"""
+	Choose a campaign for a new fuzzer, claim one of its slots and create the fuzzer's instance.
+
+	The slot is claimed with a compare-and-set on the campaign's counter in the same transaction that creates the
+	instance, so concurrent registrations can never take more slots than the campaign wants and a slot is never
+	claimed without an instance to show for it. A registration that loses the race moves on to the next best campaign.
+
+	:return: the new instance, or None if no campaign wants more fuzzers
+	"""
+	key = policies[current_app.config['SCHEDULER_POLICY']]
+	for campaign in sorted(candidates(), key=key):
+		if claim_slot(campaign.id):
+			return add_instance(campaign.id, hostname)
+		db.session.rollback()
+	return None
+
+
+def reserve_master(campaign, hostname):
+	"""
+	Create the master instance for a campaign, unless another registration already has
+
+	:return: the new instance, or None if the campaign already has a master
+	"""
+	if claim_master(campaign.id):
+		return add_instance(campaign.id, hostname, master=True)
+	db.session.rollback()
+	return None
+
+
+def release(instance):
+	"""
+	Return the slot held by a (non master) fuzzer that has stopped
+	"""
+	if instance.master:
+		return
+	db.session.execute(
+		update(models.Campaign.__table__)
+		.where(models.Campaign.id == instance.campaign_id)
+		.where(models.Campaign.running_fuzzers > 0)
+		.values(running_fuzzers=models.Campaign.running_fuzzers - 1)
+	)
+	db.session.commit()
+
+
+def recount_running(campaign_ids=None):
+	"""
+	Recompute running_fuzzers (and has_master) from the instances of the given campaigns, or of every campaign. Done in
+	a single statement so registrations running concurrently are not lost
+	"""
+	instance = models.FuzzerInstance
+	running = db.session.query(func.count(instance.id)).filter(
+		instance.campaign_id == models.Campaign.id,
+		instance.master == False,
+		instance.state == instance.RUNNING
+	).correlate(models.Campaign).as_scalar()
+	has_master = db.session.query(instance.id).filter(
+		instance.campaign_id == models.Campaign.id,
+		instance.master == True
+	).correlate(models.Campaign).exists()
+	statement = update(models.Campaign.__table__).values(running_fuzzers=running, has_master=has_master)
+	if campaign_ids is not None:
+		statement = statement.where(models.Campaign.id.in_(campaign_ids))
+	db.session.execute(statement)
+
+
+def recount(now=None):
+	"""
+	Recompute every campaign's running_fuzzers from its instances and update the recent paths found rate used by the
+	productivity policy
+	"""
+	now = now or int(time.time())
+	instance = models.FuzzerInstance
+	recount_running()
+	db.session.commit()
+
+	paths_found = dict(db.session.query(instance.campaign_id, func.sum(instance.paths_found)).group_by(instance.campaign_id))
+	for campaign in models.Campaign.query.filter(models.Campaign.archived.isnot(True)):
+		total = paths_found.get(campaign.id) or 0
+		if campaign.paths_rate_updated and campaign.running_fuzzers:
+			hours = (now - campaign.paths_rate_updated) / (60 * 60)
+			rate = max(total - (campaign.paths_found_total or 0), 0) / hours / campaign.running_fuzzers if hours else 0
+			# smooth the rate so a single quiet interval doesn't starve a campaign
+			campaign.paths_rate = (campaign.paths_rate or 0) / 2 + rate / 2
+		campaign.paths_found_total = total
+		campaign.paths_rate_updated = now
+	db.session.commit()
+
+
+@jobs.task('refresh_scheduler', every='SCHEDULER_REFRESH_FREQUENCY')
+def refresh_scheduler(job):
+	recount()
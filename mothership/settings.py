@@ -6,17 +6,80 @@ class Config(object):
 	SECRET_KEY = 'secret key'
 	FUZZER_KEY = 'secret key'
 	DATA_DIRECTORY = 'data'
+	STORAGE_BACKEND = 'local'     # where campaign files are kept - 'local' (in DATA_DIRECTORY) or 's3', see storage.py
+	S3_BUCKET = None
+	S3_PREFIX = ''
+	S3_ENDPOINT_URL = None        # e.g. http://localhost:9000 for MinIO, None for AWS
+	S3_REGION = None
+	S3_ACCESS_KEY_ID = None       # None to use boto3's usual credentials
+	S3_SECRET_ACCESS_KEY = None
+	S3_URL_EXPIRY = 60 * 60       # seconds that presigned download URLs are valid for
 	UPLOAD_FREQUENCY = 60 * 15    # 15 minutes
 	DOWNLOAD_FREQUENCY = 60 * 30  # 30 minutes
+	JOB_WORKERS = 2               # background threads for copying, resetting and deleting campaigns
+	JOB_POLL_INTERVAL = 5
+	LEASE_TTL = 60                # seconds before another process takes over the leases of one that stopped
+	CLONE_HARDLINKS = True        # fall back to hardlinks when copied campaign files can't be reflinked
+	DELETE_CHUNK_SIZE = 10000     # rows deleted per transaction when resetting or deleting campaigns
+	INIT_DB_ON_START = True       # bring the database up to date on the first request, unset by gunicorn.conf.py
+
+	INGEST_ASYNC = False                # answer fuzzer submissions once logged and write them in the background, see ingest.py
+	INGEST_DIRECTORY = 'ingest'         # on a local disk - the logs of stopped processes are replayed from here
+	INGEST_BATCH_SIZE = 500             # submissions written per transaction
+	INGEST_BATCH_INTERVAL = 1           # seconds the writer waits when there is nothing to write
+	INGEST_SEGMENT_SIZE = 64 * 1024 * 1024
+	INGEST_FSYNC = True                 # fsync every logged submission so none are lost if the host crashes
+	INGEST_MAX_BACKLOG = 10000          # refuse submissions while this many are waiting to be written...
+	INGEST_RETRY_AFTER = 30             # ...and ask fuzzers to retry this many seconds later
+
+	# applied to every connection to an sqlite database, see sqlite.py
+	SQLITE_PRAGMAS = {
+		'journal_mode': 'WAL',
+		'synchronous': 'NORMAL',
+		'busy_timeout': 30000,             # milliseconds
+		'mmap_size': 256 * 1024 * 1024,
+		'cache_size': -64 * 1024,          # KiB
+	}
+	SQLITE_SINGLE_WRITER = False        # with an sqlite database, write fuzzer submissions as with INGEST_ASYNC
+
+	HEARTBEAT_FREQUENCY = 15
+	HEARTBEAT_TIMEOUT = 60              # fuzzers that miss heartbeats for this long are marked dead...
+	REAPER_FREQUENCY = 15               # ...by a job run this often
+
+	SCHEDULER_POLICY = 'fair_share'      # one of first, priority, fair_share or productivity
+	SCHEDULER_REFRESH_FREQUENCY = 60
+	SCHEDULER_MIN_PATHS_RATE = 1.        # paths/hour assumed for campaigns that have found nothing recently
+
+	ARCHIVE_DIRECTORY = 'archive'
+	RETENTION_FREQUENCY = 60 * 60 * 6   # how often to apply snapshot retention and archive old campaigns
+	# both delete data so are off (None) unless set, e.g. to 30 and 60
+	SNAPSHOT_RETENTION_DAYS = None      # keep every snapshot for this long...
+	SNAPSHOT_ROLLUP_INTERVAL = 60 * 60  # ...then keep only one per instance per hour
+	ARCHIVE_AFTER_DAYS = None           # archive inactive campaigns that have not been updated for this long
 	SQLALCHEMY_TRACK_MODIFICATIONS = False
 	DEBUG_TB_INTERCEPT_REDIRECTS = False
+	CACHE_VIEW_TIMEOUT = 30  # longest a cached stats/graph response is served after the campaign last changed
+	STREAM_KEEPALIVE = 15    # seconds between re-checking stats on an idle dashboard event stream
+	STREAM_MAX_AGE = 60 * 5  # seconds before an event stream is closed to free its server thread...
+	STREAM_RETRY = 2         # ...and the dashboard reconnects after this many seconds
+	METRICS_ENABLED = True              # record request, SQL and ingest metrics and serve them at /metrics
+	METRICS_N_PLUS_ONE_THRESHOLD = 20   # warn when a request repeats the same SQL statement more than this many times
 
 
 class ProdConfig(Config):
 	ENV = 'prod'
 	SQLALCHEMY_DATABASE_URI = 'mysql+pymysql://<username>:<password>@<identifier>.amazonaws.com/mothership'
-	CACHE_TYPE = 'simple'
+	# per server process, so keep workers * (SQLALCHEMY_POOL_SIZE + SQLALCHEMY_MAX_OVERFLOW) under the database's
+	# connection limit
+	SQLALCHEMY_POOL_SIZE = 10
+	SQLALCHEMY_MAX_OVERFLOW = 10
+	SQLALCHEMY_POOL_TIMEOUT = 10
+	SQLALCHEMY_POOL_RECYCLE = 60 * 60 * 2  # reconnect before MySQL's wait_timeout closes idle connections
+	# shared between server processes, use CACHE_TYPE = 'redis' and CACHE_REDIS_URL to share between hosts
+	CACHE_TYPE = 'filesystem'
+	CACHE_DIR = 'cache'
 	ASSETS_DEBUG = False
+	INGEST_ASYNC = True
 
 
 class DevConfig(Config):
@@ -39,3 +102,5 @@ class TestConfig(Config):
 
 	CACHE_TYPE = 'null'
 	WTF_CSRF_ENABLED = False
+	JOB_WORKERS = 0  # run jobs inline so tests see their effects
+	RETENTION_FREQUENCY = None
@@ -0,0 +1,49 @@
+"""
+Make the most of an sqlite database, as used by DevConfig and small deployments.
+
+By default sqlite locks the whole database for each write and fsyncs every commit, so fuzzers submitting at the same
+time queue up behind each other's fsyncs and eventually fail with "database is locked". Every new sqlite connection is
+instead set up with SQLITE_PRAGMAS:
+
+	journal_mode = WAL      readers don't block the writer (or the writer readers), and commits append to the WAL
+	synchronous = NORMAL    only fsync when the WAL is checkpointed - a power cut may lose the last commits, but never
+	                        corrupts the database
+	busy_timeout            wait for the write lock rather than failing straight away
+	mmap_size, cache_size   read the database through a memory map and keep more pages cached
+
+Writes still happen one at a time, so with SQLITE_SINGLE_WRITER fuzzer submissions are handed to the ingest writer
+(see ingest.py), which makes the writes of many requests in one transaction, rather than every request thread
+competing for the write lock with its own transaction. Like INGEST_ASYNC, submissions are then answered with a 202
+before they are written, and whether a fuzzer should terminate is answered from the last submission written, so it
+is off unless set.
+"""
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_listening = False
+_pragmas = {}
+
+
+def is_sqlite(database_uri):
+	return database_uri.startswith('sqlite')
+
+
+def set_pragmas(dbapi_connection, connection_record):
+	if not isinstance(dbapi_connection, sqlite3.Connection):
+		return
+	cursor = dbapi_connection.cursor()
+	for name, value in _pragmas.items():
+		cursor.execute('PRAGMA %s = %s' % (name, value))
+	cursor.close()
+
+
+def init_app(app):
+	global _listening, _pragmas
+	if not is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+		return
+	_pragmas = dict(app.config['SQLITE_PRAGMAS'])
+	if not _listening:
+		event.listen(Engine, 'connect', set_pragmas)
+		_listening = True
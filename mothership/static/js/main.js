@@ -2,25 +2,99 @@ $('tr[data-href]').on("click", function() {
 	document.location = $(this).data('href');
 });
 
-$('div[data-update-url]').each(function(){
+var streams = {};
+
+function getStream(url){
+	// one EventSource per stream url, shared by everything on the page that listens to it
+	if (!url || !window.EventSource){
+		return null;
+	}
+	if (!(url in streams)){
+		streams[url] = new EventSource(url);
+	}
+	return streams[url];
+}
+
+function updateFields(updating, data){
+	$.each(data, function(k, v){
+		updating.find('#' + k).text(v);
+	});
+}
+
+$('[data-update-url]').each(function(){
 	var updating = $(this);
+	var stream = getStream(updating.data('streamUrl'));
+	if (stream){
+		stream.addEventListener('stats', function(e){
+			updateFields(updating, JSON.parse(e.data));
+		});
+		return;
+	}
 	(function(){
-		console.log(updating);
 		var update = arguments.callee;
-		console.log(updating.data('updateUrl'));
 		$.getJSON(updating.data('updateUrl'), function(data) {
-			$.each(data, function(k, v){
-				updating.find('#' + k).text(v);
-			});
-			console.log('updateRate' in updating.data());
-			if ('updateRate' in updating.data()){
-				console.log(updating.data('updateRate'));
-        		setTimeout(update, +updating.data('updateRate'));
-        	}
+			updateFields(updating, data);
+			if ('updateRate' in updating.data() && !data.finished){
+				setTimeout(update, +updating.data('updateRate'));
+			}
 		});
 	})();
 });
 
+function appendSeries(chart, update){
+	$.each(update, function(i, newSeries){
+		var series = null;
+		$.each(chart.series, function(j, s){
+			if (s.name === newSeries.name){
+				series = s;
+			}
+		});
+		if (!series){
+			chart.addSeries(newSeries, false);
+			return;
+		}
+		$.each(newSeries.data, function(j, point){
+			series.addPoint(point, false);
+		});
+	});
+	chart.redraw();
+}
+
+function refreshGraph(chart, source, cursor, rate){
+	// fetch only the points after the last one we have
+	setTimeout(function(){
+		$.getJSON(source + (source.indexOf('?') < 0 ? '?' : '&') + 'since=' + cursor, function(update){
+			if (update.series){
+				appendSeries(chart, update.series);
+				cursor = update.cursor;
+			}
+			refreshGraph(chart, source, cursor, rate);
+		});
+	}, rate);
+}
+
+function appendSnapshots(chart, property, update){
+	// new series start in the latest activity period, which has the largest offset
+	var offset = 0;
+	var series = null;
+	$.each(chart.series, function(i, s){
+		offset = Math.max(offset, s.options.offset || 0);
+		if (s.name === update.name){
+			series = s;
+		}
+	});
+	if (!series){
+		series = chart.addSeries({name: update.name, data: [], offset: offset}, false);
+	}
+	var seriesOffset = series.options.offset || offset;
+	$.each(update.snapshots, function(i, snapshot){
+		if (property in snapshot){
+			series.addPoint([(snapshot.unix_time - seriesOffset) * 1000, snapshot[property]], false);
+		}
+	});
+	chart.redraw();
+}
+
 function durationFormatter(x){
 	var millisInDay = 24*60*60*1000;
 	var days = x / millisInDay;
@@ -93,7 +167,19 @@ $('div[data-graph]').each(function(){
 					}
 				}
             }
+            var cursor = data.cursor;
             $(that).highcharts(data);
+
+			var chart = $(that).highcharts();
+			var stream = getStream($(that).data('streamUrl'));
+			var property = $(that).data('property');
+			if (stream && property){
+				stream.addEventListener('snapshots', function(e){
+					appendSnapshots(chart, property, JSON.parse(e.data));
+				});
+			} else if (cursor !== undefined && 'refreshRate' in $(that).data()){
+				refreshGraph(chart, source, cursor, +$(that).data('refreshRate'));
+			}
 		}
 	}).fail(function(data) {
 		console.log(data);
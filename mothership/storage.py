@@ -0,0 +1,254 @@
+"""
+Where campaign files (executables, libraries, testcases, queue tars and crashes) are kept.
+
+Files are addressed by '/' separated keys, starting with the campaign's secure_filename for campaign files. Two
+backends are available, chosen with STORAGE_BACKEND:
+
+	local - files under DATA_DIRECTORY on the mothership's own disk
+	s3    - objects in the S3_BUCKET of an S3 compatible object store (AWS, MinIO, ...), optionally under S3_PREFIX.
+	        Downloads are redirected to presigned URLs so that their bytes never pass through the mothership, and
+	        several mothership processes or hosts can share the same files. Requires boto3
+
+Older crashes store the absolute path of their file rather than a key, which the local backend still resolves.
+"""
+import contextlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+
+from flask import current_app, redirect, send_file
+from werkzeug.utils import secure_filename
+
+from mothership.clone import clone, unshare
+
+try:
+	import boto3
+except ImportError:
+	boto3 = None
+
+
+def campaign_key(campaign_name, *parts):
+	return '/'.join((secure_filename(campaign_name),) + parts)
+
+
+def add_to_tar(tar, name, f, size):
+	info = tarfile.TarInfo(name)
+	info.size = size
+	info.mode = 0o644
+	tar.addfile(info, f)
+
+
+class LocalStorage:
+
+	def __init__(self, root, hardlinks=True):
+		self.root = root
+		self.hardlinks = hardlinks
+		os.makedirs(root, exist_ok=True)
+
+	def path(self, key):
+		return os.path.join(self.root, key)
+
+	def save(self, key, f):
+		"""
+		Write the contents of the file object (or werkzeug FileStorage) f to key
+		"""
+		path = self.path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		# the file may be hardlinked to a copied campaign's
+		unshare(path)
+		with open(path, 'wb') as dest:
+			shutil.copyfileobj(getattr(f, 'stream', f), dest)
+
+	def open(self, key):
+		return open(self.path(key), 'rb')
+
+	def exists(self, key):
+		""" :return: whether key is a file or there are any files under it """
+		return os.path.exists(self.path(key))
+
+	def size(self, key):
+		""" :return: the size of key, or the total size of the files under it """
+		path = self.path(key)
+		if not os.path.exists(path):
+			return 0
+		if not os.path.isdir(path):
+			return os.path.getsize(path)
+		size = 0
+		for root, dirs, files in os.walk(path):
+			for name in files:
+				try:
+					size += os.lstat(os.path.join(root, name)).st_size
+				except FileNotFoundError:
+					pass
+		return size
+
+	def list(self, key):
+		""" :return: the names of the files directly under key """
+		try:
+			return sorted(name for name in os.listdir(self.path(key)) if os.path.isfile(os.path.join(self.path(key), name)))
+		except FileNotFoundError:
+			return []
+
+	def delete(self, key):
+		""" Delete key, or everything under it """
+		path = self.path(key)
+		if os.path.isdir(path):
+			shutil.rmtree(path, ignore_errors=True)
+		elif os.path.exists(path):
+			os.remove(path)
+
+	def copy(self, source, dest):
+		""" Copy source, or everything under it, to dest """
+		os.makedirs(os.path.dirname(self.path(dest)), exist_ok=True)
+		clone(self.path(source), self.path(dest), hardlinks=self.hardlinks)
+
+	def serve(self, key):
+		return send_file(os.path.abspath(self.path(key)))
+
+	def tar(self, key, arcname):
+		""" :return: an uncompressed tar of everything under key, with its files under arcname """
+		data = io.BytesIO()
+		os.makedirs(self.path(key), exist_ok=True)
+		with tarfile.open(fileobj=data, mode='w:') as tar:
+			tar.add(self.path(key), arcname=arcname)
+		data.seek(0)
+		return data
+
+	@contextlib.contextmanager
+	def local(self, key):
+		""" Get a path on the local disk to key (or the files under it) for use with other programs """
+		yield self.path(key)
+
+
+class S3Storage:
+
+	def __init__(self, bucket, prefix='', url_expiry=60 * 60, **client_args):
+		if not boto3:
+			raise ImportError('boto3 is required for STORAGE_BACKEND = "s3"')
+		self.client = boto3.client('s3', **client_args)
+		self.bucket = bucket
+		self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+		self.url_expiry = url_expiry
+
+	def name(self, key):
+		return self.prefix + key.lstrip('/')
+
+	def objects(self, key):
+		""" :return: the objects (as returned by list_objects_v2) under the key directory """
+		paginator = self.client.get_paginator('list_objects_v2')
+		for page in paginator.paginate(Bucket=self.bucket, Prefix=self.name(key).rstrip('/') + '/'):
+			for obj in page.get('Contents', []):
+				yield obj
+
+	def relative(self, obj, key):
+		return obj['Key'][len(self.name(key).rstrip('/')) + 1:]
+
+	def save(self, key, f):
+		self.client.upload_fileobj(getattr(f, 'stream', f), self.bucket, self.name(key))
+
+	def open(self, key):
+		return self.client.get_object(Bucket=self.bucket, Key=self.name(key))['Body']
+
+	def open_object(self, obj):
+		return self.client.get_object(Bucket=self.bucket, Key=obj['Key'])['Body']
+
+	def head(self, key):
+		try:
+			return self.client.head_object(Bucket=self.bucket, Key=self.name(key))
+		except self.client.exceptions.ClientError as e:
+			if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+				return None
+			raise
+
+	def exists(self, key):
+		return bool(self.head(key)) or any(True for _ in self.objects(key))
+
+	def size(self, key):
+		head = self.head(key)
+		if head:
+			return head['ContentLength']
+		return sum(obj['Size'] for obj in self.objects(key))
+
+	def list(self, key):
+		return sorted(name for name in (self.relative(obj, key) for obj in self.objects(key)) if '/' not in name)
+
+	def delete(self, key):
+		names = [obj['Key'] for obj in self.objects(key)] + [self.name(key)]
+		for i in range(0, len(names), 1000):
+			self.client.delete_objects(Bucket=self.bucket, Delete={
+				'Objects': [{'Key': name} for name in names[i:i + 1000]],
+				'Quiet': True
+			})
+
+	def copy(self, source, dest):
+		if self.head(source):
+			self.client.copy_object(Bucket=self.bucket, Key=self.name(dest), CopySource={'Bucket': self.bucket, 'Key': self.name(source)})
+			return
+		for obj in self.objects(source):
+			self.client.copy_object(
+				Bucket=self.bucket,
+				Key=self.name(dest + '/' + self.relative(obj, source)),
+				CopySource={'Bucket': self.bucket, 'Key': obj['Key']}
+			)
+
+	def serve(self, key):
+		return redirect(self.client.generate_presigned_url(
+			'get_object',
+			Params={'Bucket': self.bucket, 'Key': self.name(key)},
+			ExpiresIn=self.url_expiry
+		))
+
+	def tar(self, key, arcname):
+		data = io.BytesIO()
+		with tarfile.open(fileobj=data, mode='w:') as tar:
+			directory = tarfile.TarInfo(arcname)
+			directory.type = tarfile.DIRTYPE
+			directory.mode = 0o755
+			tar.addfile(directory)
+			for obj in self.objects(key):
+				with contextlib.closing(self.open_object(obj)) as f:
+					add_to_tar(tar, arcname + '/' + self.relative(obj, key), f, obj['Size'])
+		data.seek(0)
+		return data
+
+	@contextlib.contextmanager
+	def local(self, key):
+		with tempfile.TemporaryDirectory(prefix='mothership_') as temp:
+			path = os.path.join(temp, os.path.basename(key.rstrip('/')))
+			if self.head(key):
+				self.client.download_file(self.bucket, self.name(key), path)
+			for obj in self.objects(key):
+				dest = os.path.join(path, self.relative(obj, key))
+				os.makedirs(os.path.dirname(dest), exist_ok=True)
+				self.client.download_file(self.bucket, obj['Key'], dest)
+			yield path
+
+
+def create(config):
+	backend = config['STORAGE_BACKEND']
+	if backend == 'local':
+		return LocalStorage(config['DATA_DIRECTORY'], hardlinks=config['CLONE_HARDLINKS'])
+	elif backend == 's3':
+		return S3Storage(
+			config['S3_BUCKET'],
+			prefix=config['S3_PREFIX'],
+			url_expiry=config['S3_URL_EXPIRY'],
+			endpoint_url=config['S3_ENDPOINT_URL'],
+			region_name=config['S3_REGION'],
+			aws_access_key_id=config['S3_ACCESS_KEY_ID'],
+			aws_secret_access_key=config['S3_SECRET_ACCESS_KEY']
+		)
+	raise ValueError('Unknown STORAGE_BACKEND "%s"' % backend)
+
+
+def init_app(app):
+	app.extensions['mothership_storage'] = create(app.config)
+
+
+def get():
+	"""
+	:return: the current app's storage backend
+	"""
+	return current_app.extensions['mothership_storage']
@@ -0,0 +1,147 @@
+"""
+Maintain each campaign's timeline: the periods during which at least one (non master) fuzzer was producing snapshots.
+
+Graphs are drawn against a timeline with the gaps between periods removed, so a point at unix_time is drawn at
+(unix_time - period.offset). Periods are updated incrementally as fuzzers submit snapshots, so drawing a graph never
+has to sort every fuzzer's start and stop times.
+"""
+from bisect import bisect_right
+
+from sqlalchemy import func
+
+from mothership import models
+from mothership.models import db
+
+
+def set_offsets(periods):
+	running_time = 0
+	for period in periods:
+		period.offset = period.start - running_time
+		running_time += period.stop - period.start
+
+
+def merge(periods):
+	"""
+	Merge overlapping periods (moving their instances into the earlier period) and recompute their offsets
+
+	:return: the remaining periods in order
+	"""
+	periods = sorted(periods, key=lambda p: p.start)
+	merged = []
+	for period in periods:
+		if merged and period.start <= merged[-1].stop:
+			previous = merged[-1]
+			previous.stop = max(previous.stop, period.stop)
+			db.session.flush()
+			models.FuzzerInstance.query.filter_by(period_id=period.id).update({models.FuzzerInstance.period_id: previous.id}, synchronize_session=False)
+			db.session.delete(period)
+		else:
+			merged.append(period)
+	set_offsets(merged)
+	return merged
+
+
+def rebuild(campaign, commit=True):
+	"""
+	Rebuild the timeline of a campaign from its snapshots
+	"""
+	instance = models.FuzzerInstance
+	snapshot = models.FuzzerSnapshot
+	models.ActivityPeriod.query.filter_by(campaign_id=campaign.id).delete(synchronize_session=False)
+	instance.query.filter_by(campaign_id=campaign.id).update({instance.period_id: None, instance.first_snapshot: None, instance.last_snapshot: None}, synchronize_session=False)
+
+	intervals = db.session.query(instance.id, instance.master, func.min(snapshot.unix_time), func.max(snapshot.unix_time)).join(
+		snapshot, snapshot.instance_id == instance.id
+	).filter(instance.campaign_id == campaign.id).group_by(instance.id, instance.master).all()
+
+	periods = []
+	members = []
+	for instance_id, master, first, last in sorted(intervals, key=lambda i: i[2]):
+		instance.query.filter_by(id=instance_id).update({instance.first_snapshot: first, instance.last_snapshot: last}, synchronize_session=False)
+		if master:
+			continue
+		if periods and first <= periods[-1].stop:
+			periods[-1].stop = max(periods[-1].stop, last)
+		else:
+			periods.append(models.ActivityPeriod(campaign_id=campaign.id, start=first, stop=last))
+			members.append([])
+		members[-1].append(instance_id)
+	set_offsets(periods)
+	for period, instance_ids in zip(periods, members):
+		db.session.add(period)
+		db.session.flush()
+		instance.query.filter(instance.id.in_(instance_ids)).update({instance.period_id: period.id}, synchronize_session=False)
+	campaign.timeline_built = True
+	if commit:
+		db.session.commit()
+
+
+def record(instance, times, commit=True):
+	"""
+	Update the timeline of an instance's campaign with newly submitted snapshot times
+
+	:param commit: False to leave committing to the caller, e.g. when ingesting a batch of submissions
+	"""
+	if not times:
+		return
+	campaign = instance.campaign
+	if not campaign.timeline_built:
+		db.session.flush()
+		rebuild(campaign, commit)
+		return
+
+	first, last = min(times), max(times)
+	instance.first_snapshot = first if instance.first_snapshot is None else min(instance.first_snapshot, first)
+	instance.last_snapshot = last if instance.last_snapshot is None else max(instance.last_snapshot, last)
+	if instance.master:
+		if commit:
+			instance.commit()
+		return
+
+	periods = models.ActivityPeriod.all(campaign_id=campaign.id).all()
+	period = None
+	for p in periods:
+		if p.id == instance.period_id or (instance.period_id is None and p.start <= instance.last_snapshot and p.stop >= instance.first_snapshot):
+			period = p
+			break
+	if period:
+		period.start = min(period.start, instance.first_snapshot)
+		period.stop = max(period.stop, instance.last_snapshot)
+	else:
+		period = models.ActivityPeriod(campaign_id=campaign.id, start=instance.first_snapshot, stop=instance.last_snapshot)
+		db.session.add(period)
+		periods.append(period)
+	db.session.flush()
+	instance.period_id = period.id
+	merge(periods)
+	if commit:
+		db.session.commit()
+
+
+def activity_periods(campaign):
+	"""
+	:return: the activity periods of a campaign in order
+	"""
+	if not campaign.timeline_built:
+		rebuild(campaign)
+	return models.ActivityPeriod.all(campaign_id=campaign.id).order_by(models.ActivityPeriod.start).all()
+
+
+def periods(campaign):
+	"""
+	:return: the activity periods of a campaign in order, each paired with the (non master) instances that ran in it
+	"""
+	campaign_periods = activity_periods(campaign)
+	instances = {}
+	for instance in campaign.fuzzers.filter(models.FuzzerInstance.period_id.isnot(None)).order_by(models.FuzzerInstance.first_snapshot):
+		instances.setdefault(instance.period_id, []).append(instance)
+	return [(period, instances.get(period.id, [])) for period in campaign_periods]
+
+
+def place(periods, times):
+	"""
+	:return: the position of each time on the timeline, using the period it falls in (or the last period starting
+	before it)
+	"""
+	starts = [period.start for period in periods]
+	return [t - periods[max(bisect_right(starts, t) - 1, 0)].offset for t in times]
@@ -27,7 +27,7 @@ active = True
 class AflMasterInstance(AflInstance):
 
 	def get_args(self, sync_dir, testcases):
-		return [os.path.join(self.afl_directory, './afl-fuzz'), '-i', testcases, '-o', sync_dir, '-M', self.name] + self.afl_args
+		return [os.path.join(self.afl_directory, './afl-fuzz'), '-i', self.input_dir(sync_dir, testcases), '-o', sync_dir, '-M', self.name] + self.afl_args
 
 class MothershipMaster(MothershipSlave):
 
@@ -67,9 +67,13 @@ class MothershipMaster(MothershipSlave):
 		self.submit_timer = threading.Timer(SUBMIT_FREQUENCY, self.submit)
 		self.submit_timer.daemon = True
 
+		self.crash_watcher = CrashWatcher(os.path.join(self.own_dir, 'crashes'), self.submit_crashes, self.forget_crashes)
+
 		self.instance.start()
 		self.upload_timer.start()
 		self.submit_timer.start()
+		self.crash_watcher.start()
+		self.schedule_heartbeat()
 
 	def upload_queue(self):
 		global active
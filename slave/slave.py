@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 from __future__ import print_function
 
+import argparse
+import ctypes
+import ctypes.util
+import json
 import os
+import re
+import select
 import shutil
 import socket
+import struct
 import subprocess
 import sys
 import tarfile
@@ -31,6 +38,13 @@ SHARE_WHEN_POSSIBLE = True
 DEBUG = False
 SUBMIT_FREQUENCY = 60
 SNAPSHOT_FREQUENCY = 60
+RESTART_BACKOFF = 10           # seconds before restarting afl-fuzz after it fails, doubled for each further failure...
+RESTART_BACKOFF_MAX = 60 * 10
+MAX_FAILURES = 5               # ...until it fails this many times in a row, when its core is given back
+STABLE_RUNTIME = 60 * 10       # afl-fuzz that ran for this long before exiting starts counting failures again
+CRASH_BATCH_DELAY = 2          # seconds to wait for the rest of a burst of crashes before submitting them
+CRASH_BATCH_SIZE = 50          # most crashes to submit in one request
+CRASH_POLL_FREQUENCY = 5       # how often to look for new crashes when inotify is not available
 
 
 class tempdir:
@@ -46,6 +60,92 @@ class tempdir:
 		shutil.rmtree(self.dir)
 
 
+class keepdir:
+	""" Like tempdir, but for a directory that is kept between runs """
+	def __init__(self, path):
+		self.path = path
+
+	def __enter__(self):
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
+		return self.path
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		pass
+
+
+def parse_size(size):
+	""" Parse a size such as 512M or 2G into bytes """
+	units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+	if size[-1:].upper() in units:
+		return int(float(size[:-1]) * units[size[-1].upper()])
+	return int(size)
+
+
+class tmpfs:
+	"""
+	A size capped tmpfs to work in. Mounting one needs root, otherwise a directory in /dev/shm is used, which shares
+	its space with the rest of the host so the cap is only checked (and warned about) when queues are persisted
+	"""
+	def __init__(self, workingdir, size, prefix='tmp'):
+		self.workingdir = workingdir
+		self.size = size
+		self.prefix = prefix
+		self.mounted = False
+
+	def __enter__(self):
+		self.dir = tempfile.mkdtemp(prefix=self.prefix, dir=self.workingdir)
+		with open(os.devnull, 'wb') as devnull:
+			self.mounted = subprocess.call(['mount', '-t', 'tmpfs', '-o', 'size=%s' % self.size, 'tmpfs', self.dir], stdout=devnull, stderr=devnull) == 0
+		if not self.mounted:
+			os.rmdir(self.dir)
+			self.dir = tempfile.mkdtemp(prefix=self.prefix, dir='/dev/shm')
+			logger.warn('Could not mount a tmpfs, using %s instead' % self.dir)
+		return self.dir
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		if self.mounted:
+			subprocess.call(['umount', self.dir])
+			os.rmdir(self.dir)
+		else:
+			shutil.rmtree(self.dir)
+
+	def check_size(self):
+		if not self.mounted and directory_size(self.dir) > parse_size(self.size):
+			logger.warn('%s has grown larger than %s' % (self.dir, self.size))
+
+
+def copy_new_files(src, dst):
+	"""
+	Copy the files directly in src that are not yet in dst. AFL never modifies a queue entry once it is written, so
+	only new entries need to be copied
+	"""
+	if not os.path.isdir(src):
+		return
+	if not os.path.isdir(dst):
+		os.makedirs(dst)
+	existing = set(os.listdir(dst))
+	for name in os.listdir(src):
+		src_path = os.path.join(src, name)
+		if name in existing or not os.path.isfile(src_path):
+			continue
+		shutil.copy2(src_path, os.path.join(dst, '.' + name + '.partial'))
+		os.rename(os.path.join(dst, '.' + name + '.partial'), os.path.join(dst, name))
+
+
+def restore_queues(persist_dir, sync_dir, skip_dirs):
+	"""
+	Restore the persisted queues of fuzzers from previous runs into the sync dir, where the new fuzzers import them
+	"""
+	if not os.path.isdir(persist_dir):
+		return
+	for name in os.listdir(persist_dir):
+		if name in skip_dirs:
+			continue
+		logger.info('Restoring persisted queue of %s' % name)
+		copy_new_files(os.path.join(persist_dir, name, 'queue'), os.path.join(sync_dir, name, 'queue'))
+
+
 def optimistic_parse(value):
 	for t in [int, float]:
 		try:
@@ -57,9 +157,326 @@ def optimistic_parse(value):
 	return value
 
 
+def read_proc(pid, name):
+	with open('/proc/%d/%s' % (pid, name)) as f:
+		return f.read()
+
+
+def process_tree(pid):
+	"""
+	:return: the pid and the pids of all descendants of a process
+	"""
+	parents = {}
+	for entry in os.listdir('/proc'):
+		if not entry.isdigit():
+			continue
+		try:
+			stat = read_proc(int(entry), 'stat')
+		except (IOError, OSError):
+			continue
+		parents.setdefault(int(stat.rsplit(')', 1)[1].split()[1]), []).append(int(entry))
+	tree = [pid]
+	for p in tree:
+		tree.extend(parents.get(p, []))
+	return tree
+
+
+def sample_process(pid):
+	"""
+	:return: the cpu seconds (including waited for children), resident memory, disk io and context switches of a process
+	"""
+	sample = dict(cpu=0., rss_kb=0, read_bytes=0, write_bytes=0, ctx_switches=0)
+	fields = read_proc(pid, 'stat').rsplit(')', 1)[1].split()
+	# utime, stime, cutime, cstime
+	sample['cpu'] = sum(int(v) for v in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+	for line in read_proc(pid, 'status').splitlines():
+		key, _, value = line.partition(':')
+		if key == 'VmRSS':
+			sample['rss_kb'] = int(value.split()[0])
+		elif key in ('voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches'):
+			sample['ctx_switches'] += int(value)
+	try:
+		for line in read_proc(pid, 'io').splitlines():
+			key, _, value = line.partition(':')
+			if key in ('read_bytes', 'write_bytes'):
+				sample[key] = int(value)
+	except (IOError, OSError):
+		pass
+	return sample
+
+
+def directory_size(path):
+	size = 0
+	for root, dirs, files in os.walk(path):
+		for name in files:
+			try:
+				size += os.lstat(os.path.join(root, name)).st_size
+			except OSError:
+				pass
+	return size
+
+
+class Telemetry:
+	"""
+	Sample the resource usage of an afl-fuzz process and everything it has forked from /proc. The size of sync_dir,
+	which holds every fuzzer's queue, is only measured every size_interval seconds as walking it is costly
+	"""
+
+	def __init__(self, sync_dir, size_interval):
+		self.sync_dir = sync_dir
+		self.size_interval = size_interval
+		self.sync_dir_bytes = 0
+		self.sized = None
+		self.last = None
+		self.last_time = None
+
+	def sample(self, pid):
+		totals = dict(cpu=0., rss_kb=0, read_bytes=0, write_bytes=0, ctx_switches=0)
+		for p in process_tree(pid):
+			try:
+				for k, v in sample_process(p).items():
+					totals[k] += v
+			except (IOError, OSError):
+				# the process exited while we were reading it
+				pass
+		now = time.time()
+		if self.sized is None or now - self.sized >= self.size_interval:
+			self.sync_dir_bytes, self.sized = directory_size(self.sync_dir), now
+		telemetry = dict(rss_kb=totals['rss_kb'], sync_dir_bytes=self.sync_dir_bytes)
+		if self.last:
+			elapsed = now - self.last_time
+			telemetry['cpu_percent'] = max(totals['cpu'] - self.last['cpu'], 0) / elapsed * 100
+			for k in ['read_bytes', 'write_bytes', 'ctx_switches']:
+				telemetry[k + '_per_sec'] = max(totals[k] - self.last[k], 0) / elapsed
+		self.last, self.last_time = totals, now
+		return telemetry
+
+
+def parse_cpu_list(cpu_list):
+	""" Parse a kernel cpu list such as 0-3,8-11 """
+	cpus = []
+	for part in cpu_list.strip().split(','):
+		if not part:
+			continue
+		if '-' in part:
+			start, stop = part.split('-')
+			cpus.extend(range(int(start), int(stop) + 1))
+		else:
+			cpus.append(int(part))
+	return cpus
+
+
+def cpu_topology():
+	"""
+	:return: {cpu: (package, core)} for every online cpu this process may run on
+	"""
+	base = '/sys/devices/system/cpu'
+	with open(os.path.join(base, 'online')) as f:
+		cpus = parse_cpu_list(f.read())
+	if hasattr(os, 'sched_getaffinity'):
+		allowed = os.sched_getaffinity(0)
+		cpus = [cpu for cpu in cpus if cpu in allowed]
+	topology = {}
+	for cpu in cpus:
+		try:
+			with open(os.path.join(base, 'cpu%d' % cpu, 'topology', 'physical_package_id')) as f:
+				package = int(f.read())
+			with open(os.path.join(base, 'cpu%d' % cpu, 'topology', 'core_id')) as f:
+				core = int(f.read())
+		except (IOError, OSError, ValueError):
+			package, core = 0, cpu
+		topology[cpu] = package, core
+	return topology
+
+
+def cpu_times():
+	times = {}
+	with open('/proc/stat') as f:
+		for line in f:
+			fields = line.split()
+			if fields[0].startswith('cpu') and fields[0] != 'cpu':
+				values = [int(v) for v in fields[1:]]
+				# idle + iowait
+				times[int(fields[0][3:])] = sum(values), values[3] + values[4]
+	return times
+
+
+def busy_cpus(interval=1, threshold=0.5):
+	"""
+	:return: the cpus that were more than threshold busy over interval seconds
+	"""
+	before = cpu_times()
+	time.sleep(interval)
+	after = cpu_times()
+	busy = set()
+	for cpu, (total, idle) in after.items():
+		if cpu not in before:
+			continue
+		elapsed = total - before[cpu][0]
+		if elapsed and 1 - (idle - before[cpu][1]) / elapsed > threshold:
+			busy.add(cpu)
+	return busy
+
+
+def free_cores():
+	"""
+	Choose one cpu from each physical core that has no busy hyperthreads, so each fuzzer gets a core to itself. Cores
+	are ordered by package so fuzzers fill one socket before the next
+
+	:return: the list of cpus to pin fuzzers to
+	"""
+	try:
+		topology = cpu_topology()
+		busy = busy_cpus()
+	except (IOError, OSError) as e:
+		logger.warn('Could not read cpu topology: %s' % e)
+		return []
+	cores = {}
+	for cpu, core in sorted(topology.items()):
+		cores.setdefault(core, []).append(cpu)
+	return [cpus[0] for core, cpus in sorted(cores.items()) if not any(cpu in busy for cpu in cpus)]
+
+
+
+class Inotify:
+	""" Just enough of inotify through ctypes to watch a directory, so the slave needs nothing beyond requests """
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_TO = 0x00000080
+	IN_DELETE_SELF = 0x00000400
+	IN_MOVE_SELF = 0x00000800
+	IN_IGNORED = 0x00008000
+	IN_CLOEXEC = 0o2000000
+	EVENT = struct.Struct('iIII')
+
+	def __init__(self):
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = self.check(self.libc.inotify_init1(self.IN_CLOEXEC))
+
+	def check(self, result):
+		if result < 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno))
+		return result
+
+	def add_watch(self, path, mask):
+		return self.check(self.libc.inotify_add_watch(self.fd, path.encode(), mask))
+
+	def rm_watch(self, wd):
+		self.libc.inotify_rm_watch(self.fd, wd)
+
+	def read(self, timeout):
+		"""
+		:return: the (watch, mask, name) of each event, waiting up to timeout seconds for the first
+		"""
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return []
+		data = os.read(self.fd, 64 * 1024)
+		events = []
+		position = 0
+		while position < len(data):
+			wd, mask, cookie, length = self.EVENT.unpack_from(data, position)
+			position += self.EVENT.size
+			events.append((wd, mask, data[position:position + length].rstrip(b'\0').decode()))
+			position += length
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+
+class CrashWatcher(threading.Thread):
+	"""
+	Pass the crashes afl-fuzz saves in crash_dir to submit within seconds, in batches. New crashes are noticed with
+	inotify, or by polling crash_dir where inotify is not available. submit returns the crashes it could not submit,
+	which are retried with the next batch. reset is called when crash_dir is moved or deleted, as the crashes of the
+	directory that replaces it are numbered from the start again
+	"""
+
+	def __init__(self, crash_dir, submit, reset=None):
+		super(CrashWatcher, self).__init__()
+		self.daemon = True
+		self.crash_dir = crash_dir
+		self.submit = submit
+		self.reset = reset
+		self.pending = set()
+		self.inode = None
+		self.stopping = threading.Event()
+
+	def scan(self):
+		if os.path.isdir(self.crash_dir):
+			self.pending.update(os.listdir(self.crash_dir))
+
+	def replaced(self):
+		"""
+		:return: whether crash_dir has been moved or deleted since the last call, for when it is polled
+		"""
+		try:
+			inode = os.stat(self.crash_dir).st_ino
+		except OSError:
+			inode = None
+		replaced = self.inode is not None and inode != self.inode
+		self.inode = inode
+		return replaced
+
+	def restarted(self):
+		# crashes still pending are kept: submit skips those that were moved aside along with the directory, and submits
+		# those the new directory has a crash of the same name for
+		if self.reset:
+			self.reset()
+
+	def flush(self):
+		if self.pending:
+			self.pending = set(self.submit(sorted(self.pending)))
+
+	def run(self):
+		try:
+			inotify = Inotify()
+		except (OSError, AttributeError) as e:
+			logger.warn('inotify is not available (%s), polling for crashes instead' % e)
+			inotify = None
+		watch = None
+
+		while not self.stopping.is_set():
+			if inotify and watch is None and os.path.isdir(self.crash_dir):
+				try:
+					watch = inotify.add_watch(self.crash_dir, Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_MOVE_SELF | Inotify.IN_DELETE_SELF)
+				except OSError as e:
+					logger.warn('Could not watch %s: %s' % (self.crash_dir, e))
+				# crashes saved before the watch was added
+				self.scan()
+
+			if watch is None:
+				self.stopping.wait(CRASH_POLL_FREQUENCY)
+				if self.replaced():
+					self.restarted()
+				self.scan()
+			else:
+				events = inotify.read(CRASH_POLL_FREQUENCY)
+				if events:
+					# afl-fuzz tends to save crashes in bursts
+					self.stopping.wait(CRASH_BATCH_DELAY)
+					events += inotify.read(0)
+				for wd, mask, name in events:
+					if wd != watch:
+						continue
+					if mask & (Inotify.IN_MOVE_SELF | Inotify.IN_DELETE_SELF | Inotify.IN_IGNORED):
+						# afl-fuzz moves its crashes aside when it is restarted, so watch the new directory instead
+						inotify.rm_watch(watch)
+						watch = None
+						self.restarted()
+					elif name:
+						self.pending.add(name)
+			self.flush()
+
+		if inotify:
+			inotify.close()
+		self.scan()
+		self.flush()
+
+
 class AflInstance(threading.Thread):
 
-	def __init__(self, afl_directory, campaign_directory, name, afl_args, program, program_args):
+	def __init__(self, afl_directory, campaign_directory, name, afl_args, program, program_args, cpu=None, resume=False):
 		super(AflInstance, self).__init__()
 
 		self.afl_directory = afl_directory
@@ -73,10 +490,69 @@ class AflInstance(threading.Thread):
 		self.program_args = []
 		for arg in program_args:
 			self.program_args.append(arg.replace('%%', campaign_directory))
+		self.cpu = cpu
+		self.resume = resume
 
 		self.process = None
+		self.restarts = 0
+		self.exit_reason = None
+		self.failed = False
+		self.on_failure = None
+		self.stopping = False
+		self.wakeup = threading.Event()
 
 	def run(self):
+		"""
+		Run afl-fuzz, restarting it (resuming its queue) with exponential backoff whenever it exits. After MAX_FAILURES
+		failures in a row give up and call on_failure
+		"""
+		failures = 0
+		while not self.stopping:
+			started = time.time()
+			self.launch()
+			print('waiting on', self.process)
+			self.process.wait()
+			print('done waiting on', self.process)
+			if self.stopping:
+				return
+			self.exit_reason = self.describe_exit()
+			logger.warn('afl-fuzz for %s %s' % (self.name, self.exit_reason))
+			if time.time() - started > STABLE_RUNTIME:
+				failures = 0
+			failures += 1
+			if failures >= MAX_FAILURES:
+				logger.error('Giving up on %s after %d failures' % (self.name, failures))
+				self.failed = True
+				if self.on_failure:
+					self.on_failure(self.exit_reason)
+				return
+			backoff = min(RESTART_BACKOFF * 2 ** (failures - 1), RESTART_BACKOFF_MAX)
+			logger.info('Restarting %s in %d seconds' % (self.name, backoff))
+			self.wakeup.wait(backoff)
+			self.restarts += 1
+			self.resume = True
+
+	def describe_exit(self):
+		if self.process.returncode < 0:
+			reason = 'was killed by signal %d' % -self.process.returncode
+		else:
+			reason = 'exited with %d' % self.process.returncode
+		if not DEBUG:
+			# afl-fuzz explains why it aborted at the end of its output
+			for log in ['_stdout.txt', '_stderr.txt']:
+				try:
+					with open(os.path.join('./logs', self.name + log), 'rb') as f:
+						f.seek(max(os.path.getsize(f.name) - 4096, 0))
+						lines = [re.sub(r'\x1b\[[0-9;]*m', '', line) for line in f.read().decode('utf-8', 'replace').splitlines()]
+				except (IOError, OSError):
+					continue
+				aborts = [line.strip() for line in lines if 'PROGRAM ABORT' in line]
+				if aborts:
+					reason += ': ' + aborts[-1]
+					break
+		return reason
+
+	def launch(self):
 		testcases = os.path.join(self.campaign_directory, 'testcases')
 		sync_dir = os.path.join(self.campaign_directory, 'sync_dir')
 		dictionary = os.path.join(self.campaign_directory, 'dictionary.txt')
@@ -100,27 +576,38 @@ class AflInstance(threading.Thread):
 			env['AFL_PRELOAD'] = os.path.join(self.campaign_directory, 'ld_preload', preload) + ' '
 		env['AFL_SKIP_CPUFREQ'] = 'True'
 		# env['AFL_NO_VAR_CHECK'] = 'True'
+		preexec_fn = None
+		if self.cpu is not None:
+			# stop afl-fuzz from choosing its own core
+			env['AFL_NO_AFFINITY'] = '1'
+			cpu = self.cpu
+			preexec_fn = lambda: os.sched_setaffinity(0, {cpu})
+			logger.info('Pinning %s to cpu %d' % (self.name, cpu))
 		if DEBUG:
-			self.process = subprocess.Popen(args, env=env, cwd=self.campaign_directory)
+			self.process = subprocess.Popen(args, env=env, cwd=self.campaign_directory, preexec_fn=preexec_fn)
 		else:
 			self.process = subprocess.Popen(args,
-			                                stdout=open(os.path.join('./logs', self.name + '_stdout.txt'), 'wb'),
-			                                stderr=open(os.path.join('./logs', self.name + '_stderr.txt'), 'wb'),
+			                                stdout=open(os.path.join('./logs', self.name + '_stdout.txt'), 'ab'),
+			                                stderr=open(os.path.join('./logs', self.name + '_stderr.txt'), 'ab'),
 			                                env=env,
-			                                cwd=self.campaign_directory
+			                                cwd=self.campaign_directory,
+			                                preexec_fn=preexec_fn
 			                                )
 
-		print('waiting on', self.process)
-		self.process.wait()
-		print('done waiting on', self.process)
-		if self.process.returncode != 0:
-			raise Exception("Process exited with %d" % self.process.returncode)
+	def input_dir(self, sync_dir, testcases):
+		# afl-fuzz resumes from its previous queue when given -i-
+		if self.resume and os.path.isdir(os.path.join(sync_dir, self.name, 'queue')):
+			return '-'
+		return testcases
 
 	def get_args(self, sync_dir, testcases):
-		return [os.path.join(self.afl_directory, './afl-fuzz'), '-i', testcases, '-o', sync_dir, '-S', self.name] + self.afl_args
+		return [os.path.join(self.afl_directory, './afl-fuzz'), '-i', self.input_dir(sync_dir, testcases), '-o', sync_dir, '-S', self.name] + self.afl_args
 
 	def terminate(self):
-		self.process.terminate()
+		self.stopping = True
+		self.wakeup.set()
+		if self.process and self.process.poll() is None:
+			self.process.terminate()
 
 
 class MothershipSlave:
@@ -128,7 +615,10 @@ class MothershipSlave:
 	def register(self, mothership_url):
 		try:
 			logger.info('Registering slave')
-			request = requests.get(mothership_url + '/fuzzers/register?hostname=%s' % socket.gethostname())
+			url = mothership_url + '/fuzzers/register?hostname=%s' % socket.gethostname()
+			if self.cpu is not None:
+				url += '&cpu=%d' % self.cpu
+			request = requests.get(url)
 			if request.status_code == 404:
 				logger.error('No more campaigns requiring fuzzers')
 				return None
@@ -136,10 +626,31 @@ class MothershipSlave:
 		except requests.ConnectionError as e:
 			raise Exception('Could not connect to %s' % mothership_url, e)
 
-	def __init__(self, mothership_url, directory):
+	def reattach(self, mothership_url, instance_id):
+		try:
+			logger.info('Reattaching to instance %d' % instance_id)
+			url = mothership_url + '/fuzzers/reattach/%d' % instance_id
+			if self.cpu is not None:
+				url += '?cpu=%d' % self.cpu
+			request = requests.get(url)
+			if request.status_code != 200:
+				logger.warn('Could not reattach to instance %d: %s' % (instance_id, request.text))
+				return None
+			return request.json()
+		except requests.ConnectionError as e:
+			raise Exception('Could not connect to %s' % mothership_url, e)
+
+	def __init__(self, mothership_url, directory, cpu=None, state_dir=None, instance_id=None):
 		self.mothership_url = mothership_url
 		self.directory = directory
+		self.cpu = cpu
+		self.state_dir = state_dir
+		self.resumed = False
+		self.failed = False
+		self.persist_dir = None
+		self.tmpfs = None
 		self.submitted_crashes = {'README.txt'}
+		self.state_lock = threading.Lock()
 		self.snapshot_times = set()
 		self.snapshot_tell = 0
 		self.last_snapshot = 0
@@ -148,8 +659,20 @@ class MothershipSlave:
 		self.instance = None
 		self.upload_timer = None
 		self.submit_timer = None
-
-		instance_params = self.register(mothership_url)
+		self.heartbeat_timer = None
+		self.crash_watcher = None
+		self.stopped = False
+
+		instance_params = None
+		if instance_id is not None:
+			instance_params = self.reattach(mothership_url, instance_id)
+			if instance_params:
+				self.resumed = True
+				self.load_state(instance_id)
+			else:
+				self.delete_state(instance_id)
+		if not instance_params:
+			instance_params = self.register(mothership_url)
 		if not instance_params:
 			self.valid = False
 			return
@@ -158,6 +681,7 @@ class MothershipSlave:
 
 		self.id = instance_params['id']
 		logger.info('Slave registered with id=%d' % self.id)
+		self.save_state()
 
 		self.name = instance_params['name']
 		self.campaign_name = instance_params['campaign_name']
@@ -166,6 +690,8 @@ class MothershipSlave:
 		self.upload_url = instance_params['upload']
 		self.submit_url = instance_params['submit']
 		self.submit_crash = instance_params['submit_crash']
+		self.heartbeat_url = instance_params.get('heartbeat')
+		self.heartbeat_in = instance_params.get('heartbeat_in', 15)
 
 		self.program = instance_params['program']
 		self.program_args = instance_params['program_args']
@@ -178,6 +704,8 @@ class MothershipSlave:
 		self.testcases = os.path.join(self.campaign_directory, 'testcases')
 		self.sync_dir = os.path.join(self.campaign_directory, 'sync_dir')
 		self.own_dir = os.path.join(self.sync_dir, self.name)
+		# sync_dir is sized at most as often as the queue is uploaded
+		self.telemetry = Telemetry(self.sync_dir, self.upload_in)
 
 		self.instance = None
 		self.upload_timer = None
@@ -197,8 +725,11 @@ class MothershipSlave:
 
 			self.program,
 			self.program_args,
+			cpu=self.cpu,
+			resume=self.resumed
 		)
 		self.instance.daemon = True
+		self.instance.on_failure = self.give_up
 
 		logger.info('Upload in %d', self.upload_in )
 		self.upload_timer = threading.Timer(self.upload_in, self.upload_queue)
@@ -207,14 +738,98 @@ class MothershipSlave:
 		self.submit_timer = threading.Timer(SUBMIT_FREQUENCY, self.submit)
 		self.submit_timer.daemon = True
 
+		self.crash_watcher = CrashWatcher(os.path.join(self.own_dir, 'crashes'), self.submit_crashes, self.forget_crashes)
+
 		self.instance.start()
 		self.upload_timer.start()
 		self.submit_timer.start()
+		self.crash_watcher.start()
+		self.schedule_heartbeat()
+
+	def state_path(self, instance_id):
+		return os.path.join(self.state_dir, 'instances', '%d.json' % instance_id)
+
+	def load_state(self, instance_id):
+		try:
+			with open(self.state_path(instance_id)) as f:
+				state = json.load(f)
+		except (IOError, OSError, ValueError) as e:
+			logger.warn('Could not load the state of instance %d: %s' % (instance_id, e))
+			return
+		self.snapshot_tell = state['snapshot_tell']
+		self.last_snapshot = state['last_snapshot']
+		self.submitted_crashes = set(state['submitted_crashes'])
+
+	def save_state(self):
+		"""
+		Save what has been submitted so a restarted slave can reattach to this instance without submitting it again
+		"""
+		if not self.state_dir:
+			return
+		path = self.state_path(self.id)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		# saved from both the submit timer and the crash watcher
+		with self.state_lock:
+			with open(path + '.partial', 'w') as f:
+				json.dump(dict(
+					snapshot_tell=self.snapshot_tell,
+					last_snapshot=self.last_snapshot,
+					submitted_crashes=sorted(self.submitted_crashes)
+				), f)
+			os.rename(path + '.partial', path)
+
+	def delete_state(self, instance_id):
+		if self.state_dir and os.path.exists(self.state_path(instance_id)):
+			os.remove(self.state_path(instance_id))
+
+	def schedule_heartbeat(self):
+		if not self.heartbeat_url or self.stopped:
+			return
+		self.heartbeat_timer = threading.Timer(self.heartbeat_in, self.heartbeat)
+		self.heartbeat_timer.daemon = True
+		self.heartbeat_timer.start()
+
+	def heartbeat(self):
+		try:
+			if requests.post(self.heartbeat_url).json()['terminate']:
+				self.stop()
+				return
+		except Exception as e:
+			logger.warn(e)
+		self.schedule_heartbeat()
+
+	def give_up(self, reason):
+		""" afl-fuzz keeps failing, so stop this instance and let run_slaves use the core for something else """
+		self.failed = True
+		self.stop(reason)
+
+	def stop(self, reason=None):
+		logger.warn('Terminating instance %d' % self.id)
+		self.stopped = True
+		self.delete_state(self.id)
+		requests.post('%s/fuzzers/terminate/%d' % (self.mothership_url, self.id), json={'reason': reason})
+		self.instance.terminate()
+		for timer in [self.upload_timer, self.submit_timer, self.heartbeat_timer]:
+			if timer:
+				timer.cancel()
+		if self.crash_watcher:
+			self.crash_watcher.stopping.set()
+
+	def persist_queue(self):
+		if not self.persist_dir:
+			return
+		logger.info('Persisting queue to %s' % self.persist_dir)
+		copy_new_files(os.path.join(self.own_dir, 'queue'), os.path.join(self.persist_dir, 'queue'))
+		if self.tmpfs:
+			self.tmpfs.check_size()
 
 	def upload_queue(self):
 		logger.info('Uploading queue')
 
 		try:
+			self.persist_queue()
+
 			def state_filter(tarinfo):
 				if '.state' in tarinfo.name:
 					return None
@@ -241,10 +856,10 @@ class MothershipSlave:
 
 	def submit(self):
 		logger.info('Submitting status')
+		submit_in = SUBMIT_FREQUENCY
 
 		status_file = os.path.join(self.own_dir, 'fuzzer_stats')
 		plot_file = os.path.join(self.own_dir, 'plot_data')
-		crash_dir = os.path.join(self.own_dir, 'crashes')
 
 		try:
 			status = {}
@@ -256,52 +871,113 @@ class MothershipSlave:
 			# FIXME: there is an where process is sometimes None and this doesn't work even though the process is running on the host
 			logger.info('%d - %r' % (self.id, status))
 
-			snapshots = []
+			# only remembered as submitted once the mothership has accepted them
+			snapshots, snapshot_times = [], set()
+			snapshot_tell, last_snapshot = self.snapshot_tell, self.last_snapshot
+			if snapshot_tell > os.path.getsize(plot_file):
+				# afl-fuzz starts a new plot_data when it resumes
+				snapshot_tell = 0
 			with open(plot_file, 'r') as f:
 				keys = f.readline()[2:-1].split(', ')
-				if self.snapshot_tell:
-					f.seek(self.snapshot_tell)
+				if snapshot_tell:
+					f.seek(snapshot_tell)
 				for line in f.readlines():
 					values = line[:-1].split(', ')
-					if values[0] not in self.snapshot_times:
-						self.snapshot_times.add(values[0])
+					if values[0] not in self.snapshot_times and values[0] not in snapshot_times:
+						snapshot_times.add(values[0])
 						values[6] = values[6][:-1]
 						values = [optimistic_parse(v) for v in values]
-						if values[0] - self.last_snapshot > SNAPSHOT_FREQUENCY:
-							self.last_snapshot = values[0]
+						if values[0] - last_snapshot > SNAPSHOT_FREQUENCY:
+							last_snapshot = values[0]
 							snapshots.append(dict(zip(keys, values)))
-				self.snapshot_tell = f.tell()
+				snapshot_tell = f.tell()
+
+			telemetry = {}
+			try:
+				if self.instance and self.instance.process:
+					telemetry = self.telemetry.sample(self.instance.process.pid)
+			except Exception as e:
+				logger.warn('Could not sample telemetry: %s' % e)
 
 			response = requests.post(self.submit_url, json={
 				'snapshots': snapshots,
-				'status': status
+				'status': status,
+				'telemetry': telemetry,
+				'supervisor': {
+					'restarts': self.instance.restarts,
+					'exit_reason': self.instance.exit_reason
+				} if self.instance else {}
 			})
+			if response.status_code == 503:
+				# the mothership is behind on writing submissions, send these again later
+				submit_in = response.json().get('retry_in', SUBMIT_FREQUENCY)
+				logger.info('Mothership is busy, retrying submit in %d', submit_in)
+			else:
+				response.raise_for_status()
+				with self.state_lock:
+					self.snapshot_times |= snapshot_times
+					self.snapshot_tell, self.last_snapshot = snapshot_tell, last_snapshot
+				self.save_state()
 
-			for crash_name in os.listdir(crash_dir):
-				if crash_name in self.submitted_crashes:
-					continue
-				self.submitted_crashes.add(crash_name)
-				crash_path = os.path.join(crash_dir, crash_name)
-				logger.info('Submitting crash %s' % crash_name)
-				with open(crash_path, 'rb') as crash_file:
-					requests.post(self.submit_crash + '?time=%d' % os.path.getmtime(crash_path), files={'file': crash_file})
-
-			if response.json()['terminate']:
-				logger.warn('Terminating instance %d' % self.id)
-				requests.post('%s/fuzzers/terminate/%d' % (self.mothership_url, self.id))
-				self.instance.terminate()
-				self.upload_timer.cancel()
-				return
+				if response.json()['terminate']:
+					self.stop()
+					return
 
 		except Exception as e:
 			# File not created yet
 			logger.warn(e)
 			traceback.print_exc()
 
-		self.submit_timer = threading.Timer(SUBMIT_FREQUENCY, self.submit)
+		if self.stopped:
+			return
+		self.submit_timer = threading.Timer(submit_in, self.submit)
 		self.submit_timer.daemon = True
 		self.submit_timer.start()
 
+	def submit_crashes(self, crash_names):
+		"""
+		Submit crashes from the crashes directory, up to CRASH_BATCH_SIZE of them per request
+
+		:return: the crashes that could not be submitted
+		"""
+		crash_dir = os.path.join(self.own_dir, 'crashes')
+		crash_names = [name for name in crash_names if name not in self.submitted_crashes]
+		for i in range(0, len(crash_names), CRASH_BATCH_SIZE):
+			batch = crash_names[i:i + CRASH_BATCH_SIZE]
+			files, times = {}, {}
+			try:
+				for n, crash_name in enumerate(batch):
+					crash_path = os.path.join(crash_dir, crash_name)
+					if not os.path.isfile(crash_path):
+						# moved aside by a restarted afl-fuzz
+						continue
+					field = 'crash%d' % n
+					times[field] = int(os.path.getmtime(crash_path))
+					files[field] = (crash_name, open(crash_path, 'rb'))
+				if files:
+					logger.info('Submitting %d crashes' % len(files))
+					requests.post(self.submit_crash, files=files, data={'times': json.dumps(times)}).raise_for_status()
+			except (IOError, OSError) as e:
+				logger.warn('Could not submit crashes: %s' % e)
+				return crash_names[i:]
+			finally:
+				for crash_name, crash_file in files.values():
+					crash_file.close()
+			with self.state_lock:
+				# not those that were moved aside, as a crash in the new directory may be saved under the same name
+				self.submitted_crashes.update(crash_name for crash_name, crash_file in files.values())
+			self.save_state()
+		return []
+
+	def forget_crashes(self):
+		"""
+		Forget the crashes submitted from a crashes directory afl-fuzz has moved aside, so the set of them doesn't grow
+		across restarts and the new directory's crashes (named from id:000000 again) are submitted
+		"""
+		with self.state_lock:
+			self.submitted_crashes = {'README.txt'}
+		self.save_state()
+
 	def join(self):
 		if self.instance:
 			self.instance.join()
@@ -364,12 +1040,48 @@ def download_afl(mothership_url, directory):
 	os.chmod(afl, 0o755)
 
 
-def run_slaves(mothership_url, count, workingdir):
-	with tempdir(workingdir, 'mothership_afl_') as directory:
+def saved_instances(state_dir):
+	instances_dir = os.path.join(state_dir, 'instances')
+	if not os.path.isdir(instances_dir):
+		return []
+	return sorted(int(name[:-5]) for name in os.listdir(instances_dir) if name.endswith('.json') and name[:-5].isdigit())
+
+
+def run_slaves(mothership_url, count, workingdir, tmpfs_size=None, state_dir=None):
+	"""
+	Start count slaves (by default one per free core), each pinned to a core of its own while there are free cores.
+
+	With tmpfs_size the fuzzers run on a tmpfs of that size. Their queues are persisted to workingdir whenever they
+	are uploaded and restored (as sync dirs for the new fuzzers to import) when the slaves are restarted.
+
+	With state_dir the slaves work in (and keep their state in) that directory instead of a temporary one. Restarted
+	slaves reattach to the instances they were running and afl-fuzz resumes from their previous queues
+	"""
+	cpus = free_cores() if hasattr(os, 'sched_setaffinity') else []
+	if count is None:
+		count = max(len(cpus), 1)
+	if count > len(cpus):
+		logger.warn('Only %d free cores for %d slaves, the rest will not be pinned' % (len(cpus), count))
+	if tmpfs_size:
+		workspace = tmpfs(workingdir, tmpfs_size, 'mothership_afl_')
+	elif state_dir:
+		workspace = keepdir(os.path.join(state_dir, 'work'))
+	else:
+		workspace = tempdir(workingdir, 'mothership_afl_')
+	persist_root = os.path.join(workingdir, 'mothership_queues') if tmpfs_size else None
+	saved = saved_instances(state_dir) if state_dir else []
+	with workspace as directory:
 		logger.info('Starting %d slave(s) in %s' % (count, directory))
 		slaves = []
-		for _ in range(count):
-			slaves.append(MothershipSlave(mothership_url, directory))
+		for i in range(count):
+			slave = MothershipSlave(
+				mothership_url,
+				directory,
+				cpu=cpus[i] if i < len(cpus) else None,
+				state_dir=state_dir,
+				instance_id=saved[i] if i < len(saved) else None
+			)
+			slaves.append(slave)
 			time.sleep(0.5)
 		campaigns = {slave.campaign_directory: slave for slave in slaves if slave.valid}
 
@@ -378,49 +1090,73 @@ def run_slaves(mothership_url, count, workingdir):
 			return
 
 		download_afl(mothership_url, directory)
-		for slave in campaigns.values():
-			os.makedirs(slave.campaign_directory)
-			if SHARE_WHEN_POSSIBLE:
-				skip_dirs = [s.name for s in slaves if s.valid and s.campaign_id == slave.campaign_id]
+		skip_dirs = {}
+
+		def prepare(slave):
+			if persist_root:
+				slave.persist_dir = os.path.join(persist_root, slave.campaign_name, slave.name)
+				slave.tmpfs = workspace
+			if slave.campaign_directory in skip_dirs:
+				# the campaign is already downloaded and being synced
+				skip_dirs[slave.campaign_directory].append(slave.name)
 			else:
-				skip_dirs = [slave.name]
-			download_queue(slave.download_url, slave.campaign_directory, skip_dirs, executable_name=slave.program)
-
-		for slave in slaves:
-			if slave.valid:
-				slave.start()
-
-		for slave in slaves:
-			print('waiting on', slave)
-			slave.join()
-			print('finished waiting on', slave)
+				if not os.path.isdir(slave.campaign_directory):
+					os.makedirs(slave.campaign_directory)
+				if SHARE_WHEN_POSSIBLE:
+					skip_dirs[slave.campaign_directory] = [s.name for s in slaves if s.valid and s.campaign_id == slave.campaign_id]
+				else:
+					skip_dirs[slave.campaign_directory] = [slave.name]
+				# a resumed campaign directory already has the executable, libraries and testcases
+				downloaded = os.path.exists(os.path.join(slave.campaign_directory, slave.program))
+				download_queue(slave.download_url, slave.campaign_directory, skip_dirs[slave.campaign_directory], executable_name=None if downloaded else slave.program)
+				if persist_root:
+					restore_queues(os.path.join(persist_root, slave.campaign_name), slave.sync_dir, skip_dirs[slave.campaign_directory])
+			if slave.resumed and slave.persist_dir:
+				copy_new_files(os.path.join(slave.persist_dir, 'queue'), os.path.join(slave.own_dir, 'queue'))
+
+		running = [slave for slave in slaves if slave.valid]
+		for slave in running:
+			prepare(slave)
+		for slave in running:
+			slave.start()
+
+		# give the cores of fuzzers that keep failing to whichever campaign the mothership chooses next
+		while running:
+			time.sleep(10)
+			for slave in list(running):
+				if slave.instance.is_alive():
+					continue
+				running.remove(slave)
+				if not slave.failed:
+					continue
+				logger.info('Registering a new fuzzer in place of %s' % slave.name)
+				replacement = MothershipSlave(mothership_url, directory, cpu=slave.cpu, state_dir=state_dir)
+				if replacement.valid:
+					slaves.append(replacement)
+					prepare(replacement)
+					replacement.start()
+					running.append(replacement)
 
 def main():
-	try:
-		mothership_url = sys.argv[1]
-		if mothership_url.endswith('/'):
-			mothership_url = mothership_url[:-1]
-
-	except IndexError:
-		mothership_url = 'http://localhost:5000'
+	parser = argparse.ArgumentParser(description='Run AFL fuzzers for campaigns managed by a mothership')
+	parser.add_argument('mothership_url', nargs='?', default='http://localhost:5000')
+	parser.add_argument('count', nargs='?', type=int, help='the number of fuzzers to run, defaults to one per free core')
+	parser.add_argument('workingdir', nargs='?', default='/tmp/')
+	parser.add_argument('--tmpfs', metavar='SIZE', help='run the fuzzers on a tmpfs of this size (e.g. 2G), persisting their queues to workingdir')
+	parser.add_argument('--state-dir', help='keep the fuzzers and their state in this directory so they resume when restarted')
+	args = parser.parse_args()
+
+	mothership_url = args.mothership_url
+	if mothership_url.endswith('/'):
+		mothership_url = mothership_url[:-1]
 	if not mothership_url.startswith('http'):
 		mothership_url = 'http://' + mothership_url
 
-	try:
-		count = int(sys.argv[2])
-	except IndexError:
-		count = 1
-
-	try:
-		workingdir = sys.argv[3]
-	except IndexError:
-		workingdir = '/tmp/'
-
 	try:
 		os.mkdir('logs')
 	except:
 		pass
-	run_slaves(mothership_url, count, workingdir)
+	run_slaves(mothership_url, args.count, args.workingdir, args.tmpfs, args.state_dir)
 	logger.info('exiting')
 	sys.exit()
 
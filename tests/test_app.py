@@ -1,3 +1,5 @@
+import json
+
 from flask import url_for
 
 
@@ -6,4 +8,109 @@ def test_app(db, client):
 
 
 def test_list_campaigns(db, client):
-	assert client.get(url_for('campaigns.list_campaigns')).status_code == 200
\ No newline at end of file
+	assert client.get(url_for('campaigns.list_campaigns')).status_code == 200
+
+
+def test_metrics(db, client):
+	client.get(url_for('campaigns.list_campaigns'))
+	response = client.get(url_for('main.prometheus_metrics'))
+	assert response.status_code == 200
+	assert b'mothership_request_latency_seconds_count{endpoint="campaigns.list_campaigns"}' in response.data
+
+
+def test_reattach(session, client):
+	from mothership import models
+	campaign = models.Campaign('reattach')
+	campaign.active = True
+	campaign.desired_fuzzers = 1
+	campaign.put()
+	instance_id = json.loads(client.get(url_for('fuzzers.register', hostname='test')).data.decode('utf-8'))['id']
+	response = client.get(url_for('fuzzers.reattach', instance_id=instance_id))
+	assert json.loads(response.data.decode('utf-8'))['id'] == instance_id
+	client.post(url_for('fuzzers.terminate', instance_id=instance_id))
+	assert client.get(url_for('fuzzers.reattach', instance_id=instance_id)).status_code == 410
+
+
+def test_sqlite_pragmas(db):
+	connection = db.engine.connect()
+	try:
+		assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+		assert connection.execute('PRAGMA synchronous').scalar() == 1  # NORMAL
+	finally:
+		connection.close()
+
+
+def test_sqlite_single_writer(app, session, client, monkeypatch, tmpdir):
+	from mothership import models, ingest
+	monkeypatch.setitem(app.config, 'SQLITE_SINGLE_WRITER', True)
+	log = ingest.Log(str(tmpdir), app.config['INGEST_SEGMENT_SIZE'], fsync=False)
+	monkeypatch.setattr(ingest, '_log', log)
+	campaign = models.Campaign('single writer')
+	campaign.active = True
+	campaign.desired_fuzzers = 1
+	campaign.put()
+	instance_id = json.loads(client.get(url_for('fuzzers.register', hostname='test')).data.decode('utf-8'))['id']
+	response = client.post(url_for('fuzzers.submit', instance_id=instance_id), content_type='application/json', data=json.dumps({
+		'status': {'last_update': 1000, 'execs_done': 100},
+		'snapshots': [{'unix_time': 1000, 'paths_total': 1}]
+	}))
+	# logged for the writer rather than written by the request
+	assert response.status_code == 202
+	assert not models.FuzzerInstance.get(id=instance_id).snapshots.count()
+
+	assert ingest.Writer(app, log).drain(log.name, log)
+	instance = models.FuzzerInstance.get(id=instance_id)
+	assert instance.execs_done == 100
+	assert [snapshot.paths_total for snapshot in instance.snapshots] == [1]
+	assert log.pending == 0
+
+
+def test_master_heartbeat_while_inactive(session, client):
+	from mothership import models
+	campaign = models.Campaign('paused master')
+	campaign.active = True
+	campaign.desired_fuzzers = 1
+	campaign.put()
+	master_id = json.loads(client.get(url_for('fuzzers.register', hostname='test', master=campaign.id)).data.decode('utf-8'))['id']
+	slave_id = json.loads(client.get(url_for('fuzzers.register', hostname='test')).data.decode('utf-8'))['id']
+	campaign.active = False
+	campaign.commit()
+
+	def terminate(instance_id):
+		return json.loads(client.post(url_for('fuzzers.heartbeat', instance_id=instance_id)).data.decode('utf-8'))['terminate']
+	# the master is paused until the campaign is active again
+	assert terminate(master_id) is False
+	assert terminate(slave_id) is True
+
+
+def test_logged_submission_answer(app, session, client, monkeypatch, tmpdir):
+	from mothership import models, ingest
+	monkeypatch.setitem(app.config, 'SQLITE_SINGLE_WRITER', True)
+	monkeypatch.setattr(ingest, '_log', ingest.Log(str(tmpdir), app.config['INGEST_SEGMENT_SIZE'], fsync=False))
+	campaign = models.Campaign('logged answer')
+	campaign.active = True
+	campaign.desired_fuzzers = 1
+	campaign.put()
+	instance_id = json.loads(client.get(url_for('fuzzers.register', hostname='test')).data.decode('utf-8'))['id']
+
+	def terminate():
+		response = client.post(url_for('fuzzers.submit', instance_id=instance_id), content_type='application/json', data=json.dumps({
+			'status': {}, 'snapshots': []
+		}))
+		assert response.status_code == 202
+		return json.loads(response.data.decode('utf-8'))['terminate']
+	# answered from what has been written so far, by whichever process wrote it
+	assert terminate() is False
+	campaign.active = False
+	campaign.commit()
+	assert terminate() is True
+
+
+def test_make_tests_twice(session, client):
+	from mothership import models
+	campaign = models.Campaign('tested')
+	campaign.put()
+	for _ in range(2):
+		client.post(url_for('campaigns.make_tests', campaign_id=campaign.id), data={'sizes': '1', 'repeats': 1})
+	# the second request is refused even though the first's files may not have been copied yet
+	assert models.Campaign.query.filter_by(name='tested | 1 fuzzer | test 1').count() == 1
@@ -0,0 +1,23 @@
+from werkzeug.contrib.cache import SimpleCache
+
+from mothership.caching import campaign_cached, invalidate
+from mothership.extensions import cache
+
+
+def test_campaign_cached(app, monkeypatch):
+	monkeypatch.setitem(app.extensions['cache'], cache, SimpleCache())
+	calls = []
+
+	@campaign_cached
+	def view(campaign_id):
+		calls.append(campaign_id)
+		return 'response %d' % len(calls)
+
+	with app.test_request_context('/'):
+		assert view(1).get_data() == b'response 1'
+		assert view(1).get_data() == b'response 1'
+		assert view(2).get_data() == b'response 2'
+		invalidate(1)
+		assert view(1).get_data() == b'response 3'
+		assert view(2).get_data() == b'response 2'
+	assert calls == [1, 2, 1]
@@ -0,0 +1,37 @@
+import os
+
+from mothership.clone import clone, unshare
+
+
+def test_clone_tree(tmpdir):
+	src = tmpdir.mkdir('src')
+	src.join('executable').write('binary')
+	src.mkdir('libraries').join('libfoo.so').write('library')
+	dst = os.path.join(str(tmpdir), 'dst')
+
+	clone(str(src), dst)
+	assert open(os.path.join(dst, 'executable')).read() == 'binary'
+	assert open(os.path.join(dst, 'libraries', 'libfoo.so')).read() == 'library'
+
+
+def test_unshare_keeps_original(tmpdir):
+	src = tmpdir.join('testcase')
+	src.write('original')
+	dst = str(tmpdir.join('clone'))
+	clone(str(src), dst)
+
+	unshare(dst)
+	with open(dst, 'w') as f:
+		f.write('modified')
+	assert src.read() == 'original'
+
+
+def test_clone_again(tmpdir):
+	src = tmpdir.join('testcase')
+	src.write('original')
+	dst = str(tmpdir.join('clone'))
+	clone(str(src), dst)
+	# a copy that is run again, e.g. after its job was requeued
+	clone(str(src), dst)
+	assert src.read() == 'original'
+	assert open(dst).read() == 'original'
@@ -0,0 +1,39 @@
+from mothership import models, coordination, jobs
+
+
+def as_process(monkeypatch, name):
+	monkeypatch.setattr(coordination, 'identity', lambda: name)
+
+
+def test_lease_expires(session, monkeypatch):
+	as_process(monkeypatch, 'first')
+	assert coordination.acquire('test lease', 60, now=1000)
+	assert coordination.acquire('test lease', 60, now=1030)
+	as_process(monkeypatch, 'second')
+	assert not coordination.acquire('test lease', 60, now=1060)
+	assert coordination.acquire('test lease', 60, now=1100)
+	assert models.Lease.get(name='test lease').holder == 'second'
+
+
+def test_requeue_orphans(session, monkeypatch):
+	as_process(monkeypatch, 'alive')
+	coordination.heartbeat(60, now=1000)
+	running = models.Job.create(kind='test', status=models.Job.RUNNING, runner='alive')
+	orphaned = models.Job.create(kind='test', status=models.Job.RUNNING, runner='dead')
+
+	assert jobs.requeue_orphans(now=1030) == 1
+	assert models.Job.get(id=running.id).status == models.Job.RUNNING
+	assert models.Job.get(id=orphaned.id).status == models.Job.PENDING
+
+
+def test_runner_heartbeats_before_starting(app, session, monkeypatch):
+	as_process(monkeypatch, 'starting')
+	runner = jobs.JobRunner(app, 1, 1, 60)
+	alive_at_start = []
+
+	class Thread:
+		def start(self):
+			alive_at_start.append([holder for holder, in coordination.alive()])
+	runner.threads = [Thread()]
+	runner.start()
+	assert alive_at_start == [['starting']]
@@ -0,0 +1,39 @@
+import json
+
+from flask import url_for
+
+from mothership import models, events
+from mothership.controllers.campaigns import stream
+
+
+def test_publish_reaches_subscribers():
+	with events.subscribe(1) as first, events.subscribe(1) as second, events.subscribe(2) as other:
+		events.publish(1, 'snapshots', {'name': 'fuzzer'})
+		assert first.get_nowait() == ('snapshots', {'name': 'fuzzer'})
+		assert second.get_nowait() == ('snapshots', {'name': 'fuzzer'})
+		assert other.empty()
+	# no one is left listening
+	events.publish(1, 'snapshots', {})
+	assert 1 not in events._subscribers
+
+
+def test_publish_drops_events_for_slow_subscribers():
+	with events.subscribe(1, maxsize=1) as queue:
+		events.publish(1, 'stats', {'n': 1})
+		events.publish(1, 'stats', {'n': 2})
+		assert queue.get_nowait() == ('stats', {'n': 1})
+		assert queue.empty()
+
+
+def test_stream_starts_with_stats(app, session, monkeypatch):
+	monkeypatch.setitem(app.config, 'STREAM_MAX_AGE', 0)
+	campaign = models.Campaign('stream')
+	campaign.put()
+	with app.test_request_context(url_for('campaigns.stream', campaign_id=campaign.id)):
+		response = stream(campaign.id)
+		assert response.mimetype == 'text/event-stream'
+		retry, stats = list(response.response)
+	assert retry == 'retry: %d\n\n' % (app.config['STREAM_RETRY'] * 1000)
+	event, data = stats.strip().split('\n')
+	assert event == 'event: stats'
+	assert json.loads(data[len('data: '):])['total_executions'] == 0
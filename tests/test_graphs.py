@@ -0,0 +1,83 @@
+import json
+
+import numpy as np
+import pytest
+from flask import url_for
+
+from mothership import models
+from mothership.controllers.graphs import resample
+
+
+def get_json(client, url):
+	return json.loads(client.get(url).data.decode('utf-8'))
+
+
+def submit(client, instance_id, unix_time, paths_total):
+	client.post(url_for('fuzzers.submit', instance_id=instance_id), content_type='application/json', data=json.dumps({
+		'status': {'start_time': 1000, 'last_update': unix_time, 'execs_done': 100},
+		'snapshots': [{'unix_time': unix_time, 'paths_total': paths_total}]
+	}))
+
+
+def test_snapshot_property_cursor(session, client):
+	campaign = models.Campaign('graph cursor')
+	campaign.active = True
+	campaign.desired_fuzzers = 2
+	campaign.put()
+	first, second = [get_json(client, url_for('fuzzers.register', hostname='test'))['id'] for _ in range(2)]
+	submit(client, first, 2000, 1)
+	submit(client, second, 1500, 2)
+
+	url = url_for('graphs.snapshot_property', campaign_id=campaign.id, property_name='paths_total')
+	cursor = get_json(client, url)['cursor']
+	# a batch of older snapshots that reaches the mothership after newer ones
+	submit(client, second, 1600, 3)
+
+	update = get_json(client, url + '?since=%d' % cursor)
+	assert sorted(y for series in update['series'] for x, y in series['data']) == [3]
+	assert update['cursor'] > cursor
+	assert not any(series['data'] for series in get_json(client, url + '?since=%d' % update['cursor'])['series'])
+
+
+def test_resample():
+	nan = float('nan')
+	grid, resampled = resample(
+		np.array([1, 1, 2, 2, 2]),
+		np.array([0., 10., 5., 6., 8.]),
+		np.array([1., 2., 10., 20., 30.]),
+		11
+	)
+	assert grid.tolist() == list(range(11))
+	# each instance holds its latest value, and is missing outside of its first and last snapshot
+	np.testing.assert_array_equal(resampled, [
+		[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2],
+		[nan, nan, nan, nan, nan, 10, 20, 20, 30, nan, nan],
+	])
+
+
+def test_aggregate_property(session, client):
+	campaign = models.Campaign('aggregate')
+	campaign.put()
+	for hostname, snapshots in [
+		('first', [(100, 1), (200, 2), (300, 3)]),
+		('ragged', [(200, 10), (300, 30)]),
+		# after a gap, which the timeline removes so its snapshots are drawn from x = 200
+		('late', [(1000, 5), (1100, 7)]),
+	]:
+		instance = models.FuzzerInstance(campaign_id=campaign.id, hostname=hostname, start_time=snapshots[0][0], last_update=snapshots[-1][0], execs_done=100)
+		session.add(instance)
+		session.flush()
+		for unix_time, paths_total in snapshots:
+			session.add(models.FuzzerSnapshot(instance_id=instance.id, unix_time=unix_time, paths_total=paths_total))
+	session.commit()
+
+	graph = get_json(client, url_for('graphs.aggregate_property', campaign_id=campaign.id, property_name='paths_total', points=4))
+	series = {series['name']: series['data'] for series in graph['series']}
+	assert [x for x, y in series['Total']] == [0, 100000, 200000, 300000]
+	for name, expected in [
+		('Total', [1, 12, 38, 7]),
+		('Mean', [1, 6, 38 / 3, 7]),
+		('10th Percentile', [1, 2.8, 3.4, 7]),
+		('90th Percentile', [1, 9.2, 25, 7]),
+	]:
+		assert [y for x, y in series[name]] == pytest.approx(expected)
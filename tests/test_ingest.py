@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+from mothership import models, coordination, ingest
+
+
+@ingest.handler('test')
+def apply_test(name):
+	if not name:
+		raise ValueError('poison')
+	models.db.session.add(models.Lease(name='ingest ' + name))
+
+
+@ingest.handler('test file')
+def apply_test_file(directory, name):
+	# saved outside of the database before the submission fails, as crashes are saved to storage
+	path = os.path.join(directory, name or 'poison')
+	open(path, 'w').close()
+	ingest.after_rollback(os.remove, path)
+	apply_test(name)
+
+
+@pytest.fixture
+def writes(db):
+	"""
+	The writer commits and rolls back its own transactions, so tests of it can't run inside the session fixture's
+	transaction and remove what they wrote instead
+	"""
+	def applied():
+		lease = models.Lease
+		return sorted(name[len('ingest '):] for name, in db.session.query(lease.name).filter(lease.name.like('ingest %')))
+	yield applied
+	models.Lease.query.filter(models.Lease.name.like('ingest %')).delete(synchronize_session=False)
+	models.IngestCheckpoint.query.delete()
+	db.session.commit()
+
+
+def test_replay_orphaned_log(app, writes, monkeypatch, tmpdir):
+	monkeypatch.setattr(coordination, 'identity', lambda: 'dead')
+	dead = ingest.Log(str(tmpdir), 64, fsync=False)
+	for name in ['first', '', 'second', 'third']:
+		dead.append('test', {'name': name})
+	with open(ingest.segment_path(str(tmpdir), dead.name, dead.segment), 'ab') as f:
+		# the process died part way through logging a submission
+		f.write(b'{"kind": "te')
+	dead.lock_file.close()
+
+	monkeypatch.setattr(coordination, 'identity', lambda: 'alive')
+	writer = ingest.Writer(app, ingest.Log(str(tmpdir), 64, fsync=False))
+	writer.adopt_orphans()
+
+	assert writes() == ['first', 'second', 'third']
+	assert not models.IngestCheckpoint.get(log='dead')
+	assert ingest.segments(str(tmpdir), 'dead') == []
+
+
+def test_drain_while_rotating(app, writes, monkeypatch, tmpdir):
+	# room for three records per segment
+	log = ingest.Log(str(tmpdir), 130, fsync=False)
+	writer = ingest.Writer(app, log)
+	appended = []
+	segments = ingest.segments
+
+	def appending(directory, name):
+		# the log appends to its segment and then rotates between the writer finding the segment empty and listing
+		# the later ones
+		for _ in range(2):
+			if len(appended) < 20:
+				appended.append('%02d' % len(appended))
+				log.append('test', {'name': appended[-1]})
+		return segments(directory, name)
+	monkeypatch.setattr(ingest, 'segments', appending)
+
+	for _ in range(100):
+		if not writer.drain(log.name, log) and len(appended) == 20:
+			break
+	assert writes() == appended
+	assert log.pending == 0
+
+
+def test_rollback_undoes_saved_files(app, writes, tmpdir):
+	log = ingest.Log(str(tmpdir), 4096, fsync=False)
+	files = tmpdir.mkdir('files')
+	for name in ['first', '', 'second']:
+		log.append('test file', {'directory': str(files), 'name': name})
+
+	# the batch fails as a whole, and then each submission is applied alone
+	assert ingest.Writer(app, log).drain(log.name, log)
+	assert writes() == ['first', 'second']
+	assert sorted(files.listdir()) == [files.join('first'), files.join('second')]
@@ -1,6 +1,6 @@
 import time
 
-from mothership import models
+from mothership import models, jobs
 
 
 def test_create_campaign():
@@ -9,3 +9,24 @@ def test_create_campaign():
 	assert campaign.id > 0
 	assert campaign.get(id=campaign.id)
 	assert len(list(campaign.all(id=campaign.id))) == 1
+
+
+@jobs.task('test_add')
+def add_job(job, a, b):
+	job.set_progress(0.5, 'adding')
+	return a + b
+
+
+def test_job_runs_inline(session):
+	job = jobs.enqueue('test_add', a=1, b=2)
+	job = models.Job.get(id=job.id)
+	assert job.status == models.Job.DONE
+	assert job.result == 3
+	assert job.progress == 1
+
+
+def test_delete_in_chunks(session):
+	session.add_all(models.Lease(name='chunk %d' % i) for i in range(2000))
+	session.commit()
+	assert models.delete_in_chunks(models.Lease, models.Lease.name.like('chunk %'), chunk_size=1500) == 2000
+	assert not models.Lease.query.filter(models.Lease.name.like('chunk %')).count()
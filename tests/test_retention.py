@@ -0,0 +1,88 @@
+import io
+import os
+
+import pytest
+
+from mothership import models, retention
+from mothership.storage import LocalStorage, campaign_key
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+START = 1000 * HOUR
+
+
+@pytest.fixture
+def store(app, monkeypatch, tmpdir):
+	store = LocalStorage(str(tmpdir.join('data')))
+	monkeypatch.setitem(app.extensions, 'mothership_storage', store)
+	monkeypatch.setitem(app.config, 'ARCHIVE_DIRECTORY', str(tmpdir.join('archive')))
+	return store
+
+
+def make_instance(session, name, times):
+	campaign = models.Campaign(name)
+	campaign.put()
+	instance = models.FuzzerInstance(campaign_id=campaign.id, hostname='%s host' % name)
+	session.add(instance)
+	session.flush()
+	for t in times:
+		session.add(models.FuzzerSnapshot(instance_id=instance.id, unix_time=t, paths_total=t - START))
+	session.commit()
+	return campaign, instance
+
+
+def snapshot_times(instance_id):
+	snapshot = models.FuzzerSnapshot
+	return [t for t, in models.db.session.query(snapshot.unix_time).filter_by(instance_id=instance_id).order_by(snapshot.unix_time)]
+
+
+def test_rollup_snapshots(app, session, monkeypatch):
+	monkeypatch.setitem(app.config, 'SNAPSHOT_ROLLUP_INTERVAL', HOUR)
+	now = START + 10 * DAY
+	campaign, instance = make_instance(session, 'rollup', [
+		START, START + 600, START + 1200,  # one hour, rolled up to its last snapshot
+		START + HOUR, START + HOUR + 600,  # the next hour
+		now - 600,                         # still within retention
+	])
+	campaign.snapshot_retention_days = 1
+	campaign.commit()
+
+	assert retention.rollup_snapshots(campaign, now=now) == 3
+	assert snapshot_times(instance.id) == [START + 1200, START + HOUR + 600, now - 600]
+	# already rolled up
+	assert retention.rollup_snapshots(campaign, now=now) == 0
+
+
+def test_rollup_disabled_by_default(app, session):
+	campaign, instance = make_instance(session, 'no rollup', [START, START + 600])
+	assert retention.rollup_snapshots(campaign, now=START + 1000 * DAY) == 0
+	assert snapshot_times(instance.id) == [START, START + 600]
+
+
+def test_archive_and_import(session, store):
+	campaign, instance = make_instance(session, 'archive', [START, START + 600])
+	crash = models.Crash(campaign_id=campaign.id, instance_id=instance.id, name='id:000000', created=START, analyzed=False)
+	session.add(crash)
+	session.flush()
+	crash.path = campaign_key(campaign.name, 'crashes', '%d_crash' % crash.id)
+	store.save(crash.path, io.BytesIO(b'crashing input'))
+	store.save(campaign_key(campaign.name, 'sync_dir', 'fuzzer.tar'), io.BytesIO(b'queue'))
+	session.commit()
+
+	path, freed = retention.archive_campaign(campaign)
+	assert os.path.exists(path)
+	assert campaign.archived
+	assert not campaign.fuzzers.count()
+	assert not campaign.crashes.count()
+	assert not store.exists(campaign_key(campaign.name, 'crashes'))
+	assert not store.exists(campaign_key(campaign.name, 'sync_dir'))
+
+	restored = retention.import_archive(path)
+	assert restored.id == campaign.id
+	assert not restored.archived
+	instance, = restored.fuzzers
+	assert instance.hostname == 'archive host'
+	assert snapshot_times(instance.id) == [START, START + 600]
+	crash, = restored.crashes
+	assert crash.name == 'id:000000' and crash.instance_id == instance.id
+	assert store.open(crash.path).read() == b'crashing input'
@@ -0,0 +1,45 @@
+from mothership import models, scheduler, reaper
+
+
+def make_campaign(name, desired, priority=1):
+	campaign = models.Campaign(name)
+	campaign.active = True
+	campaign.desired_fuzzers = desired
+	campaign.priority = priority
+	campaign.put()
+	return campaign
+
+
+def test_fair_share_spreads_fuzzers(session):
+	first = make_campaign('fair share 1', 2)
+	second = make_campaign('fair share 2', 2)
+	reserved = [scheduler.reserve('test').campaign_id for _ in range(4)]
+	assert sorted(reserved) == sorted([first.id, first.id, second.id, second.id])
+	assert scheduler.reserve('test') is None
+
+
+def test_release_frees_slot(session):
+	campaign = make_campaign('release', 1)
+	instance = scheduler.reserve('test')
+	assert instance.campaign_id == campaign.id
+	assert scheduler.reserve('test') is None
+	scheduler.release(instance)
+	assert scheduler.reserve('test').campaign_id == campaign.id
+
+
+def test_only_one_master(session):
+	campaign = make_campaign('master', 1)
+	assert scheduler.reserve_master(campaign, 'test').master
+	assert scheduler.reserve_master(campaign, 'test') is None
+
+
+def test_reaper_frees_slot(session):
+	campaign = make_campaign('reaper', 1)
+	instance = scheduler.reserve('test')
+	instance.last_heartbeat -= 60 * 60
+	instance.commit()
+	assert reaper.reap() == 1
+	assert models.FuzzerInstance.get(id=instance.id).state == models.FuzzerInstance.DEAD
+	assert scheduler.reserve('test').campaign_id == campaign.id
+	# the reaped fuzzer can't come back now that its slot has been given away
+	assert not reaper.beat(models.FuzzerInstance.get(id=instance.id))
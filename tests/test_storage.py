@@ -0,0 +1,52 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from mothership.storage import LocalStorage, S3Storage
+
+
+@pytest.fixture(params=['local', 's3'])
+def store(request, tmpdir):
+	if request.param == 'local':
+		return LocalStorage(str(tmpdir))
+	# run against MinIO (or any S3 compatible store) with e.g. MOTHERSHIP_TEST_S3=http://localhost:9000/bucket
+	url = os.environ.get('MOTHERSHIP_TEST_S3')
+	if not url:
+		pytest.skip('MOTHERSHIP_TEST_S3 is not set')
+	pytest.importorskip('boto3')
+	endpoint, bucket = url.rsplit('/', 1)
+	store = S3Storage(bucket, prefix='test_%d' % id(tmpdir), endpoint_url=endpoint)
+	request.addfinalizer(lambda: store.delete(''))
+	return store
+
+
+def test_save_and_list(store):
+	store.save('campaign/testcases/a', io.BytesIO(b'aaa'))
+	store.save('campaign/testcases/b', io.BytesIO(b'bb'))
+	store.save('campaign/executable', io.BytesIO(b'binary'))
+
+	assert store.list('campaign/testcases') == ['a', 'b']
+	assert store.list('campaign') == ['executable']
+	assert store.exists('campaign/testcases')
+	assert not store.exists('campaign/libraries')
+	assert store.size('campaign/testcases') == 5
+	assert store.open('campaign/executable').read() == b'binary'
+
+
+def test_copy_and_delete(store):
+	store.save('source/testcases/a', io.BytesIO(b'testcase'))
+	store.copy('source/testcases', 'dest/testcases')
+	store.delete('source')
+
+	assert not store.exists('source/testcases/a')
+	assert store.open('dest/testcases/a').read() == b'testcase'
+
+
+def test_tar(store):
+	store.save('campaign/libraries/libfoo.so', io.BytesIO(b'library'))
+	with tarfile.open(fileobj=store.tar('campaign/libraries', 'libraries')) as tar:
+		assert tar.extractfile('libraries/libfoo.so').read() == b'library'
+	with tarfile.open(fileobj=store.tar('campaign/ld_preload', 'ld_preload')) as tar:
+		assert tar.getnames() == ['ld_preload']
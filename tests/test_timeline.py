@@ -0,0 +1,26 @@
+from mothership import models, timeline
+
+
+def submit(instance, times):
+	for t in times:
+		instance.snapshots.append(models.FuzzerSnapshot(unix_time=t))
+	timeline.record(instance, times)
+
+
+def period_bounds(campaign):
+	return [(period.start, period.stop, period.offset) for period, _ in timeline.periods(campaign)]
+
+
+def test_periods_merge_and_offset(session):
+	campaign = models.Campaign('timeline')
+	campaign.put()
+	first, second, third = [models.FuzzerInstance.create(campaign_id=campaign.id) for _ in range(3)]
+	submit(first, [100, 200])
+	submit(third, [500, 600])
+	assert period_bounds(campaign) == [(100, 200, 100), (500, 600, 400)]
+	# a fuzzer bridging the gap merges both periods into one
+	submit(second, [150, 550])
+	assert period_bounds(campaign) == [(100, 600, 100)]
+	incremental = period_bounds(campaign)
+	timeline.rebuild(campaign)
+	assert period_bounds(campaign) == incremental
@@ -0,0 +1,12 @@
+"""
+Entry point for running the mothership under a production WSGI server with several worker processes, e.g.
+
+	gunicorn -c gunicorn.conf.py wsgi:app
+
+MOTHERSHIP_ENV chooses the settings class as it does for manage.py, but defaults to prod.
+"""
+import os
+
+from mothership import create_app
+
+app = create_app('mothership.settings.%sConfig' % os.environ.get('MOTHERSHIP_ENV', 'prod').capitalize())